@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""合成題庫產生器（效能量測用）
+
+產生接近真實分布的中文題庫：科目 / 主題呈長尾分布、年度偏向近年、少量 HTML 與近似重複題，
+並附上註記、筆記與圖片列（圖片只有資料列與 media_blobs 登錄，不產生實體檔案）。
+
+    python bench/generate_bank.py --size 10k --out bench/.data/bank_10k.db
+    python bench/generate_bank.py --rows 2500 --out /tmp/bank.db --seed 7
+
+同一個 seed 與筆數一定產生同一份資料。
+"""
+import os, sys, time, random, hashlib, argparse
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import exam_db
+
+SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+SUBJECTS = {
+    "民法":     ["總則", "債編總論", "債編各論", "物權", "親屬", "繼承"],
+    "刑法":     ["刑法總則", "構成要件", "違法性", "罪責", "刑罰", "財產犯罪", "妨害自由"],
+    "行政法":   ["行政程序法", "行政罰法", "訴願法", "行政訴訟法", "國家賠償法", "公務員法"],
+    "憲法":     ["基本權", "權力分立", "大法官解釋", "地方制度"],
+    "會計學":   ["財務報表", "存貨", "不動產廠房及設備", "無形資產", "負債", "權益", "現金流量表"],
+    "成本會計": ["分批成本", "分步成本", "標準成本", "作業基礎成本", "變動成本"],
+    "審計學":   ["內部控制", "查核證據", "查核報告", "抽樣", "職業道德"],
+    "統計學":   ["機率", "抽樣分配", "假設檢定", "迴歸分析", "變異數分析"],
+    "經濟學":   ["需求與供給", "彈性", "市場結構", "總體經濟", "貨幣銀行"],
+    "稅務法規": ["所得稅", "營業稅", "遺產及贈與稅", "土地稅", "稅捐稽徵法"],
+    "公司法":   ["股份有限公司", "董事會", "股東會", "公司重整"],
+    "民事訴訟法": ["管轄", "當事人", "證據", "上訴", "強制執行"],
+}
+TYPES = [("選擇", 70), ("複選", 15), ("申論", 10), ("是非", 5)]
+SOURCES = ["高考三級", "普考", "地方特考", "司法特考", "會計師", "記帳士", "律師一試", "自編"]
+SUBJECTS_TEXT = ["甲", "乙", "丙", "丁", "A公司", "B銀行", "某市政府", "受任人", "債權人", "被告"]
+PHRASES = [
+    "依現行法規定", "依實務見解", "下列敘述", "關於損害賠償", "請求權之消滅時效", "契約之成立",
+    "善意第三人", "意思表示", "無權代理", "不當得利", "侵權行為", "連帶責任", "期末存貨",
+    "折舊費用", "公允價值", "信賴保護原則", "比例原則", "法律保留", "正當法律程序",
+    "顯著水準", "信賴區間", "邊際成本", "機會成本", "所得額", "課稅所得", "查核人員",
+    "重大不實表達", "內部控制制度", "法定代理人", "限制行為能力人", "撤銷訴訟", "處分書",
+]
+TAILS = ["下列何者正確？", "下列何者錯誤？", "何者最為適當？", "應如何處理？", "其金額為何？", "請說明理由。"]
+CHARS = "的一是在不了有和人這中大為上個我以要他時來用們生到作地於出就分對成會可主發年動同工也能下過子說產種面而方後多定行學法所民得經十三之進著等部度家電力裡如水化高自二理起小物現實加量都兩體制機當使點從業本去把性好應開它合還因由其些然前外天政四日那社義事平形相全表間樣與關各重新線內數正心反你明看原又麼利比或但質氣第向道命此變條只沒結解問意建月公無系軍很情者最立代想已通並提直題黨程展五果料象員革位入常文總次品式活設及管特件長求老頭基資邊流路級少圖山統接知較將組見計別她手角期根論運農指幾九區強放決西被幹做必戰先回則任取據處府研"
+
+def _zipf(items:List, s:float=1.1) -> List[float]:
+    return [1 / (k + 1) ** s for k in range(len(items))]
+
+def _filler(rng:random.Random, n:int) -> str:
+    return "".join(rng.choice(CHARS) for _ in range(n))
+
+def _sentence(rng:random.Random, lo:int, hi:int) -> str:
+    parts = []
+    while sum(map(len, parts)) < rng.randint(lo, hi):
+        parts.append(rng.choice(PHRASES) if rng.random() < 0.5 else _filler(rng, rng.randint(4, 14)))
+    return "，".join(parts)
+
+def make_question(rng:random.Random, now:datetime) -> Dict[str, str]:
+    """產生一題（欄位同 exam_db.QUESTION_FIELDS）"""
+    subjects = list(SUBJECTS)
+    subject = rng.choices(subjects, weights=_zipf(subjects))[0]
+    topics = SUBJECTS[subject]
+    topic = rng.choices(topics, weights=_zipf(topics, 0.8))[0]
+    qtype = rng.choices([t for t, _ in TYPES], weights=[w for _, w in TYPES])[0]
+    year = str(max(90, 113 - int(rng.expovariate(0.25))))
+    stem = f"{rng.choice(SUBJECTS_TEXT)}{_sentence(rng, 30, 160)}，{rng.choice(TAILS)}"
+    if rng.random() < 0.15:
+        # 約 15% 的題目帶有 HTML（粗體、紅字、換行）
+        cut = rng.randint(4, max(5, len(stem) // 2))
+        stem = f"{stem[:cut]}<b><span style='color:red'>{stem[cut:cut+6]}</span></b><br>{stem[cut+6:]}"
+    if qtype in ("選擇", "複選"):
+        options = "\r\n".join(f"({c}) {_sentence(rng, 6, 30)}" for c in "ABCD")
+        answer = rng.choice("ABCD") if qtype == "選擇" else "".join(sorted(rng.sample("ABCD", rng.randint(2, 3))))
+    elif qtype == "是非":
+        options, answer = "(A) 是\r\n(B) 否", rng.choice("AB")
+    else:
+        options, answer = "", ""
+    explanation = "。".join(_sentence(rng, 20, 80) for _ in range(rng.randint(1, 5))) + "。"
+    created = now - timedelta(seconds=rng.randint(0, 3 * 365 * 86400))
+    updated = created + timedelta(seconds=int(rng.expovariate(1 / 86400)) if rng.random() < 0.3 else 0)
+    return {
+        "subject": subject, "source": f"{year}年{rng.choice(SOURCES)}", "year": year, "type": qtype,
+        "topic": topic, "subtopic": f"{topic}（{rng.randint(1, 6)}）", "stem": stem, "options": options,
+        "answer": answer, "explanation": explanation, "tags": ",".join(rng.sample(PHRASES, rng.randint(0, 3))),
+        "created_at": created.isoformat(timespec="seconds"), "updated_at": updated.isoformat(timespec="seconds"),
+    }
+
+def near_variant(rng:random.Random, stem:str) -> str:
+    """近似重複：全半形標點、空白、選項字母前綴或個別字元的差異"""
+    out = stem
+    for _ in range(rng.randint(1, 3)):
+        kind = rng.randrange(4)
+        if kind == 0:
+            out = out.replace("，", ",").replace("？", "?")
+        elif kind == 1:
+            out = f"({rng.choice('ABCD')}) {out}"
+        elif kind == 2 and len(out) > 4:
+            i = rng.randrange(1, len(out) - 1)
+            out = out[:i] + " " + out[i:]
+        else:
+            i = rng.randrange(len(out))
+            out = out[:i] + rng.choice(CHARS) + out[i+1:]
+    return out
+
+def generate(path:str, rows:int, seed:int=42, chunk:int=5000, minhash:bool=True, progress=None) -> Dict[str, int]:
+    """產生題庫到 path（既有檔案會被覆蓋）；回傳各資料表筆數"""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix): os.remove(path + suffix)
+    exam_db.DB_PATH = path
+    exam_db.MEDIA_DIR = os.path.join(os.path.dirname(os.path.abspath(path)), "media")
+    db = exam_db.get_db()
+    rng = random.Random(seed)
+    now = datetime(2024, 12, 31, 12, 0, 0)
+    cols = exam_db.QUESTION_FIELDS + ["created_at", "updated_at"]
+    recent: List[str] = []
+    shared_images = [hashlib.sha256(f"shared{i}".encode()).hexdigest() for i in range(50)]
+    next_id = 1
+    while next_id <= rows:
+        n = min(chunk, rows - next_id + 1)
+        questions, anns, notes, assets, blobs = [], [], [], [], {}
+        for qid in range(next_id, next_id + n):
+            q = make_question(rng, now)
+            # 約 3% 是前面某題的近似重複
+            if recent and rng.random() < 0.03:
+                q["stem"] = near_variant(rng, rng.choice(recent))
+            if len(recent) < 2000: recent.append(q["stem"])
+            else: recent[rng.randrange(2000)] = q["stem"]
+            questions.append((qid, *[q[c] for c in cols], exam_db.stem_hash(q["stem"])))
+            if rng.random() < 0.35:
+                wrong = min(int(rng.expovariate(0.6)), 30)
+                color = rng.choice(["", "", "", "#fff3b0", "#d0f4de", "#ffd6e0"])
+                kws = ",".join(rng.sample(PHRASES, rng.randint(1, 2))) if rng.random() < 0.2 else ""
+                anns.append((qid, color, kws, wrong, int(rng.random() < 0.4), int(rng.random() < 0.1), q["updated_at"]))
+            if rng.random() < 0.10:
+                notes.append((qid, _sentence(rng, 20, 300), q["updated_at"], q["updated_at"]))
+            if rng.random() < 0.05:
+                for _ in range(rng.randint(1, 3)):
+                    sha = rng.choice(shared_images) if rng.random() < 0.2 else hashlib.sha256(f"{seed}:{qid}:{rng.random()}".encode()).hexdigest()
+                    ext = rng.choice([".png", ".jpg"])
+                    blobs.setdefault(sha, (sha, ext, rng.randint(20_000, 900_000), 1280, 960, q["created_at"]))
+                    assets.append((qid, exam_db._blob_paths(sha, blobs[sha][1])["original"], "", q["created_at"], sha))
+        with db.write() as conn:
+            conn.executemany(f"INSERT OR IGNORE INTO questions (id, {', '.join(cols)}, stem_hash) VALUES ({', '.join(['?'] * (len(cols) + 2))})", questions)
+            # 題幹正規化後撞到既有題目而被略過的列，不產生附屬資料
+            lo, hi = next_id, next_id + n - 1
+            alive = {r[0] for r in conn.execute("SELECT id FROM questions WHERE id BETWEEN ? AND ?", (lo, hi))}
+            conn.executemany("INSERT INTO annotations (qid, color, highlight_keywords, wrong_count, done, star, last_updated) VALUES (?,?,?,?,?,?,?)",
+                             [a for a in anns if a[0] in alive])
+            conn.executemany("INSERT INTO notes (qid, note, created_at, updated_at) VALUES (?,?,?,?)", [x for x in notes if x[0] in alive])
+            conn.executemany("INSERT INTO note_assets (qid, file_path, caption, created_at, sha256) VALUES (?,?,?,?,?)", [x for x in assets if x[0] in alive])
+            conn.executemany("INSERT OR IGNORE INTO media_blobs (sha256, ext, size, width, height, created_at) VALUES (?,?,?,?,?,?)", list(blobs.values()))
+        next_id += n
+        if progress: progress(next_id - 1, rows)
+    if minhash:
+        exam_db.refresh_minhash()
+    conn = exam_db.get_conn()
+    return {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ["questions", "annotations", "notes", "note_assets", "media_blobs"]}
+
+def main():
+    ap = argparse.ArgumentParser(description="產生合成題庫（SQLite）")
+    g = ap.add_mutually_exclusive_group(required=True)
+    g.add_argument("--size", choices=list(SIZES), help="預設規模")
+    g.add_argument("--rows", type=int, help="自訂題數")
+    ap.add_argument("--out", required=True, help="輸出的 .db 路徑（會覆蓋）")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--no-minhash", action="store_true", help="不預先計算近似重複簽章")
+    args = ap.parse_args()
+    rows = args.rows or SIZES[args.size]
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    t0 = time.perf_counter()
+    def report(done, total):
+        print(f"\r{done:,}/{total:,}", end="", file=sys.stderr, flush=True)
+    counts = generate(args.out, rows, seed=args.seed, minhash=not args.no_minhash, progress=report)
+    print(file=sys.stderr)
+    print(f"{args.out}: " + ", ".join(f"{k}={v:,}" for k, v in counts.items()) + f"（{time.perf_counter() - t0:.1f}s）")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""資料層效能量測（不需要 Streamlit runtime）
+
+    python bench/run_bench.py --size 10k                  # 量測並與 bench/baseline.json 比較
+    python bench/run_bench.py --size 10k --save-baseline  # 把這次結果存成基準
+    python bench/run_bench.py --size 100k --only query    # 只跑名稱含 query 的項目
+
+題庫由 generate_bank.py 產生並快取在 bench/.data/（同 seed 同內容）。每個項目在獨立的子行程裡
+跑（會改資料的項目用題庫副本），記錄每次呼叫的 p50 / p95 與該子行程的峰值 RSS。
+量測的是 exam_db / exam_render 的函式本身，也就是 app 端 st.cache_data 沒命中時的成本。
+
+與基準比較：p50、p95 或峰值 RSS 超過基準的 (1 + --tolerance) 倍視為退步（差距小於 --min-delta-ms
+的時間差不計），有退步時結束碼為 1。基準只在同一台機器上比較才有意義。
+"""
+import os, sys, json, time, shutil, random, platform, argparse, resource, sqlite3, subprocess, tempfile
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HERE = os.path.join(ROOT, "bench")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+DATA_DIR = os.path.join(HERE, ".data")
+DEFAULT_BASELINE = os.path.join(HERE, "baseline.json")
+
+# ---------- 量測項目 ----------
+# 每個項目：setup(exam_db) 回傳一個無參數函式，每次呼叫量一次；mutates=True 的項目在題庫副本上跑
+CASES: Dict[str, Dict] = {}
+
+def case(name:str, repeat:int=20, mutates:bool=False):
+    def deco(setup:Callable):
+        CASES[name] = {"setup": setup, "repeat": repeat, "mutates": mutates}
+        return setup
+    return deco
+
+def _top_subject(db) -> str:
+    return db.get_conn().execute("SELECT value FROM facets WHERE dim='subject' ORDER BY n DESC LIMIT 1").fetchone()[0]
+
+@case("query.default")
+def _query_default(db):
+    return lambda: db.query_questions({}, "", 800, False, 0)
+
+@case("query.subject")
+def _query_subject(db):
+    subject = _top_subject(db)
+    return lambda: db.query_questions({"subject": [subject]}, "", 800, False, 0)
+
+@case("query.search_fts")
+def _query_search_fts(db):
+    return lambda: db.query_questions({}, "損害賠償", 800, False, 0)
+
+@case("query.search_like")
+def _query_search_like(db):
+    return lambda: db.query_questions({}, "契約", 800, False, 0)
+
+@case("query.wrong_only")
+def _query_wrong_only(db):
+    return lambda: db.query_questions({}, "", 800, True, 2)
+
+@case("query.count")
+def _query_count(db):
+    subject = _top_subject(db)
+    return lambda: db.count_questions({"subject": [subject]}, "", False, 0)
+
+@case("query.page_deep")
+def _query_page_deep(db):
+    # 跳到第 200 頁（每頁 50 題）：先定位 keyset 起點再取一頁
+    def run():
+        after = db.page_anchor({}, "", False, 0, 199 * 50 - 1)
+        return db.query_page({}, "", False, 0, 50, after)
+    return run
+
+@case("get_meta")
+def _get_meta(db):
+    return db.load_meta
+
+@case("facet_counts")
+def _facet_counts(db):
+    subject = _top_subject(db)
+    return lambda: db.facet_counts({"subject": [subject]}, "", False, 0)
+
+@case("study_summary")
+def _study_summary(db):
+    return lambda: db.study_summary("topic", {}, "", False, 0)
+
+@case("mock.sampler")
+def _mock_sampler(db):
+    # 快取未命中時：讀題庫快照並建各科目的 alias 表
+    from exam_mock import build_sampler
+    return lambda: build_sampler(db.mock_pool({}, "", False, 0, "subject"))
+
+@case("mock.draw_100", repeat=50)
+def _mock_draw_100(db):
+    # 快取命中後產生一份 100 題試卷：抽樣＋一次取回題目
+    from exam_mock import build_sampler, allocate, draw
+    sampler = build_sampler(db.mock_pool({}, "", False, 0, "subject"))
+    seeds = iter(range(10**6))
+    return lambda: db.questions_by_ids(draw(sampler, allocate(sampler, 100), next(seeds)))
+
+@case("insert_questions.500", repeat=10, mutates=True)
+def _insert_questions_500(db):
+    import pandas as pd
+    from generate_bank import make_question
+    from datetime import datetime
+    rng = random.Random(2024)
+    def run():
+        rows = [make_question(rng, datetime(2025, 1, 1)) for _ in range(500)]
+        return db.add_questions(pd.DataFrame(rows)[db.QUESTION_FIELDS])
+    return run
+
+@case("find_duplicate_ids_to_delete", repeat=10)
+def _find_duplicate_ids_to_delete(db):
+    return db.find_duplicate_ids_to_delete
+
+@case("delete_ids.200", repeat=10, mutates=True)
+def _delete_ids_200(db):
+    ids = [r[0] for r in db.get_conn().execute("SELECT id FROM questions")]
+    random.Random(7).shuffle(ids)
+    chunks = (ids[i:i+200] for i in range(0, len(ids), 200))
+    return lambda: db.delete_ids(next(chunks))
+
+@case("apply_highlight.50", repeat=50)
+def _apply_highlight_50(db):
+    from exam_render import apply_highlight
+    rows = db.get_conn().execute("SELECT stem, options, explanation FROM questions ORDER BY id LIMIT 50").fetchall()
+    def run():
+        for stem, options, expl in rows:
+            for txt in (stem, options, expl):
+                apply_highlight(txt, "契約,損害賠償,依實務見解", "#ffff66", "#000000")
+    return run
+
+@case("render_fragments.50", repeat=50)
+def _render_fragments_50(db):
+    # 一頁 50 張卡片的片段（第一次呼叫後命中記憶體 LRU，含查詢該頁註記）
+    rows = db.query_page({}, "", False, 0, 50)[0].to_dict("records")
+    return lambda: db.render_fragments(rows)
+
+@case("render_fragments.50.math", repeat=50)
+def _render_fragments_50_math(db):
+    # 同上，開啟算式排版（多一次掃描算式並查 latex_cache）
+    rows = db.query_page({}, "", False, 0, 50)[0].to_dict("records")
+    return lambda: db.render_fragments(rows, math=True)
+
+# ---------- 子行程：單一項目 ----------
+def _peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 單位是 KB，macOS 是 bytes
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def _percentile(xs:List[float], p:float) -> float:
+    xs = sorted(xs)
+    k = (len(xs) - 1) * p
+    lo = int(k); hi = min(lo + 1, len(xs) - 1)
+    return xs[lo] + (xs[hi] - xs[lo]) * (k - lo)
+
+def run_case(name:str, db_path:str, repeat:int) -> Dict:
+    import exam_db
+    exam_db.DB_PATH = db_path
+    exam_db.MEDIA_DIR = os.path.join(os.path.dirname(db_path), "media")
+    exam_db.get_db()
+    fn = CASES[name]["setup"](exam_db)
+    fn()  # 暖身：連線、SQLite page cache、lazy import
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return {"p50_ms": round(_percentile(times, 0.5), 3), "p95_ms": round(_percentile(times, 0.95), 3),
+            "peak_rss_mb": round(_peak_rss_mb(), 1), "n": repeat}
+
+def _spawn(name:str, db_path:str, repeat:int) -> Dict:
+    work = None
+    if CASES[name]["mutates"]:
+        work = tempfile.mkdtemp(prefix="exam_bench_")
+        src = sqlite3.connect(db_path); dst = sqlite3.connect(os.path.join(work, "bank.db"))
+        src.backup(dst); src.close(); dst.close()
+        db_path = os.path.join(work, "bank.db")
+    try:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", name, "--db", db_path, "--repeat", str(repeat)],
+                             capture_output=True, text=True, check=True)
+        return json.loads(out.stdout.strip().splitlines()[-1])
+    finally:
+        if work: shutil.rmtree(work, ignore_errors=True)
+
+# ---------- 基準比較 ----------
+def compare(results:Dict, baseline:Dict, tolerance:float, min_delta_ms:float) -> List[str]:
+    """回傳退步項目的說明"""
+    bad = []
+    for name, cur in results.items():
+        ref = baseline.get(name)
+        if not ref: continue
+        for key in ("p50_ms", "p95_ms"):
+            if cur[key] > ref[key] * (1 + tolerance) and cur[key] - ref[key] >= min_delta_ms:
+                bad.append(f"{name} {key}: {ref[key]:.2f} → {cur[key]:.2f}")
+        if cur["peak_rss_mb"] > ref["peak_rss_mb"] * (1 + tolerance):
+            bad.append(f"{name} peak_rss_mb: {ref['peak_rss_mb']:.1f} → {cur['peak_rss_mb']:.1f}")
+    return bad
+
+def _env() -> Dict:
+    return {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "platform": platform.platform(),
+            "machine": platform.node(), "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def ensure_bank(size:str, seed:int) -> str:
+    from generate_bank import SIZES
+    path = os.path.join(DATA_DIR, f"bank_{size}_s{seed}.db")
+    if not os.path.exists(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        print(f"產生題庫 {size}（只有第一次）…", file=sys.stderr)
+        # 在子行程產生，避免 exam_db 的連線留在這個行程
+        subprocess.run([sys.executable, os.path.join(HERE, "generate_bank.py"), "--rows", str(SIZES[size]),
+                        "--out", path, "--seed", str(seed)], check=True)
+    return path
+
+def main():
+    ap = argparse.ArgumentParser(description="exam_db 資料層效能量測")
+    ap.add_argument("--size", default="10k", choices=["1k", "10k", "100k", "1m"])
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--only", default="", help="只跑名稱包含此字串的項目")
+    ap.add_argument("--repeat", type=int, default=0, help="覆寫每個項目的重複次數")
+    ap.add_argument("--baseline", default=DEFAULT_BASELINE)
+    ap.add_argument("--save-baseline", action="store_true")
+    ap.add_argument("--tolerance", type=float, default=0.25)
+    ap.add_argument("--min-delta-ms", type=float, default=0.5)
+    ap.add_argument("--json", help="另存本次結果")
+    ap.add_argument("--worker", help=argparse.SUPPRESS)
+    ap.add_argument("--db", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_case(args.worker, args.db, args.repeat)))
+        return
+
+    db_path = ensure_bank(args.size, args.seed)
+    names = [n for n in CASES if args.only in n]
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {}).get(args.size, {})
+    results = {}
+    print(f"{'項目':<30}{'p50 ms':>10}{'p95 ms':>10}{'RSS MB':>9}  基準 p50")
+    for name in names:
+        r = _spawn(name, db_path, args.repeat or CASES[name]["repeat"])
+        results[name] = r
+        ref = baseline.get(name)
+        delta = f"{ref['p50_ms']:.2f} ({(r['p50_ms'] / ref['p50_ms'] - 1) * 100:+.0f}%)" if ref and ref["p50_ms"] else "—"
+        print(f"{name:<30}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['peak_rss_mb']:>9.1f}  {delta}")
+
+    report = {"env": _env(), "results": {args.size: results}}
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        data = {"env": _env(), "results": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                data = json.load(f)
+        data["env"] = _env()
+        data.setdefault("results", {}).setdefault(args.size, {}).update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        print(f"已寫入基準：{args.baseline}")
+        return
+    if not baseline:
+        print(f"找不到 {args.size} 的基準（{args.baseline}），先以 --save-baseline 建立。")
+        return
+    bad = compare(results, baseline, args.tolerance, args.min_delta_ms)
+    if bad:
+        print("\n效能退步：\n  " + "\n  ".join(bad))
+        sys.exit(1)
+    print("\n與基準相比沒有退步。")
+
+if __name__ == "__main__":
+    main()
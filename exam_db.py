@@ -0,0 +1,1555 @@
+# -*- coding: utf-8 -*-
+# 考古題 Handy Plus — 資料存取層
+# 連線管理、schema migration、題目 / 筆記 / 圖片 / 註記的讀寫、搜尋、去重與匯出。
+# 不依賴 Streamlit，可單獨 import（批次工具、效能量測）；pandas / numpy 用到才載入。
+import os, re, io, csv, html, json, time, uuid, zlib, queue, random, shutil, sqlite3, zipfile, hashlib, functools, itertools, threading, unicodedata
+from collections import Counter
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime
+from typing import TYPE_CHECKING, Callable, List, Dict
+
+from exam_profile import ProfiledConnection
+from exam_render import FragmentCache
+import exam_math
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+DB_PATH = "exam_handy.db"
+MEDIA_DIR = "media"
+
+# ---------- 連線 ----------
+class ConnectionManager:
+    """SQLite 連線管理（多人同時使用時）：
+    - 讀：每個執行緒一條自己的連線（WAL 模式下可同時讀，互不阻塞）
+    - 寫：只有一條 writer 連線，所有寫入交易序列化。長交易（匯入、刪除）用 write() 在呼叫端執行緒內進行；
+      零碎的小寫入用 submit()/run_write() 交給背景 writer 執行緒，排隊中的多筆合併成一次 commit。
+    資料庫忙碌（其他行程持有鎖）時依 busy_timeout 等待，開交易失敗再以退避重試。"""
+
+    def __init__(self, path:str, busy_timeout_ms:int=5000, max_retries:int=5, max_batch:int=64):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.max_retries = max_retries
+        self.max_batch = max_batch
+        self._local = threading.local()
+        self._readers: Dict[int, sqlite3.Connection] = {}
+        self._readers_lock = threading.Lock()
+        self._wlock = threading.RLock()
+        self._stats = Counter()
+        self._writer = self._open(check_same_thread=False)
+        self.has_fts = False   # migrate() 後才知道 SQLite 是否支援 FTS5 trigram
+        self._queue: "queue.Queue" = queue.Queue()
+        threading.Thread(target=self._writer_loop, name="db-writer", daemon=True).start()
+
+    def _open(self, check_same_thread:bool=True) -> sqlite3.Connection:
+        # isolation_level=None：交易一律明確以 BEGIN / COMMIT 控制；
+        # ProfiledConnection 在開啟效能剖析時記錄每條 SQL，平常與一般連線相同
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000,
+                               check_same_thread=check_same_thread, isolation_level=None,
+                               factory=ProfiledConnection)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA cache_size=100000;")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)};")
+        self._stats["connections_opened"] += 1
+        return conn
+
+    # ----- 讀 -----
+    def reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # 只在本執行緒使用，但結束後由其他執行緒的 _prune_readers 關閉
+            conn = self._open(check_same_thread=False)
+            conn.execute("PRAGMA query_only=1;")
+            self._local.conn = conn
+            with self._readers_lock:
+                # 執行緒 id 會被重用：同 id 的舊連線屬於已結束的執行緒
+                stale = self._readers.pop(threading.get_ident(), None)
+                if stale is not None:
+                    stale.close()
+                    self._stats["connections_closed"] += 1
+                self._readers[threading.get_ident()] = conn
+                self._prune_readers()
+        return conn
+
+    def _prune_readers(self):
+        """Streamlit 每次重跑可能換新執行緒；已結束執行緒留下的連線在這裡關閉"""
+        alive = {t.ident for t in threading.enumerate()}
+        for ident in [i for i in self._readers if i not in alive]:
+            self._readers.pop(ident).close()
+            self._stats["connections_closed"] += 1
+
+    # ----- 寫 -----
+    def _begin(self, conn:sqlite3.Connection):
+        for attempt in range(self.max_retries + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e) or attempt == self.max_retries:
+                    raise
+                self._stats["busy_retries"] += 1
+                time.sleep(min(2.0, 0.05 * 2 ** attempt) * (0.5 + random.random()))
+
+    @contextmanager
+    def write(self):
+        """在目前執行緒取得 writer 連線並開一個交易；離開時 commit，例外時 rollback"""
+        t0 = time.perf_counter()
+        with self._wlock:
+            self._stats["writer_wait_ms"] += (time.perf_counter() - t0) * 1000
+            conn = self._writer
+            if conn.in_transaction:
+                # 巢狀呼叫：併入外層交易
+                yield conn
+                return
+            self._begin(conn)
+            try:
+                yield conn
+                conn.execute("COMMIT")
+                self._stats["write_txns"] += 1
+            except BaseException:
+                conn.execute("ROLLBACK")
+                self._stats["write_rollbacks"] += 1
+                raise
+
+    def submit(self, fn:Callable) -> Future:
+        """把 fn(conn) 排進 writer 佇列；回傳 Future"""
+        fut: Future = Future()
+        self._queue.put((fn, fut))
+        return fut
+
+    def run_write(self, fn:Callable):
+        return self.submit(fn).result()
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try: batch.append(self._queue.get_nowait())
+                except queue.Empty: break
+            results = []
+            try:
+                with self.write() as conn:
+                    for i, (fn, fut) in enumerate(batch):
+                        # 每筆工作一個 savepoint，單筆失敗不影響同批其他寫入
+                        conn.execute(f"SAVEPOINT job{i}")
+                        try:
+                            results.append((fut, fn(conn), None))
+                            conn.execute(f"RELEASE job{i}")
+                        except Exception as e:
+                            conn.execute(f"ROLLBACK TO job{i}"); conn.execute(f"RELEASE job{i}")
+                            results.append((fut, None, e))
+                self._stats["batches"] += 1
+                self._stats["batched_jobs"] += len(batch)
+                self._stats["max_batch"] = max(self._stats["max_batch"], len(batch))
+            except Exception as e:
+                results = [(fut, None, e) for _, fut in batch]
+            for fut, value, err in results:
+                if err is None: fut.set_result(value)
+                else: fut.set_exception(err)
+
+    def stats(self) -> Dict:
+        with self._readers_lock:
+            readers = len(self._readers)
+        out = dict(self._stats)
+        out.update({"open_readers": readers, "queue_depth": self._queue.qsize()})
+        return out
+
+_db = None
+_db_lock = threading.Lock()
+
+def get_db() -> ConnectionManager:
+    """整個行程共用一個 ConnectionManager；第一次取用時建立並套用 schema migration"""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                os.makedirs(MEDIA_DIR, exist_ok=True)
+                db = ConnectionManager(DB_PATH)
+                migrate(db)
+                _db = db
+                # 上次結束前還沒清完的圖片檔
+                if db.reader().execute("SELECT 1 FROM media_gc LIMIT 1").fetchone():
+                    schedule_media_gc()
+    return _db
+
+def get_conn() -> sqlite3.Connection:
+    """目前執行緒的唯讀連線；寫入請用 get_db().write() 或 get_db().run_write()"""
+    return get_db().reader()
+
+def _safe_add_column(conn, table:str, col:str, decl:str) -> bool:
+    """欄位不存在才新增；回傳這次是否有新增"""
+    if col in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl};")
+    return True
+
+# ---------- schema migration ----------
+def _create_base_tables(conn):
+    """v2.0 原本的四張表與索引"""
+    cur = conn.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS questions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        subject TEXT, source TEXT, year TEXT, type TEXT,
+        topic TEXT, subtopic TEXT,
+        stem TEXT, options TEXT, answer TEXT,
+        explanation TEXT, tags TEXT,
+        created_at TEXT, updated_at TEXT
+    );""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS notes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        qid INTEGER UNIQUE,
+        note TEXT,
+        created_at TEXT, updated_at TEXT
+    );""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS note_assets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        qid INTEGER, file_path TEXT, caption TEXT, created_at TEXT
+    );""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS annotations (
+        qid INTEGER PRIMARY KEY,
+        color TEXT DEFAULT '',
+        highlight_keywords TEXT DEFAULT '',
+        hl_bg TEXT DEFAULT '#ffff66',
+        hl_fg TEXT DEFAULT '#000000',
+        wrong_count INTEGER DEFAULT 0,
+        last_updated TEXT
+    );""")
+    # 索引
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_q_subject ON questions(subject)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_q_year    ON questions(year)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_q_type    ON questions(type)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_q_topic   ON questions(topic)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_img_qid   ON note_assets(qid)")
+    # annotations 欄位（done, star）
+    _safe_add_column(conn, "annotations", "done", "INTEGER DEFAULT 0")
+    _safe_add_column(conn, "annotations", "star", "INTEGER DEFAULT 0")
+
+def _add_media_blobs(conn):
+    """圖片以內容雜湊存放（相同檔案只存一份），縮圖 / 預覽圖於上傳時產生"""
+    cur = conn.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS media_blobs (
+        sha256 TEXT PRIMARY KEY,
+        ext TEXT, size INTEGER, width INTEGER, height INTEGER,
+        created_at TEXT
+    );""")
+    _safe_add_column(conn, "note_assets", "sha256", "TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_img_sha   ON note_assets(sha256)")
+
+def _add_stem_hash(conn):
+    """題幹雜湊（正規化後的題幹摘要）＋唯一索引：匯入時交給 INSERT OR IGNORE 去重"""
+    added = _safe_add_column(conn, "questions", "stem_hash", "TEXT")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_q_stem_hash ON questions(stem_hash)")
+    if added:
+        _backfill_stem_hash(conn)
+
+# 各資料表的世代計數器：trigger 在每次異動時 +1，所有 session 的快取都以它為 key
+VERSIONED_TABLES = ["questions","annotations","notes","note_assets"]
+
+def _ensure_data_version(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS data_version (
+        tbl TEXT PRIMARY KEY,
+        gen INTEGER NOT NULL DEFAULT 0
+    );""")
+    for tbl in VERSIONED_TABLES:
+        _version_triggers(conn, tbl)
+
+def _version_triggers(conn, tbl:str):
+    """tbl 有任何異動時把 data_version 的世代加一；之後新增的表在自己的 migration 裡呼叫"""
+    conn.execute("INSERT OR IGNORE INTO data_version (tbl, gen) VALUES (?, 0)", (tbl,))
+    for op in ["INSERT","UPDATE","DELETE"]:
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {tbl}_ver_{op.lower()} AFTER {op} ON {tbl} BEGIN
+            UPDATE data_version SET gen = gen + 1 WHERE tbl = '{tbl}';
+        END;""")
+
+# 側欄篩選的維度；facets 表以 trigger 維護每個維度的不重複值與題數
+FACET_DIMS = ["subject","year","type","topic","subtopic"]
+
+def _ensure_facets(conn):
+    existed = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='facets'").fetchone() is not None
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS facets (
+        dim TEXT, value TEXT, n INTEGER NOT NULL,
+        PRIMARY KEY (dim, value)
+    ) WITHOUT ROWID;""")
+    def add(ref):
+        return "\n".join(f"""
+        INSERT INTO facets (dim, value, n) SELECT '{d}', TRIM({ref}.{d}), 1 WHERE TRIM(COALESCE({ref}.{d}, '')) <> ''
+            ON CONFLICT(dim, value) DO UPDATE SET n = n + 1;""" for d in FACET_DIMS)
+    def remove(ref):
+        return "\n".join(f"""
+        UPDATE facets SET n = n - 1 WHERE dim = '{d}' AND value = TRIM({ref}.{d});
+        DELETE FROM facets WHERE dim = '{d}' AND value = TRIM({ref}.{d}) AND n <= 0;""" for d in FACET_DIMS)
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS questions_facets_ai AFTER INSERT ON questions BEGIN {add('new')} END;")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS questions_facets_ad AFTER DELETE ON questions BEGIN {remove('old')} END;")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS questions_facets_au AFTER UPDATE OF {', '.join(FACET_DIMS)} ON questions BEGIN {remove('old')} {add('new')} END;")
+    if not existed:
+        for d in FACET_DIMS:
+            conn.execute(f"""INSERT INTO facets (dim, value, n)
+                SELECT '{d}', TRIM({d}), COUNT(*) FROM questions WHERE TRIM(COALESCE({d}, '')) <> '' GROUP BY TRIM({d})""")
+
+def data_version(*tables:str) -> tuple:
+    """目前各資料表的世代（跨 session、跨行程皆一致）；用來當 st.cache_data 的 key，只失效受影響的快取"""
+    rows = dict(get_conn().execute("SELECT tbl, gen FROM data_version").fetchall())
+    return tuple(rows.get(t, 0) for t in tables)
+
+def normalize_stem(stem:str) -> str:
+    """題幹正規化：全形/半形統一（NFKC）、去頭尾空白、連續空白合併為一個"""
+    return " ".join(unicodedata.normalize("NFKC", stem or "").split())
+
+def stem_hash(stem:str) -> str:
+    return hashlib.sha1(normalize_stem(stem).encode("utf-8")).hexdigest()
+
+def _backfill_stem_hash(conn, batch:int=5000):
+    """替既有題目補上 stem_hash。已存在的重複題保留 NULL（UPDATE OR IGNORE），之後可用去重功能清掉"""
+    read = conn.execute("SELECT id, stem FROM questions WHERE stem_hash IS NULL ORDER BY id")
+    while True:
+        rows = read.fetchmany(batch)
+        if not rows: break
+        conn.executemany("UPDATE OR IGNORE questions SET stem_hash=? WHERE id=?",
+                         [(stem_hash(str(stem or "")), qid) for qid, stem in rows])
+
+def _ensure_minhash(conn):
+    """近似重複題的 MinHash 簽章；題目刪除或題幹修改時由 trigger 清掉，refresh_minhash() 再補算"""
+    conn.execute("CREATE TABLE IF NOT EXISTS stem_minhash (qid INTEGER PRIMARY KEY, sig BLOB)")
+    conn.execute("CREATE TRIGGER IF NOT EXISTS questions_minhash_ad AFTER DELETE ON questions BEGIN DELETE FROM stem_minhash WHERE qid = old.id; END;")
+    conn.execute("CREATE TRIGGER IF NOT EXISTS questions_minhash_au AFTER UPDATE OF stem ON questions WHEN old.stem IS NOT new.stem "
+                 "BEGIN DELETE FROM stem_minhash WHERE qid = old.id; END;")
+
+# 全文檢索涵蓋的欄位（與原本 LIKE 搜尋的八個欄位相同）
+FTS_COLUMNS = ["stem","explanation","tags","source","options","topic","subject","subtopic"]
+
+def _ensure_fts(conn) -> bool:
+    """建立 questions_fts（外部內容表，trigram 斷詞免分詞即可搜中文）與同步 trigger；
+    首次建立時從 questions 回填。SQLite 不支援 FTS5/trigram（< 3.34）時回傳 False。"""
+    cur = conn.cursor()
+    existed = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='questions_fts'").fetchone() is not None
+    cols = ", ".join(FTS_COLUMNS)
+    new_cols = ", ".join(f"new.{c}" for c in FTS_COLUMNS)
+    old_cols = ", ".join(f"old.{c}" for c in FTS_COLUMNS)
+    try:
+        cur.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+            {cols}, content='questions', content_rowid='id', tokenize='trigram'
+        );""")
+    except sqlite3.OperationalError:
+        return False
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS questions_fts_ai AFTER INSERT ON questions BEGIN
+        INSERT INTO questions_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+    END;""")
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS questions_fts_ad AFTER DELETE ON questions BEGIN
+        INSERT INTO questions_fts(questions_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+    END;""")
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS questions_fts_au AFTER UPDATE OF {cols} ON questions BEGIN
+        INSERT INTO questions_fts(questions_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+        INSERT INTO questions_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+    END;""")
+    if not existed:
+        cur.execute("INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')")
+    return True
+
+# 讀書狀態（錯誤次數 / 已做過 / 星號）在 questions 上留一份副本，由 annotations 的 trigger 維護，
+# 題目查詢不必 JOIN，預設排序與狀態篩選可以直接走索引（不必每次把篩選結果整個排序）
+STUDY_STATE = ["wrong_count","done","star"]
+
+def _denormalize_study_state(conn):
+    for col in STUDY_STATE:
+        _safe_add_column(conn, "questions", col, "INTEGER NOT NULL DEFAULT 0")
+    def copy(ref):
+        return ", ".join(f"{c} = COALESCE({ref}.{c}, 0)" for c in STUDY_STATE)
+    reset = ", ".join(f"{c} = 0" for c in STUDY_STATE)
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS annotations_state_ai AFTER INSERT ON annotations BEGIN "
+                 f"UPDATE questions SET {copy('new')} WHERE id = new.qid; END;")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS annotations_state_au AFTER UPDATE OF qid, {', '.join(STUDY_STATE)} ON annotations BEGIN "
+                 f"UPDATE questions SET {reset} WHERE id = old.qid AND old.qid IS NOT new.qid; "
+                 f"UPDATE questions SET {copy('new')} WHERE id = new.qid; END;")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS annotations_state_ad AFTER DELETE ON annotations BEGIN "
+                 f"UPDATE questions SET {reset} WHERE id = old.qid; END;")
+    conn.execute(f"""UPDATE questions SET ({', '.join(STUDY_STATE)}) =
+        (SELECT {', '.join(f'COALESCE(a.{c}, 0)' for c in STUDY_STATE)} FROM annotations a WHERE a.qid = questions.id)
+        WHERE id IN (SELECT qid FROM annotations)""")
+    # 只有題目內容變動才算 questions 異動；讀書狀態副本的更新不讓選單等快取失效
+    content = QUESTION_FIELDS + ["created_at","updated_at","stem_hash"]
+    conn.execute("DROP TRIGGER IF EXISTS questions_ver_update")
+    conn.execute(f"""
+    CREATE TRIGGER questions_ver_update AFTER UPDATE OF {', '.join(content)} ON questions BEGIN
+        UPDATE data_version SET gen = gen + 1 WHERE tbl = 'questions';
+    END;""")
+    # 排序鍵 (wrong_count, COALESCE(updated_at,''), id) 的索引：反向掃描即為預設順序，rowid 在索引尾端
+    order = "wrong_count, COALESCE(updated_at,'')"
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_q_order ON questions({order})")
+    # 常用篩選＋排序；取代原本只有單欄的科目、年度索引
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_q_subject_order ON questions(subject, {order})")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_q_year_order ON questions(year, {order})")
+    conn.execute("DROP INDEX IF EXISTS idx_q_subject")
+    conn.execute("DROP INDEX IF EXISTS idx_q_year")
+    # 部分索引：只含做錯過 / 已做過 / 加星的題目，條件須與 _question_query_parts 產生的字面一致
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_q_wrong ON questions({order}) WHERE wrong_count > 0")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_q_done  ON questions({order}) WHERE done > 0")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_q_star  ON questions({order}) WHERE star > 0")
+    conn.execute("ANALYZE questions")
+
+def _add_media_gc(conn):
+    """待刪除的圖片檔佇列：刪除交易只登記路徑，檔案由背景執行緒 collect_media_garbage() 移除"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS media_gc (
+        id INTEGER PRIMARY KEY,
+        sha256 TEXT, file_path TEXT NOT NULL,
+        queued_at TEXT
+    );""")
+
+# 進度總覽的彙總表：每個 (科目, 年度, 題型, 主題, 次主題) 組合的題數與讀書狀態計數。
+# 由 questions 的 trigger 增量維護（讀書狀態副本由 annotations 的 trigger 回寫，因此註記異動也會反映），
+# 總覽只需掃過組合數量的列，與題庫大小無關
+ROLLUP_MEASURES = ["total","done","wrong","wrong_sum","star"]
+
+def _ensure_study_rollup(conn):
+    existed = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='study_rollup'").fetchone() is not None
+    dims = ", ".join(FACET_DIMS)
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS study_rollup (
+        {", ".join(f"{d} TEXT NOT NULL" for d in FACET_DIMS)},
+        {", ".join(f"{m} INTEGER NOT NULL DEFAULT 0" for m in ROLLUP_MEASURES)},
+        PRIMARY KEY ({dims})
+    ) WITHOUT ROWID;""")
+    def measures(ref):
+        return f"1, {ref}.done > 0, {ref}.wrong_count > 0, {ref}.wrong_count, {ref}.star > 0"
+    def key(ref):
+        return ", ".join(f"COALESCE({ref}.{d}, '')" for d in FACET_DIMS)
+    def match(ref):
+        return " AND ".join(f"{d} = COALESCE({ref}.{d}, '')" for d in FACET_DIMS)
+    def add(ref):
+        return (f"INSERT INTO study_rollup ({dims}, {', '.join(ROLLUP_MEASURES)}) VALUES ({key(ref)}, {measures(ref)}) "
+                f"ON CONFLICT({dims}) DO UPDATE SET {', '.join(f'{m} = {m} + excluded.{m}' for m in ROLLUP_MEASURES)};")
+    def remove(ref):
+        vals = dict(zip(ROLLUP_MEASURES, measures(ref).split(", ")))
+        return (f"UPDATE study_rollup SET {', '.join(f'{m} = {m} - ({vals[m]})' for m in ROLLUP_MEASURES)} WHERE {match(ref)}; "
+                f"DELETE FROM study_rollup WHERE {match(ref)} AND total <= 0;")
+    watched = ", ".join(FACET_DIMS + STUDY_STATE)
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS questions_rollup_ai AFTER INSERT ON questions BEGIN {add('new')} END;")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS questions_rollup_ad AFTER DELETE ON questions BEGIN {remove('old')} END;")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS questions_rollup_au AFTER UPDATE OF {watched} ON questions BEGIN {remove('old')} {add('new')} END;")
+    if not existed:
+        conn.execute(f"""INSERT INTO study_rollup ({dims}, {', '.join(ROLLUP_MEASURES)})
+            SELECT {key('q')}, COUNT(*), SUM(q.done > 0), SUM(q.wrong_count > 0), SUM(q.wrong_count), SUM(q.star > 0)
+            FROM questions q GROUP BY {key('q')}""")
+
+def _add_jobs(conn):
+    """背景工作（exam_jobs.py）：狀態、進度、計數、可續跑的檢查點與結果"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL, title TEXT, params TEXT,
+        status TEXT NOT NULL DEFAULT 'queued',
+        owner TEXT,
+        done_units INTEGER DEFAULT 0, total_units INTEGER DEFAULT 0,
+        message TEXT, counters TEXT, checkpoint TEXT, result TEXT, error TEXT,
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT, started_at TEXT, finished_at TEXT, updated_at TEXT
+    );""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)")
+
+def _add_render_cache(conn):
+    """題目 HTML 片段（exam_render.FragmentCache 的持久層）：每題保留最新一份，題目刪除時一併刪除"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS render_cache (
+        qid INTEGER PRIMARY KEY,
+        updated_at TEXT, ann_ver TEXT, html TEXT
+    );""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS questions_render_ad AFTER DELETE ON questions BEGIN
+        DELETE FROM render_cache WHERE qid = old.id; END""")
+
+def _add_latex_cache(conn):
+    """算式轉換結果（exam_math）：以算式雜湊為鍵；latex 為 NULL 表示無法解析，不再重試"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS latex_cache (
+        hash TEXT PRIMARY KEY,
+        expr TEXT, latex TEXT, simplified TEXT, created_at TEXT
+    ) WITHOUT ROWID;""")
+    _version_triggers(conn, "latex_cache")
+
+# 裝置同步（exam_sync）的異動紀錄：每筆 (表, uid) 只留最新一列，每次異動先刪再插入、換上新的 seq，
+# 所以「seq 大於 N 的列」就是 N 之後有變動的資料；刪除留下 op='d' 的墓碑。
+# 題目與圖片以 uid 識別（各裝置的 id 不同），筆記與註記跟著題目的 uid。origin 為匯入來源裝置，本機異動為 NULL
+SYNC_TABLES = ["questions","notes","annotations","note_assets"]
+_SYNC_NOW = "strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime')"
+
+def _add_changes(conn):
+    for tbl in ("questions", "note_assets"):
+        if _safe_add_column(conn, tbl, "uid", "TEXT"):
+            conn.execute(f"UPDATE {tbl} SET uid = lower(hex(randomblob(16))) WHERE uid IS NULL")
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{tbl}_uid ON {tbl}(uid)")
+    existed = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='changes'").fetchone() is not None
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        tbl TEXT NOT NULL, uid TEXT NOT NULL, op TEXT NOT NULL,
+        at TEXT, origin TEXT,
+        UNIQUE (tbl, uid)
+    );""")
+    conn.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("INSERT OR IGNORE INTO sync_state (key, value) VALUES ('device', lower(hex(randomblob(8))))")
+    # 本機清除資料（clear_all）時 +1，對方看到較新的 epoch 才接受變小的確認位置
+    conn.execute("INSERT OR IGNORE INTO sync_state (key, value) VALUES ('epoch', '0')")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sync_peers (
+        peer TEXT PRIMARY KEY, name TEXT,
+        acked INTEGER NOT NULL DEFAULT 0,
+        received INTEGER NOT NULL DEFAULT 0,
+        epoch INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT
+    );""")
+    # 不用 INSERT OR REPLACE：觸發語句本身帶 ON CONFLICT（upsert、OR IGNORE）時，trigger 內的衝突處理會被它取代
+    def log(tbl, op, uid):
+        return (f"DELETE FROM changes WHERE tbl = '{tbl}' AND uid = {uid}; "
+                f"INSERT INTO changes (tbl, uid, op, at) SELECT '{tbl}', {uid}, '{op}', {_SYNC_NOW} WHERE {uid} IS NOT NULL;")
+    def quid(ref):
+        return f"(SELECT uid FROM questions WHERE id = {ref}.qid)"
+    # 新列沒給 uid 時補一個（程式寫入都會給，這裡是保險）
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS questions_changes_ai AFTER INSERT ON questions BEGIN
+        UPDATE questions SET uid = lower(hex(randomblob(16))) WHERE id = new.id AND new.uid IS NULL;
+        {log('questions', 'u', '(SELECT uid FROM questions WHERE id = new.id)')} END;""")
+    # 讀書狀態副本由 annotations 回寫，不算題目異動
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS questions_changes_au AFTER UPDATE OF {', '.join(QUESTION_FIELDS)}, uid ON questions BEGIN
+        {log('questions', 'u', 'new.uid')} END;""")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS questions_changes_ad AFTER DELETE ON questions BEGIN {log('questions', 'd', 'old.uid')} END;")
+    for tbl in ("notes", "annotations"):
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {tbl}_changes_ai AFTER INSERT ON {tbl} BEGIN {log(tbl, 'u', quid('new'))} END;")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {tbl}_changes_au AFTER UPDATE ON {tbl} BEGIN {log(tbl, 'u', quid('new'))} END;")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {tbl}_changes_ad AFTER DELETE ON {tbl} BEGIN {log(tbl, 'd', quid('old'))} END;")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS note_assets_changes_ai AFTER INSERT ON note_assets BEGIN
+        UPDATE note_assets SET uid = lower(hex(randomblob(16))) WHERE id = new.id AND new.uid IS NULL;
+        {log('note_assets', 'u', '(SELECT uid FROM note_assets WHERE id = new.id)')} END;""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS note_assets_changes_au AFTER UPDATE OF qid, caption, sha256, uid ON note_assets BEGIN
+        {log('note_assets', 'u', 'new.uid')} END;""")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS note_assets_changes_ad AFTER DELETE ON note_assets BEGIN {log('note_assets', 'd', 'old.uid')} END;")
+    if not existed:
+        # 既有資料全部記一筆，seq 0 之後的異動就是完整快照（新裝置第一次同步用）
+        conn.execute("INSERT INTO changes (tbl, uid, op, at) SELECT 'questions', uid, 'u', updated_at FROM questions ORDER BY id")
+        for tbl, ts in (("notes", "updated_at"), ("annotations", "last_updated")):
+            conn.execute(f"INSERT INTO changes (tbl, uid, op, at) SELECT '{tbl}', q.uid, 'u', t.{ts} FROM {tbl} t JOIN questions q ON q.id = t.qid ORDER BY q.id")
+        conn.execute("INSERT INTO changes (tbl, uid, op, at) SELECT 'note_assets', uid, 'u', created_at FROM note_assets ORDER BY id")
+
+# 依序套用；PRAGMA user_version 記錄已套用到第幾步。只能往後加，已發佈的步驟不可改動或調換順序。
+# 每一步都要能在「舊版程式已建好部分結構」的資料庫上重跑（IF NOT EXISTS / 先檢查欄位）。
+MIGRATIONS: List[Callable] = [
+    _create_base_tables,
+    _add_media_blobs,
+    _add_stem_hash,
+    _ensure_data_version,
+    _ensure_facets,
+    _ensure_minhash,
+    _ensure_fts,
+    _denormalize_study_state,
+    _add_media_gc,
+    _ensure_study_rollup,
+    _add_jobs,
+    _add_render_cache,
+    _add_latex_cache,
+    _add_changes,
+]
+
+def migrate(db:ConnectionManager) -> int:
+    """套用尚未執行的 migration，回傳目前版本。已是最新版時只讀一次 user_version，不開寫入交易。
+    需要升級時在寫入鎖內重讀版本，多個行程同時啟動也只會有一個真的執行。"""
+    conn = db.reader()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < len(MIGRATIONS):
+        with db.write() as w:
+            version = w.execute("PRAGMA user_version").fetchone()[0]
+            for step in range(version, len(MIGRATIONS)):
+                MIGRATIONS[step](w)
+                w.execute(f"PRAGMA user_version = {step + 1}")
+            version = max(version, len(MIGRATIONS))
+    db.has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name='questions_fts'").fetchone() is not None
+    return version
+
+# ---------- 題目 / 註記 ----------
+# annotations 欄位與資料表預設值（沒有列時視為預設值，不必先寫入空列）
+ANN_FIELDS = ["color","highlight_keywords","hl_bg","hl_fg","wrong_count","done","star"]
+ANN_DEFAULTS = {"color": "", "highlight_keywords": "", "hl_bg": "#ffff66", "hl_fg": "#000000",
+                "wrong_count": 0, "done": 0, "star": 0}
+
+QUESTION_FIELDS = ["subject","source","year","type","topic","subtopic","stem","options","answer","explanation","tags"]
+
+def _insert_question_chunk(conn, df:"pd.DataFrame"):
+    """寫入一批題目（不 commit）：題幹雜湊撞到唯一索引的列由 INSERT OR IGNORE 跳過。
+    回傳 (新增數, 跳過數)；題幹空白的列也算跳過。"""
+    df = df.copy()
+    for c in QUESTION_FIELDS:
+        if c not in df.columns:
+            df[c] = ""
+        df[c] = df[c].fillna("").astype(str)
+    df["stem"] = df["stem"].str.strip()
+    blank = int((df["stem"] == "").sum())
+    df = df[df["stem"] != ""]
+    now = datetime.now().isoformat(timespec="seconds")
+    rows = [(*vals, stem_hash(vals[6]), now, now, uuid.uuid4().hex) for vals in df[QUESTION_FIELDS].itertuples(index=False, name=None)]
+    cur = conn.cursor()
+    cur.executemany(f"INSERT OR IGNORE INTO questions ({', '.join(QUESTION_FIELDS)}, stem_hash, created_at, updated_at, uid) "
+                    f"VALUES ({', '.join(['?']*(len(QUESTION_FIELDS)+4))})", rows)
+    inserted = max(cur.rowcount, 0)
+    return inserted, blank + len(rows) - inserted
+
+def import_questions_csv(src, chunksize:int=5000, encoding:str="utf-8-sig", on_progress=None):
+    """分批串流匯入 CSV，全部批次在同一個交易內；記憶體用量只跟 chunksize 有關。
+    on_progress(已讀列數, 新增數, 跳過數) 每批呼叫一次。回傳 (新增數, 跳過數)。"""
+    import pandas as pd
+    inserted = skipped = read = 0
+    with get_db().write() as conn:
+        for chunk in pd.read_csv(src, encoding=encoding, dtype=str, keep_default_na=False, chunksize=chunksize):
+            n_ins, n_skip = _insert_question_chunk(conn, chunk)
+            inserted += n_ins; skipped += n_skip; read += len(chunk)
+            if on_progress: on_progress(read, inserted, skipped)
+    refresh_minhash()
+    refresh_render_cache()
+    return inserted, skipped
+
+def add_questions(df:"pd.DataFrame"):
+    """寫入一批題目（單一交易）；回傳 (新增數, 跳過數)"""
+    with get_db().write() as conn:
+        inserted, skipped = _insert_question_chunk(conn, df)
+    refresh_minhash()
+    refresh_render_cache()
+    return inserted, skipped
+
+def update_question_row(qid:int, data:Dict):
+    """更新題目；修改後的題幹若與其他題重複，回滾並拋出 ValueError"""
+    sets, vals = [], []
+    for f in QUESTION_FIELDS:
+        sets.append(f"{f}=?"); vals.append(data.get(f,""))
+    sets.append("stem_hash=?"); vals.append(stem_hash(data.get("stem","")))
+    sets.append("updated_at=?"); vals.append(datetime.now().isoformat(timespec='seconds'))
+    vals.append(qid)
+    try:
+        with get_db().write() as conn:
+            conn.execute(f"UPDATE questions SET {', '.join(sets)} WHERE id=?", vals)
+    except sqlite3.IntegrityError:
+        raise ValueError("題幹與資料庫中其他題目重複")
+    refresh_minhash()
+    if MATH_DEFAULT:
+        convert_formulas(pending_formulas([qid]))
+    refresh_render_cache([qid])
+
+def chunked(seq:List, size:int=500):
+    """切成小段，避免 IN (?,?,...) 超過 SQLite 參數上限"""
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
+def notes_bulk(qids) -> Dict[int, str]:
+    """一次取回多題的筆記：{qid: note}，沒有筆記的題目不在結果中"""
+    conn = get_conn(); out: Dict[int, str] = {}
+    for part in chunked(list(qids)):
+        holders = ",".join(["?"]*len(part))
+        for qid, note in conn.execute(f"SELECT qid, note FROM notes WHERE qid IN ({holders})", part):
+            out[int(qid)] = note or ""
+    return out
+
+def save_note(qid:int, text:str):
+    now = datetime.now().isoformat(timespec='seconds')
+    get_db().run_write(lambda conn: conn.execute(
+        "INSERT INTO notes (qid, note, created_at, updated_at) VALUES (?,?,?,?) ON CONFLICT(qid) DO UPDATE SET note=excluded.note, updated_at=excluded.updated_at",
+        (qid, text, now, now)))
+
+def images_bulk(qids) -> Dict[int, List[Dict]]:
+    """一次取回多題的圖片：{qid: [{id, file_path, caption, created_at, sha256}, ...]}（新上傳的在前）"""
+    conn = get_conn(); out: Dict[int, List[Dict]] = {}
+    for part in chunked(list(qids)):
+        holders = ",".join(["?"]*len(part))
+        rows = conn.execute(f"SELECT qid, id, file_path, caption, created_at, sha256 FROM note_assets WHERE qid IN ({holders}) ORDER BY qid, id DESC", part)
+        for qid, aid, path, cap, created, sha in rows:
+            out.setdefault(int(qid), []).append({"id": aid, "file_path": path, "caption": cap, "created_at": created, "sha256": sha})
+    return out
+
+# ---------- media（內容定址） ----------
+THUMB_PX = 320      # 卡片縮圖
+PREVIEW_PX = 1280   # 逐題模式預覽圖
+
+def _blob_paths(sha:str, ext:str) -> Dict[str, str]:
+    """原檔 media/objects/ab/<sha><ext>；縮圖與預覽圖為 WebP"""
+    sub = sha[:2]
+    return {
+        "original": os.path.join(MEDIA_DIR, "objects", sub, f"{sha}{ext}"),
+        "thumb":    os.path.join(MEDIA_DIR, "thumbs",  sub, f"{sha}.webp"),
+        "preview":  os.path.join(MEDIA_DIR, "preview", sub, f"{sha}.webp"),
+    }
+
+def _write_atomic(path:str, data:bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _make_derivatives(src:str, paths:Dict[str, str]):
+    """產生縮圖與預覽圖，回傳原圖 (寬, 高)；不是圖片時回傳 (None, None)。Pillow 隨 Streamlit 安裝，用到才載入"""
+    from PIL import Image, ImageOps
+    try:
+        with Image.open(src) as im:
+            im = ImageOps.exif_transpose(im)
+            size = im.size
+            if im.mode not in ("RGB", "RGBA"):
+                im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+            for key, px in (("preview", PREVIEW_PX), ("thumb", THUMB_PX)):
+                if not os.path.exists(paths[key]):
+                    os.makedirs(os.path.dirname(paths[key]), exist_ok=True)
+                    im.thumbnail((px, px))
+                    im.save(paths[key], "WEBP", quality=80)
+            return size
+    except Exception:
+        return None, None
+
+def _prepare_blob(file_bytes:bytes, ext:str) -> Dict:
+    """在寫入交易之外呼叫：寫入內容定址儲存區（已存在就不重寫）並產生縮圖 / 預覽圖。
+    路徑由雜湊決定，重複寫入結果相同，解碼與 WebP 編碼不佔住 writer。回傳交給 _register_blob 的資料"""
+    sha = hashlib.sha256(file_bytes).hexdigest()
+    row = get_conn().execute("SELECT ext FROM media_blobs WHERE sha256=?", (sha,)).fetchone()
+    ext = row[0] if row else ext
+    paths = _blob_paths(sha, ext)
+    if not os.path.exists(paths["original"]):
+        _write_atomic(paths["original"], file_bytes)
+    width, height = _make_derivatives(paths["original"], paths)
+    return {"sha256": sha, "ext": ext, "size": len(file_bytes), "width": width, "height": height, "data": file_bytes}
+
+def _register_blob(conn, blob:Dict) -> str:
+    """在寫入交易內登錄到 media_blobs，回傳實際使用的副檔名。原檔若在登錄前被 media_gc 移除（同一張圖剛被刪又上傳）
+    就在鎖內補寫原檔；缺的縮圖由「整理圖片庫」補產生，顯示時退回原檔"""
+    sha = blob["sha256"]
+    conn.execute("INSERT OR IGNORE INTO media_blobs (sha256, ext, size, width, height, created_at) VALUES (?,?,?,?,?,?)",
+                 (sha, blob["ext"], blob["size"], blob["width"], blob["height"], datetime.now().isoformat(timespec='seconds')))
+    ext = conn.execute("SELECT ext FROM media_blobs WHERE sha256=?", (sha,)).fetchone()[0]
+    original = _blob_paths(sha, ext)["original"]
+    if not os.path.exists(original):
+        _write_atomic(original, blob["data"])
+    return ext
+
+def _release_blobs(conn, shas):
+    """引用計數：已沒有任何 note_assets 參照的 blob 刪除登錄，檔案排入 media_gc（呼叫前須已刪掉參照列）"""
+    now = datetime.now().isoformat(timespec='seconds')
+    for sha in set(x for x in shas if x):
+        if conn.execute("SELECT 1 FROM note_assets WHERE sha256=? LIMIT 1", (sha,)).fetchone():
+            continue
+        row = conn.execute("SELECT ext FROM media_blobs WHERE sha256=?", (sha,)).fetchone()
+        conn.executemany("INSERT INTO media_gc (sha256, file_path, queued_at) VALUES (?,?,?)",
+                         [(sha, path, now) for path in _blob_paths(sha, row[0] if row else "").values()])
+        conn.execute("DELETE FROM media_blobs WHERE sha256=?", (sha,))
+
+def _remove_legacy_files(conn, paths):
+    """舊版（未內容定址）的圖片檔，已無列參照時排入 media_gc"""
+    now = datetime.now().isoformat(timespec='seconds')
+    for path in set(x for x in paths if x):
+        if conn.execute("SELECT 1 FROM note_assets WHERE file_path=? LIMIT 1", (path,)).fetchone():
+            continue
+        conn.execute("INSERT INTO media_gc (sha256, file_path, queued_at) VALUES (NULL,?,?)", (path, now))
+
+def collect_media_garbage(batch:int=200) -> int:
+    """移除 media_gc 佇列中的檔案，回傳刪除的檔案數。每批在寫入鎖內重新確認：
+    排隊期間同一張圖又被上傳（media_blobs 有列）或舊版路徑又被參照時保留檔案"""
+    db = get_db(); removed = 0; last = 0
+    while True:
+        with db.write() as conn:
+            rows = conn.execute("SELECT id, sha256, file_path FROM media_gc WHERE id > ? ORDER BY id LIMIT ?", (last, batch)).fetchall()
+            if not rows:
+                return removed
+            done = []
+            for gid, sha, path in rows:
+                last = gid
+                if sha:
+                    keep = conn.execute("SELECT 1 FROM media_blobs WHERE sha256=?", (sha,)).fetchone()
+                else:
+                    keep = conn.execute("SELECT 1 FROM note_assets WHERE file_path=? LIMIT 1", (path,)).fetchone()
+                if not keep:
+                    try:
+                        os.remove(path); removed += 1
+                    except FileNotFoundError:
+                        pass
+                    except OSError:
+                        continue  # 暫時無法刪除（例如 Windows 上檔案被開啟），留在佇列下次再試
+                done.append((gid,))
+            conn.executemany("DELETE FROM media_gc WHERE id=?", done)
+
+_gc_lock = threading.Lock()
+_gc_thread = None
+_gc_again = False
+
+def schedule_media_gc():
+    """在背景執行緒清理 media_gc；已在跑時只標記跑完再掃一次（呼叫端的交易 commit 後新排入的檔案）"""
+    global _gc_thread, _gc_again
+    def run():
+        global _gc_thread, _gc_again
+        while True:
+            try:
+                collect_media_garbage()
+            except Exception:
+                pass
+            with _gc_lock:
+                if not _gc_again:
+                    _gc_thread = None
+                    return
+                _gc_again = False
+    with _gc_lock:
+        if _gc_thread is not None:
+            _gc_again = True
+            return
+        _gc_thread = threading.Thread(target=run, name="media-gc", daemon=True)
+        _gc_thread.start()
+
+def media_variant(asset:Dict, kind:str) -> str:
+    """取得圖片的 thumb / preview 路徑；舊資料尚未產生縮圖時退回原檔"""
+    sha = asset.get("sha256")
+    if sha:
+        path = _blob_paths(sha, "")[kind]
+        if os.path.exists(path):
+            return path
+    return asset["file_path"]
+
+def add_image(qid:int, file_bytes:bytes, filename:str, caption:str=""):
+    ext = os.path.splitext(filename)[1].lower()
+    safe_ext = ext if re.fullmatch(r"\.[a-z0-9]{1,8}", ext) else ".bin"
+    blob = _prepare_blob(file_bytes, safe_ext)
+    with get_db().write() as conn:
+        ext = _register_blob(conn, blob)
+        conn.execute("INSERT INTO note_assets (qid, file_path, caption, created_at, sha256, uid) VALUES (?,?,?,?,?,?)",
+                     (qid, _blob_paths(blob["sha256"], ext)["original"], caption, datetime.now().isoformat(timespec='seconds'),
+                      blob["sha256"], uuid.uuid4().hex))
+
+def delete_image(asset_id:int):
+    with get_db().write() as conn:
+        row = conn.execute("SELECT file_path, sha256 FROM note_assets WHERE id=?", (asset_id,)).fetchone()
+        conn.execute("DELETE FROM note_assets WHERE id=?", (asset_id,))
+        if row:
+            path, sha = row
+            if sha: _release_blobs(conn, [sha])
+            else: _remove_legacy_files(conn, [path])
+    schedule_media_gc()
+
+def backfill_media() -> Dict[str, int]:
+    """把舊版圖片搬進內容定址儲存區（相同內容合併為一份）並補產生縮圖 / 預覽圖"""
+    db = get_db()
+    stats = {"moved": 0, "missing": 0, "thumbs": 0}
+    rows = get_conn().execute("SELECT id, file_path FROM note_assets WHERE sha256 IS NULL").fetchall()
+    for aid, path in rows:
+        if not path or not os.path.exists(path):
+            stats["missing"] += 1
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        blob = _prepare_blob(data, os.path.splitext(path)[1].lower() or ".bin")
+        # 每張圖一個短交易，只做登錄與更新參照，不長時間佔住 writer
+        with db.write() as conn:
+            sha = blob["sha256"]; blob_ext = _register_blob(conn, blob)
+            conn.execute("UPDATE note_assets SET sha256=?, file_path=? WHERE id=?", (sha, _blob_paths(sha, blob_ext)["original"], aid))
+            _remove_legacy_files(conn, [path])
+        stats["moved"] += 1
+    for sha, ext in get_conn().execute("SELECT sha256, ext FROM media_blobs").fetchall():
+        paths = _blob_paths(sha, ext)
+        if os.path.exists(paths["original"]) and not (os.path.exists(paths["thumb"]) and os.path.exists(paths["preview"])):
+            _make_derivatives(paths["original"], paths)
+            stats["thumbs"] += 1
+    schedule_media_gc()
+    return stats
+
+# ---------- 側欄選單 ----------
+def load_meta():
+    """側欄選項直接讀 facets 表，成本只跟不重複值的數量有關"""
+    conn = get_conn()
+    opts: Dict[str, List[str]] = {d: [] for d in FACET_DIMS}
+    counts: Dict[str, Dict[str, int]] = {d: {} for d in FACET_DIMS}
+    for dim, value, n in conn.execute("SELECT dim, value, n FROM facets ORDER BY dim, value"):
+        if dim in opts:
+            opts[dim].append(value); counts[dim][value] = n
+    return {
+        "subjects": opts["subject"],
+        "years": opts["year"],
+        "types": opts["type"],
+        "topics": opts["topic"],
+        "subtopics": opts["subtopic"],
+        "counts": counts,
+    }
+
+def facet_counts(filters: dict, search: str, wrong_only: bool, min_wrong: int) -> Dict[str, Dict[str, int]]:
+    """每個維度的每個選項在「其他」篩選條件下會有幾題（同維度的已選值不互相限制）。
+    沒有其他條件時直接用 facets 表的總數。"""
+    conn = get_conn(); out = {}
+    for dim in FACET_DIMS:
+        others = {k: v for k, v in filters.items() if k != dim and v}
+        if not others and not search and not wrong_only and not min_wrong:
+            out[dim] = dict(conn.execute("SELECT value, n FROM facets WHERE dim=?", (dim,)).fetchall())
+            continue
+        sql, args, _ = _question_query_parts(others, search, wrong_only, min_wrong)
+        out[dim] = dict(conn.execute(f"SELECT TRIM(q.{dim}), COUNT(*) {sql} GROUP BY TRIM(q.{dim})", args).fetchall())
+    return out
+
+
+# ---------- 搜尋 / 分頁 ----------
+def _split_search_terms(search:str) -> List[str]:
+    """拆解搜尋字串：空白分隔為多個詞（需同時符合），以 "..." 或 “...” 包住視為片語"""
+    terms = []
+    for m in re.finditer(r'"([^"]*)"|“([^”]*)”|(\S+)', search or ""):
+        t = next(g for g in m.groups() if g is not None).strip()
+        if t:
+            terms.append(t)
+    return terms
+
+def _fts_phrase(term:str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+# 進度總覽等處的讀書狀態篩選；條件字面與 idx_q_wrong / idx_q_done / idx_q_star 的 WHERE 相同才會用到部分索引
+STATE_FILTERS = {"wrong": "q.wrong_count > 0", "done": "q.done > 0", "star": "q.star > 0"}
+
+def _question_query_parts(filters: dict, search: str, wrong_only: bool, min_wrong: int, state:str=""):
+    """組出題目查詢共用的 FROM/JOIN、WHERE 與排序。
+    搜尋詞 >= 3 字走 FTS5（以 bm25 相關度排序），較短的詞 trigram 無法索引，退回 LIKE。
+    讀書狀態直接讀 questions 上的副本，不 JOIN annotations；沒有搜尋時排序由 idx_q_order 等索引提供。"""
+    sql = "FROM questions q"
+    args: List = []
+    fts_terms, like_terms = [], []
+    for t in _split_search_terms(search):
+        (fts_terms if get_db().has_fts and len(t) >= 3 else like_terms).append(t)
+    if fts_terms:
+        sql += " JOIN (SELECT rowid AS fid, bm25(questions_fts) AS rank FROM questions_fts WHERE questions_fts MATCH ?) f ON f.fid = q.id"
+        args.append(" ".join(_fts_phrase(t) for t in fts_terms))
+    sql += " WHERE 1=1"
+    for key in ["subject","year","type","topic","subtopic"]:
+        vals = filters.get(key, [])
+        if vals:
+            holders = ",".join(["?"]*len(vals))
+            sql += f" AND q.{key} IN ({holders})"
+            args.extend(vals)
+    for t in like_terms:
+        sql += " AND (" + " OR ".join(f"q.{c} LIKE ?" for c in FTS_COLUMNS) + ")"
+        args.extend([f"%{t}%"]*len(FTS_COLUMNS))
+    if wrong_only:
+        sql += " AND " + STATE_FILTERS["wrong"]
+    if isinstance(min_wrong, int) and min_wrong > 0:
+        sql += " AND q.wrong_count >= ?"
+        args.append(int(min_wrong))
+    if state:
+        sql += " AND " + STATE_FILTERS[state]
+    # 排序鍵一律 DESC，keyset 分頁才能用單一 row value 比較；bm25 越小越相關，故取負值
+    keys = ["q.wrong_count", "COALESCE(q.updated_at,'')", "q.id"]
+    if fts_terms:
+        keys = ["-f.rank"] + keys
+    return sql, args, keys
+
+_QUESTION_COLS = "q.*"
+# 題目清單只取這些欄位；題幹 / 選項 / 詳解等長文字等到真的要顯示時才以 question_texts() 取回
+LIST_COLS = ["id","subject","source","year","type","topic","subtopic","wrong_count","done","star","updated_at"]
+TEXT_COLS = ["stem","options","answer","explanation","tags"]
+CATEGORY_COLS = ["subject","source","year","type","topic","subtopic"]
+
+def compact_frame(df:"pd.DataFrame") -> "pd.DataFrame":
+    """分類欄位轉成 category、讀書狀態轉成小整數：重複值多的欄位只存一份字串，快取佔用的記憶體小很多"""
+    for c in CATEGORY_COLS:
+        if c in df.columns:
+            df[c] = df[c].fillna("").astype(str).astype("category")
+    if "wrong_count" in df.columns:
+        df["wrong_count"] = df["wrong_count"].fillna(0).astype("int32")
+    for c in ("done", "star"):
+        if c in df.columns:
+            df[c] = df[c].fillna(0).astype("int8")
+    return df
+
+def query_questions(filters: dict, search: str, limit: int, wrong_only: bool, min_wrong: int, state:str="") -> "pd.DataFrame":
+    """題目清單（只有 LIST_COLS，型別已壓縮）"""
+    import pandas as pd
+    conn = get_conn()
+    sql, args, keys = _question_query_parts(filters, search, wrong_only, min_wrong, state)
+    order = ", ".join(f"{k} DESC" for k in keys)
+    q = f"SELECT {', '.join(f'q.{c}' for c in LIST_COLS)} {sql} ORDER BY {order} LIMIT ?"
+    return compact_frame(pd.read_sql_query(q, conn, params=args + [limit]))
+
+def question_texts(qids) -> Dict[int, Dict[str, str]]:
+    """一次取回多題的長文字欄位：{qid: {stem, options, answer, explanation, tags}}"""
+    conn = get_conn(); out: Dict[int, Dict[str, str]] = {}
+    for part in chunked([int(q) for q in qids]):
+        holders = ",".join(["?"]*len(part))
+        for row in conn.execute(f"SELECT id, {', '.join(TEXT_COLS)} FROM questions WHERE id IN ({holders})", part):
+            out[int(row[0])] = {c: v or "" for c, v in zip(TEXT_COLS, row[1:])}
+    return out
+
+def annotations_bulk(qids) -> Dict[int, Dict]:
+    """一次取回多題的註記：{qid: {ANN_FIELDS}}，沒有註記的題目不在結果中"""
+    conn = get_conn(); out: Dict[int, Dict] = {}
+    for part in chunked([int(q) for q in qids]):
+        holders = ",".join(["?"]*len(part))
+        for row in conn.execute(f"SELECT qid, {', '.join(ANN_FIELDS)} FROM annotations WHERE qid IN ({holders})", part):
+            out[int(row[0])] = dict(zip(ANN_FIELDS, row[1:]))
+    return out
+
+# ---------- 題目片段快取 ----------
+RENDER_LRU = 8192   # 記憶體中保留的題目數
+# 片段另存一份在 render_cache 表，重啟後不必重做；環境變數 EXAM_RENDER_CACHE=0 時只用記憶體
+RENDER_PERSIST = os.environ.get("EXAM_RENDER_CACHE", "1") != "0"
+RENDER_COLS = ["id","subject","year","type","topic","subtopic","updated_at"] + TEXT_COLS
+
+def _load_rendered(keys:List[tuple]) -> Dict[tuple, Dict[str, str]]:
+    """render_cache 中鍵完全相同（updated_at 與註記版本都對得上）的片段"""
+    conn = get_conn(); want = {k[0]: k for k in keys}; out = {}
+    for part in chunked(list(want)):
+        holders = ",".join(["?"]*len(part))
+        for qid, upd, ver, frags in conn.execute(f"SELECT qid, updated_at, ann_ver, html FROM render_cache WHERE qid IN ({holders})", part):
+            key = (int(qid), upd or "", ver)
+            if want.get(key[0]) == key:
+                out[key] = json.loads(frags)
+    return out
+
+def _store_rendered(items:List[tuple]):
+    # 交給 writer 佇列、不等待；產生片段期間被刪除的題目不寫入
+    rows = [(qid, upd, ver, json.dumps(frags, ensure_ascii=False), qid) for (qid, upd, ver), frags in items]
+    get_db().submit(lambda conn: conn.executemany(
+        "INSERT INTO render_cache (qid, updated_at, ann_ver, html) SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM questions WHERE id=?) "
+        "ON CONFLICT(qid) DO UPDATE SET updated_at=excluded.updated_at, ann_ver=excluded.ann_ver, html=excluded.html", rows))
+
+FRAGMENTS = FragmentCache(RENDER_LRU, *((_load_rendered, _store_rendered) if RENDER_PERSIST else ()))
+
+def render_fragments(rows:List[Dict], anns:Dict[int, Dict]=None, math:bool=False) -> Dict[int, Dict[str, str]]:
+    """題目片段 {qid: {header, stem, options, answer, explanation, tags}}。rows 需含 RENDER_COLS；
+    anns 沒給時一次查出這批題目的註記。math=True 時已轉換的算式換成 $LaTeX$（latex_cache 有變動就重做）"""
+    if anns is None:
+        anns = annotations_bulk([q["id"] for q in rows])
+    if not math:
+        return FRAGMENTS.get_many(rows, anns)
+    texts = [q.get(c) for q in rows for c in MATH_COLS]
+    latex = {h: tex for h, (_, tex, _) in formula_details(texts).items() if tex}
+    return FRAGMENTS.get_many(rows, anns, f"+m{data_version('latex_cache')[0]}",
+                              lambda t: exam_math.substitute(t, latex))
+
+def refresh_render_cache(qids:List[int]=None, batch:int=500) -> int:
+    """題目新增 / 修改後預先產生片段：qids 為指定題目；沒給時補做 render_cache 缺少或 updated_at 已過期的題目
+    （只用記憶體時不做全表補齊）。回傳處理題數"""
+    conn = get_conn(); cols = ", ".join(f"q.{c}" for c in RENDER_COLS); total = 0
+    if qids is not None:
+        for part in chunked([int(q) for q in qids], batch):
+            rows = conn.execute(f"SELECT {cols} FROM questions q WHERE q.id IN ({','.join(['?']*len(part))})", part).fetchall()
+            render_fragments([dict(zip(RENDER_COLS, r)) for r in rows]); total += len(rows)
+        return total
+    if not RENDER_PERSIST:
+        return 0
+    last = 0
+    while True:
+        rows = conn.execute(f"""SELECT {cols} FROM questions q LEFT JOIN render_cache r ON r.qid = q.id
+                                WHERE q.id > ? AND (r.qid IS NULL OR r.updated_at IS NOT COALESCE(q.updated_at, ''))
+                                ORDER BY q.id LIMIT ?""", (last, batch)).fetchall()
+        if not rows: return total
+        render_fragments([dict(zip(RENDER_COLS, r)) for r in rows])
+        last = rows[-1][0]; total += len(rows)
+
+# ---------- 算式排版 ----------
+# 預設關閉；環境變數 EXAM_MATH=1 時預設開啟，並在修改題目後立即轉換該題的算式
+MATH_DEFAULT = os.environ.get("EXAM_MATH", "0") == "1"
+MATH_COLS = ["stem","options","explanation"]
+
+def pending_formulas(qids:List[int]=None, batch:int=2000) -> List[str]:
+    """題目中尚未轉換過（latex_cache 沒有）的算式；qids 沒給時掃整個題庫"""
+    conn = get_conn(); cols = ", ".join(MATH_COLS); found: Dict[str, str] = {}
+    def scan(rows):
+        for r in rows:
+            for t in r[1:]:
+                for e in exam_math.find_formulas(t or ""):
+                    found.setdefault(exam_math.expr_hash(e), e)
+    if qids is not None:
+        for part in chunked([int(q) for q in qids]):
+            scan(conn.execute(f"SELECT id, {cols} FROM questions WHERE id IN ({','.join(['?']*len(part))})", part))
+    else:
+        last = 0
+        while True:
+            rows = conn.execute(f"SELECT id, {cols} FROM questions WHERE id > ? ORDER BY id LIMIT ?", (last, batch)).fetchall()
+            if not rows: break
+            scan(rows); last = rows[-1][0]
+    known = set()
+    for part in chunked(list(found)):
+        known.update(h for (h,) in conn.execute(f"SELECT hash FROM latex_cache WHERE hash IN ({','.join(['?']*len(part))})", part))
+    return [e for h, e in found.items() if h not in known]
+
+def store_formulas(conn, exprs:List[str], results:List[tuple]):
+    """寫入轉換結果（results 與 exprs 一一對應，為 exam_math.to_latex 的回傳值）；需在寫入交易內呼叫"""
+    now = datetime.now().isoformat(timespec='seconds')
+    conn.executemany("INSERT OR REPLACE INTO latex_cache (hash, expr, latex, simplified, created_at) VALUES (?,?,?,?,?)",
+                     [(exam_math.expr_hash(e), e, tex, simple, now) for e, (tex, simple) in zip(exprs, results)])
+
+def convert_formulas(exprs:List[str]) -> int:
+    """在目前行程內轉換少量算式（修改單題時用）；整個題庫請交給背景工作 math"""
+    if not exprs: return 0
+    results = [exam_math.to_latex(e) for e in exprs]
+    with get_db().write() as conn:
+        store_formulas(conn, exprs, results)
+    return len(exprs)
+
+def formula_details(texts:List[str]) -> Dict[str, tuple]:
+    """texts 中出現、且已轉換過的算式：{hash: (原式, LaTeX, 化簡後 LaTeX)}"""
+    hashes = {exam_math.expr_hash(e) for t in texts if isinstance(t, str) for e in exam_math.find_formulas(t)}
+    conn = get_conn(); out = {}
+    for part in chunked(list(hashes)):
+        for h, e, tex, simple in conn.execute(f"SELECT hash, expr, latex, simplified FROM latex_cache WHERE hash IN ({','.join(['?']*len(part))})", part):
+            out[h] = (e, tex, simple)
+    return out
+
+def count_questions(filters: dict, search: str, wrong_only: bool, min_wrong: int, state:str="") -> int:
+    conn = get_conn()
+    sql, args, _ = _question_query_parts(filters, search, wrong_only, min_wrong, state)
+    return int(conn.execute(f"SELECT COUNT(*) {sql}", args).fetchone()[0])
+
+def query_page(filters: dict, search: str, wrong_only: bool, min_wrong: int, page_size:int, after:tuple=None, state:str=""):
+    """取一頁題目（keyset 分頁）：after 為上一頁最後一列的排序鍵，回傳 (該頁 DataFrame, 本頁最後一列的排序鍵)。
+    每頁成本固定，不受頁碼深淺影響。"""
+    import pandas as pd
+    conn = get_conn()
+    sql, args, keys = _question_query_parts(filters, search, wrong_only, min_wrong, state)
+    if after is not None:
+        sql += f" AND ({', '.join(keys)}) < ({', '.join(['?']*len(keys))})"
+        args = args + list(after)
+    key_cols = ", ".join(f"{k} AS _k{i}" for i, k in enumerate(keys))
+    order = ", ".join(f"{k} DESC" for k in keys)
+    page = pd.read_sql_query(f"SELECT {_QUESTION_COLS}, {key_cols} {sql} ORDER BY {order} LIMIT ?", conn, params=args + [page_size])
+    key_names = [f"_k{i}" for i in range(len(keys))]
+    # to_dict 會把 numpy 純量轉回 Python 型別（np.int64 綁定參數時會被當成 BLOB）
+    last = tuple(page[key_names].iloc[-1:].to_dict("records")[0].values()) if not page.empty else None
+    return page.drop(columns=key_names), last
+
+def page_anchor(filters: dict, search: str, wrong_only: bool, min_wrong: int, offset:int, state:str=""):
+    """直接跳頁時，找出第 offset 列（0 起算）的排序鍵當作 keyset 起點；只取排序鍵欄位"""
+    conn = get_conn()
+    sql, args, keys = _question_query_parts(filters, search, wrong_only, min_wrong, state)
+    order = ", ".join(f"{k} DESC" for k in keys)
+    row = conn.execute(f"SELECT {', '.join(keys)} {sql} ORDER BY {order} LIMIT 1 OFFSET ?", args + [offset]).fetchone()
+    return tuple(row) if row else None
+
+# ---------- 進度總覽 ----------
+def study_summary(group_by:str, filters: dict, search: str, wrong_only: bool, min_wrong: int) -> "pd.DataFrame":
+    """依 group_by（FACET_DIMS 之一）分組的題數、已做過 / 做錯過 / 加星題數與完成率，涵蓋整個篩選結果（不受查詢上限影響）。
+    只有維度篩選時讀 study_rollup，成本只跟組合數有關；有搜尋或錯誤次數條件時改在 questions 上直接 GROUP BY"""
+    import pandas as pd
+    if group_by not in FACET_DIMS:
+        raise ValueError(f"無法依 {group_by} 分組")
+    conn = get_conn()
+    if not search and not wrong_only and not min_wrong:
+        where, args = [], []
+        for d in FACET_DIMS:
+            vals = filters.get(d) or []
+            if vals:
+                where.append(f"{d} IN ({','.join(['?']*len(vals))})")
+                args.extend(vals)
+        sql = (f"SELECT {group_by}, {', '.join(f'SUM({m})' for m in ROLLUP_MEASURES)} FROM study_rollup"
+               + (f" WHERE {' AND '.join(where)}" if where else "") + f" GROUP BY {group_by}")
+    else:
+        part, args, _ = _question_query_parts(filters, search, wrong_only, min_wrong)
+        sql = (f"SELECT COALESCE(q.{group_by}, ''), COUNT(*), SUM(q.done > 0), SUM(q.wrong_count > 0), SUM(q.wrong_count), SUM(q.star > 0) "
+               f"{part} GROUP BY 1")
+    out = pd.DataFrame(conn.execute(sql, args).fetchall(), columns=["value"] + ROLLUP_MEASURES)
+    out = out[out["total"] > 0].sort_values(["total", "value"], ascending=[False, True], ignore_index=True)
+    out["done_ratio"] = out["done"] / out["total"]
+    out["wrong_ratio"] = out["wrong"] / out["total"]
+    return out
+
+# ---------- 模擬考 ----------
+def mock_pool(filters: dict, search: str, wrong_only: bool, min_wrong: int, strata:str="") -> Dict[str, "np.ndarray"]:
+    """抽題用的題庫快照：符合篩選＋搜尋條件的 id、錯誤次數、加星、距上次註記的天數（沒註記過為 NaN）
+    與分層鍵（strata 為 FACET_DIMS 之一，空字串表示不分層），全部是等長的 numpy 陣列，不讀題幹等長文字"""
+    import numpy as np
+    if strata and strata not in FACET_DIMS:
+        raise ValueError(f"無法依 {strata} 分層")
+    sql, args, _ = _question_query_parts(filters, search, wrong_only, min_wrong)
+    key = f"COALESCE(q.{strata}, '')" if strata else "''"
+    rows = get_conn().execute(f"SELECT q.id, q.wrong_count, q.star, "
+                              f"julianday('now', 'localtime') - julianday((SELECT a.last_updated FROM annotations a WHERE a.qid = q.id)), "
+                              f"{key} {sql} ORDER BY q.id", args).fetchall()
+    ids, wrong, star, age, keys = zip(*rows) if rows else ((), (), (), (), ())
+    return {"id": np.array(ids, dtype=np.int64), "wrong_count": np.array(wrong, dtype=np.float64),
+            "star": np.array(star, dtype=np.float64), "age_days": np.array(age, dtype=np.float64),
+            "stratum": np.array(keys, dtype=object)}
+
+def questions_by_ids(qids:List[int]) -> "pd.DataFrame":
+    """依給定順序取回多題完整資料（一次查詢；超過參數上限才分段）"""
+    import pandas as pd
+    qids = [int(q) for q in qids]
+    parts = [pd.read_sql_query(f"SELECT {_QUESTION_COLS} FROM questions q WHERE q.id IN ({','.join(['?']*len(part))})",
+                               get_conn(), params=part) for part in chunked(qids)]
+    df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=["id"])
+    # 抽題後才被刪除的題目直接略過
+    present = set(df["id"].tolist())
+    return df.set_index("id", drop=False).loc[[q for q in qids if q in present]].reset_index(drop=True)
+
+# ---------- 刪除 / 去重 ----------
+# 大量刪除：要刪的 id 先放進暫存表 temp._del_ids，各表再以子查詢對它刪除，
+# 不組 IN (?,?,…) 長清單（不受 SQLite 參數上限影響）；整批在同一個寫入交易內完成
+def _stage_ids(conn, table:str):
+    """建立（或清空）寫入連線上的 id 暫存表"""
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY)")
+    conn.execute(f"DELETE FROM temp.{table}")
+
+def _delete_staged(conn) -> int:
+    """刪除 temp._del_ids 中的題目與其筆記、註記、圖片參照，回傳刪除題數。
+    不再被引用的圖片只登記到 media_gc，檔案由背景執行緒移除，不卡住呼叫端"""
+    staged = "SELECT id FROM temp._del_ids"
+    cur = conn.cursor()
+    assets = cur.execute(f"SELECT DISTINCT file_path, sha256 FROM note_assets WHERE qid IN ({staged})").fetchall()
+    cur.execute(f"DELETE FROM note_assets WHERE qid IN ({staged})")
+    cur.execute(f"DELETE FROM notes WHERE qid IN ({staged})")
+    n = cur.execute(f"DELETE FROM questions WHERE id IN ({staged})").rowcount
+    # 題目先刪，annotations 的 trigger 就不必回寫即將刪除的題目
+    cur.execute(f"DELETE FROM annotations WHERE qid IN ({staged})")
+    _release_blobs(conn, [sha for _, sha in assets])
+    _remove_legacy_files(conn, [path for path, sha in assets if not sha])
+    cur.execute("DELETE FROM temp._del_ids")
+    return n
+
+def delete_ids(qids:List[int]) -> int:
+    if not qids: return 0
+    with get_db().write() as conn:
+        _stage_ids(conn, "_del_ids")
+        conn.executemany("INSERT OR IGNORE INTO temp._del_ids (id) VALUES (?)", ((int(q),) for q in qids))
+        n = _delete_staged(conn)
+    schedule_media_gc()
+    return n
+
+def delete_where(filters: dict, search: str, wrong_only: bool, min_wrong: int) -> int:
+    """刪除符合篩選＋搜尋條件的全部題目（與 count_questions 同一組條件）；id 直接在 SQL 內選出，不經過 Python"""
+    sql, args, _ = _question_query_parts(filters, search, wrong_only, min_wrong)
+    with get_db().write() as conn:
+        _stage_ids(conn, "_del_ids")
+        conn.execute(f"INSERT OR IGNORE INTO temp._del_ids (id) SELECT q.id {sql}", args)
+        n = _delete_staged(conn)
+    schedule_media_gc()
+    return n
+
+def _detach_media_dir():
+    """把 media 目錄改名移開並建立空目錄（同一檔案系統內改名幾乎不花時間）；回傳待刪除的舊目錄"""
+    trash = f"{MEDIA_DIR}.trash-{time.time_ns()}"
+    try:
+        os.replace(MEDIA_DIR, trash)
+    except FileNotFoundError:
+        trash = None
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+    return trash
+
+def clear_all(which:str):
+    """清除是本機的重設，不同步到其他裝置：清除產生的墓碑直接丟掉，並讓各裝置下次送來完整資料"""
+    trash = None
+    with get_db().write() as conn:
+        cur = conn.cursor()
+        before = cur.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        if which == "all":
+            trash = _detach_media_dir()
+            for tbl in ["note_assets","media_blobs","media_gc","notes","annotations","stem_minhash","render_cache","questions"]:
+                cur.execute(f"DELETE FROM {tbl};")
+        elif which == "notes_only":
+            trash = _detach_media_dir()
+            cur.execute("DELETE FROM note_assets;")
+            cur.execute("DELETE FROM media_blobs;")
+            cur.execute("DELETE FROM media_gc;")
+            cur.execute("DELETE FROM notes;")
+        elif which == "ann_only":
+            cur.execute("DELETE FROM annotations;")
+        cur.execute("DELETE FROM changes WHERE seq > ? AND op = 'd'", (before,))
+        cur.execute("UPDATE sync_peers SET received = 0")
+        cur.execute("UPDATE sync_state SET value = CAST(value AS INTEGER) + 1 WHERE key = 'epoch'")
+    # 刪除整個舊目錄放在交易之外，不佔住 writer
+    if trash:
+        shutil.rmtree(trash, ignore_errors=True)
+
+
+def find_duplicate_ids_to_delete() -> list:
+    """回傳應刪除的重複題 id（以相同 stem 為重複，保留每組最小 id）"""
+    conn = get_conn()
+    rows = conn.execute("SELECT id FROM questions WHERE id NOT IN (SELECT MIN(id) FROM questions GROUP BY stem)").fetchall()
+    return [int(r[0]) for r in rows]
+
+# ---------- 批次註記 ----------
+# op -> (欄位, 新列的值, 既有列的更新運算式)；? 代入呼叫端給的 value
+BULK_OPS = {
+    "done":        ("done", "?", "?"),
+    "star":        ("star", "?", "?"),
+    "star_toggle": ("star", "1", "1 - COALESCE(annotations.star, 0)"),
+    "wrong_inc":   ("wrong_count", "?", "COALESCE(annotations.wrong_count, 0) + ?"),
+    "wrong_reset": ("wrong_count", "0", "0"),
+    "color":       ("color", "?", "?"),
+    "keywords":    ("highlight_keywords", "?", "?"),
+}
+
+def bulk_annotate(op:str, value=None, qids:List[int]=None, scope:Dict=None) -> int:
+    """對多題套用同一個註記動作，回傳寫入的題數。對象為 qids，或 scope（{filters, search, wrong_only, min_wrong}，
+    與匯出相同）符合的全部題目。id 先放進暫存表，再以一條 INSERT … SELECT … ON CONFLICT DO UPDATE 完成，
+    整批一個交易；讀書狀態副本由 annotations 的 trigger 同步"""
+    col, ins, upd = BULK_OPS[op]
+    with get_db().write() as conn:
+        _stage_ids(conn, "_bulk_ids")
+        if scope is None:
+            conn.executemany("INSERT OR IGNORE INTO temp._bulk_ids (id) VALUES (?)", ((int(q),) for q in qids or []))
+        else:
+            sql, args, _ = _question_query_parts(scope["filters"], scope["search"], scope["wrong_only"], scope["min_wrong"])
+            conn.execute(f"INSERT OR IGNORE INTO temp._bulk_ids (id) SELECT q.id {sql}", args)
+        now = datetime.now().isoformat(timespec='seconds')
+        # WHERE true：讓 SQLite 不把 ON CONFLICT 誤認為 JOIN 的一部分
+        n = conn.execute(f"""
+            INSERT INTO annotations (qid, {col}, last_updated)
+            SELECT b.id, {ins}, ? FROM temp._bulk_ids b JOIN questions q ON q.id = b.id WHERE true
+            ON CONFLICT(qid) DO UPDATE SET {col} = {upd}, last_updated = excluded.last_updated""",
+            [value] * ins.count("?") + [now] + [value] * upd.count("?")).rowcount
+        conn.execute("DELETE FROM temp._bulk_ids")
+    return n
+
+# ---------- 近似重複題（MinHash / LSH） ----------
+MINHASH_PERM = 64      # 簽章長度
+LSH_BANDS = 16         # 16 段 × 每段 4 個值：相似度 0.5 起開始成為候選，0.8 以上幾乎一定被找到
+SHINGLE_K = 3          # 以 3 個字元為一組
+LSH_MAX_BUCKET = 200   # 超過此題數的桶只跟桶內第一題比對，避免兩兩配對爆量
+
+_OPTION_PREFIX_RE = re.compile(r"^\s*(?:[\(\[【]\s*)?(?:[A-Za-z]|\d{1,3})\s*[\)\]】.、:]\s*")
+_TAG_RE = re.compile(r"<[^>]+>")
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+def near_dup_text(stem:str) -> str:
+    """比對用的題幹：全半形統一、去 HTML、去開頭的題號 / 選項字母，再去掉所有標點與空白"""
+    t = html.unescape(_TAG_RE.sub(" ", unicodedata.normalize("NFKC", stem or "")))
+    t = _OPTION_PREFIX_RE.sub("", t)
+    return _NON_WORD_RE.sub("", t).lower()
+
+def _mh_coeffs(tag:str) -> "np.ndarray":
+    import numpy as np
+    # 係數由固定字串雜湊而來，不受 numpy 亂數實作影響，存在資料庫的簽章才能一直沿用
+    return np.array([int.from_bytes(hashlib.blake2b(f"{tag}{i}".encode(), digest_size=8).digest(), "little")
+                     for i in range(MINHASH_PERM)], dtype=np.uint64)
+
+@functools.lru_cache(maxsize=1)
+def _mh_params():
+    import numpy as np
+    return _mh_coeffs("a") | np.uint64(1), _mh_coeffs("b")
+
+def minhash_signatures(texts:List[str]) -> List:
+    """一批文字的字元 shingle MinHash 簽章（uint32 × MINHASH_PERM）；空字串為 None。整批一次向量化計算"""
+    import numpy as np
+    mh_a, mh_b = _mh_params()
+    grams = [{t[i:i+SHINGLE_K] for i in range(max(1, len(t) - SHINGLE_K + 1))} if t else set() for t in texts]
+    sizes = np.fromiter((len(g) for g in grams), dtype=np.int64, count=len(grams))
+    out = [None] * len(texts)
+    if not sizes.sum(): return out
+    x = np.fromiter((zlib.crc32(k.encode("utf-8")) for g in grams for k in g), dtype=np.uint64, count=int(sizes.sum()))
+    # a*x+b（mod 2^64）取高 32 位元當作一個雜湊函數，再逐題取最小值
+    h = (mh_a[:, None] * x[None, :] + mh_b[:, None]) >> np.uint64(32)
+    nonempty = np.flatnonzero(sizes)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))[nonempty]
+    mins = np.minimum.reduceat(h, starts, axis=1).astype("<u4")
+    for col, i in enumerate(nonempty):
+        out[i] = np.ascontiguousarray(mins[:, col])
+    return out
+
+def refresh_minhash(batch:int=1000) -> int:
+    """補算缺少簽章的題目（新匯入、題幹被修改）；回傳處理題數"""
+    conn = get_conn(); last = 0; total = 0
+    while True:
+        rows = conn.execute("""SELECT q.id, q.stem FROM questions q LEFT JOIN stem_minhash m ON m.qid = q.id
+                               WHERE q.id > ? AND m.qid IS NULL ORDER BY q.id LIMIT ?""", (last, batch)).fetchall()
+        if not rows: return total
+        sigs = minhash_signatures([near_dup_text(stem) for _, stem in rows])
+        # 計算期間題目可能已被刪除，只寫入仍存在的題目
+        with get_db().write() as w:
+            w.executemany("INSERT OR REPLACE INTO stem_minhash (qid, sig) SELECT ?, ? WHERE EXISTS (SELECT 1 FROM questions WHERE id=?)",
+                          [(qid, None if sig is None else sig.tobytes(), qid) for (qid, _), sig in zip(rows, sigs)])
+        last = rows[-1][0]; total += len(rows)
+
+def find_near_duplicates(threshold:float, max_bucket:int=LSH_MAX_BUCKET) -> List[List[tuple]]:
+    """近似重複群組：[[(qid, 與群組第一題的相似度), ...], ...]；群組第一題為最小 id，大群組排前面"""
+    import numpy as np
+    qids, blobs = [], []
+    for qid, sig in get_conn().execute("SELECT qid, sig FROM stem_minhash WHERE sig IS NOT NULL ORDER BY qid"):
+        qids.append(int(qid)); blobs.append(sig)
+    if len(qids) < 2: return []
+    sigs = np.frombuffer(b"".join(blobs), dtype="<u4").reshape(-1, MINHASH_PERM)
+    # LSH：簽章切成 LSH_BANDS 段，任一段完全相同的兩題才成為候選（排序後相鄰相同者為一桶）
+    rows = MINHASH_PERM // LSH_BANDS
+    pairs = set()
+    for b in range(LSH_BANDS):
+        band = sigs[:, b*rows:(b+1)*rows]
+        order = np.lexsort(band.T[::-1])
+        diff = np.any(band[order[1:]] != band[order[:-1]], axis=1)
+        bounds = np.concatenate(([0], np.flatnonzero(diff) + 1, [len(order)]))
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            if hi - lo < 2: continue
+            members = np.sort(order[lo:hi]).tolist()
+            if len(members) > max_bucket:
+                pairs.update((members[0], j) for j in members[1:])
+            else:
+                pairs.update(itertools.combinations(members, 2))
+    if not pairs: return []
+    # 以簽章相同位置的比例估計 Jaccard 相似度，過門檻的配對再以 union-find 串成群組
+    pa, pb = np.array(list(pairs)).T
+    keep = np.count_nonzero(sigs[pa] == sigs[pb], axis=1) >= threshold * MINHASH_PERM
+    parent: Dict[int, int] = {}
+    def find(x):
+        root = x
+        while parent.get(root, root) != root: root = parent[root]
+        parent[x] = root
+        return root
+    for a, b in zip(pa[keep].tolist(), pb[keep].tolist()):
+        ra, rb = find(a), find(b)
+        if ra != rb: parent[max(ra, rb)] = min(ra, rb)
+    groups: Dict[int, List[int]] = {}
+    for x in list(parent):
+        groups.setdefault(find(x), []).append(x)
+    clusters = []
+    for members in groups.values():
+        if len(members) < 2: continue
+        members.sort()
+        sims = np.count_nonzero(sigs[members] == sigs[members[0]], axis=1) / MINHASH_PERM
+        clusters.append([(qids[i], float(sim)) for i, sim in zip(members, sims)])
+    clusters.sort(key=lambda c: (-len(c), c[0][0]))
+    return clusters
+
+def merge_duplicates(keep_id:int, drop_ids:List[int]) -> int:
+    """把 drop_ids 的筆記、圖片、註記併入 keep_id，再刪除這些題目；回傳刪除題數"""
+    drop_ids = [int(i) for i in drop_ids if int(i) != keep_id]
+    if not drop_ids: return 0
+    ids = [keep_id] + drop_ids
+    holders = ",".join(["?"]*len(ids))
+    now = datetime.now().isoformat(timespec='seconds')
+    with get_db().write() as conn:
+        # 註記：錯誤次數相加、已完成 / 星號取最大、螢光筆關鍵字聯集，顏色等取第一個有設定的值
+        rows = {r[0]: dict(zip(["qid"] + ANN_FIELDS, r)) for r in conn.execute(
+            f"SELECT qid, {', '.join(ANN_FIELDS)} FROM annotations WHERE qid IN ({holders})", ids)}
+        anns = [rows[i] for i in ids if i in rows]
+        if anns:
+            kws = []
+            for a in anns:
+                for k in re.split(r"[,，]", a["highlight_keywords"] or ""):
+                    if k.strip() and k.strip() not in kws: kws.append(k.strip())
+            first = lambda f: next((a[f] for a in anns if a[f]), ANN_DEFAULTS[f])
+            merged = {"color": first("color"), "highlight_keywords": ",".join(kws),
+                      "hl_bg": first("hl_bg"), "hl_fg": first("hl_fg"),
+                      "wrong_count": sum(int(a["wrong_count"] or 0) for a in anns),
+                      "done": max(int(a["done"] or 0) for a in anns), "star": max(int(a["star"] or 0) for a in anns)}
+            conn.execute(f"INSERT INTO annotations (qid, {', '.join(merged)}, last_updated) VALUES (?, {', '.join(['?']*len(merged))}, ?) "
+                         f"ON CONFLICT(qid) DO UPDATE SET {', '.join(f'{c}=excluded.{c}' for c in merged)}, last_updated=excluded.last_updated",
+                         [keep_id, *merged.values(), now])
+        # 筆記：依 id 順序接在一起
+        notes = dict(conn.execute(f"SELECT qid, note FROM notes WHERE qid IN ({holders})", ids).fetchall())
+        texts = []
+        for i in ids:
+            t = (notes.get(i) or "").strip()
+            if t and t not in texts: texts.append(t)
+        if len(texts) > 1 or (texts and keep_id not in notes):
+            conn.execute("INSERT INTO notes (qid, note, created_at, updated_at) VALUES (?,?,?,?) "
+                         "ON CONFLICT(qid) DO UPDATE SET note=excluded.note, updated_at=excluded.updated_at",
+                         (keep_id, "\n\n---\n\n".join(texts), now, now))
+        # 圖片改掛到保留題，刪除時就不會被一併移除
+        conn.execute(f"UPDATE note_assets SET qid=? WHERE qid IN ({','.join(['?']*len(drop_ids))})", [keep_id, *drop_ids])
+        delete_ids(drop_ids)
+    return len(drop_ids)
+
+def question_briefs(qids) -> Dict[int, tuple]:
+    """去重清單用的摘要：{qid: (科目, 年度, 來源, 純文字題幹)}"""
+    conn = get_conn(); out: Dict[int, tuple] = {}
+    for part in chunked(list(qids)):
+        holders = ",".join(["?"]*len(part))
+        for qid, subj, year, src, stem in conn.execute(f"SELECT id, subject, year, source, stem FROM questions WHERE id IN ({holders})", part):
+            out[int(qid)] = (subj or "", year or "", src or "", html.unescape(_TAG_RE.sub("", stem or "")))
+    return out
+
+# ---------- export（串流匯出） ----------
+EXPORT_DIR = "exports"
+EXPORT_CHUNK = 2000
+EXPORT_COLS = ["q.id"] + [f"q.{c}" for c in QUESTION_FIELDS] + ["q.created_at", "q.updated_at"] + [f"q.{c}" for c in STUDY_STATE]
+
+def _export_cursor(conn, scope:Dict):
+    """scope 為 None 表示整個題庫，否則為 {filters, search, wrong_only, min_wrong}；回傳已執行的 cursor"""
+    if scope is None:
+        sql, args, order = "FROM questions q", [], "q.id"
+    else:
+        sql, args, keys = _question_query_parts(scope["filters"], scope["search"], scope["wrong_only"], scope["min_wrong"])
+        order = ", ".join(f"{k} DESC" for k in keys)
+    return conn.execute(f"SELECT {', '.join(EXPORT_COLS)} {sql} ORDER BY {order}", args)
+
+def _iter_chunks(cur, size:int=EXPORT_CHUNK):
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows: break
+        yield rows
+
+def _write_csv_stream(fh, cur) -> int:
+    w = csv.writer(fh)
+    w.writerow([d[0] for d in cur.description])
+    n = 0
+    for rows in _iter_chunks(cur):
+        w.writerows(rows); n += len(rows)
+    return n
+
+def _new_export_path(ext:str) -> str:
+    """匯出檔放在 exports/，順手清掉一天以前的舊檔"""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    for name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, name)
+        try:
+            if time.time() - os.path.getmtime(path) > 86400: os.remove(path)
+        except Exception:
+            pass
+    return os.path.join(EXPORT_DIR, f"exam_export_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{ext}")
+
+def export_csv(scope:Dict=None):
+    """逐批讀出寫入 CSV（UTF-8-SIG，Excel 可直接開）；回傳 (路徑, 題數)"""
+    path = _new_export_path(".csv")
+    with open(path, "w", encoding="utf-8-sig", newline="") as fh:
+        n = _write_csv_stream(fh, _export_cursor(get_conn(), scope))
+    return path, n
+
+def export_xlsx(scope:Dict=None):
+    """以 openpyxl write-only 模式逐列寫入，不在記憶體中建整張工作表；回傳 (路徑, 題數)"""
+    from openpyxl import Workbook
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("questions")
+    cur = _export_cursor(get_conn(), scope)
+    ws.append([d[0] for d in cur.description])
+    n = 0
+    for rows in _iter_chunks(cur):
+        for row in rows:
+            # Excel 不接受控制字元，單格上限 32767 字
+            ws.append([ILLEGAL_CHARACTERS_RE.sub("", v)[:32767] if isinstance(v, str) else v for v in row])
+        n += len(rows)
+    path = _new_export_path(".xlsx")
+    wb.save(path)
+    return path, n
+
+def export_bundle(scope:Dict=None):
+    """完整備份 ZIP：questions / notes / annotations / note_assets 四個 CSV，加上引用到的 media 檔。
+    其餘資料表以同一組篩選條件的子查詢限定範圍；每個 CSV 都直接串流寫進壓縮檔。回傳 (路徑, 題數)"""
+    conn = get_conn()
+    if scope is None:
+        in_scope, scope_args = "", []
+    else:
+        sql, scope_args, _ = _question_query_parts(scope["filters"], scope["search"], scope["wrong_only"], scope["min_wrong"])
+        in_scope = f" WHERE t.qid IN (SELECT q.id {sql})"
+    cur = _export_cursor(conn, scope)
+    path = _new_export_path(".zip")
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        with zf.open("questions.csv", "w") as raw, io.TextIOWrapper(raw, encoding="utf-8-sig", newline="") as fh:
+            w = csv.writer(fh)
+            w.writerow([d[0] for d in cur.description])
+            n = 0
+            for rows in _iter_chunks(cur):
+                w.writerows(rows); n += len(rows)
+        for name, sql in [
+            ("notes.csv",       f"SELECT t.qid, t.note, t.created_at, t.updated_at FROM notes t{in_scope} ORDER BY t.qid"),
+            ("annotations.csv", f"SELECT t.* FROM annotations t{in_scope} ORDER BY t.qid"),
+            ("note_assets.csv", f"SELECT t.qid, t.file_path, t.caption, t.created_at, t.sha256 FROM note_assets t{in_scope} ORDER BY t.id"),
+        ]:
+            with zf.open(name, "w") as raw, io.TextIOWrapper(raw, encoding="utf-8-sig", newline="") as fh:
+                _write_csv_stream(fh, conn.execute(sql, scope_args))
+        media = conn.execute(f"SELECT DISTINCT t.file_path FROM note_assets t{in_scope}", scope_args)
+        for rows in _iter_chunks(media):
+            for (fp,) in rows:
+                if fp and os.path.exists(fp):
+                    zf.write(fp, arcname=os.path.relpath(fp).replace(os.sep, "/"))
+    return path, n
@@ -35,25 +35,30 @@ def check_password():
 
 check_password()
 
-import os, math, shutil, sqlite3
+import os, sys, math, time, random
 from datetime import datetime
 from typing import List, Dict
 
 import pandas as pd
 import streamlit as st
 
-def _safe_add_column(conn, table:str, col:str, decl:str):
-    try:
-        info = pd.read_sql_query(f"PRAGMA table_info({table})", conn)
-        if col not in info["name"].tolist():
-            conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl};")
-            conn.commit()
-    except Exception:
-        pass
-
-
-DB_PATH = "exam_handy.db"
-MEDIA_DIR = "media"
+from exam_db import (
+    get_db, get_conn, data_version, FACET_DIMS, ANN_FIELDS, ANN_DEFAULTS,
+    add_questions, update_question_row,
+    notes_bulk, save_note, images_bulk, add_image, delete_image, media_variant,
+    load_meta, facet_counts, query_questions, count_questions, query_page, page_anchor, study_summary, mock_pool, questions_by_ids, question_texts, render_fragments, FRAGMENTS,
+    MATH_DEFAULT, MATH_COLS, formula_details,
+    delete_ids, delete_where, bulk_annotate,
+    refresh_minhash, find_near_duplicates, merge_duplicates, question_briefs,
+)
+from exam_jobs import (
+    ACTIVE as JOB_ACTIVE, RESUMABLE as JOB_RESUMABLE, submit as submit_job, cancel as cancel_job, resume as resume_job,
+    list_jobs, get_job, has_active_jobs, save_upload,
+)
+from exam_render import LRU
+import exam_sync
+from exam_mock import STALE_DAYS, build_sampler, allocate, draw
+from exam_profile import start_run, stop as stop_profiling, section, note_cache_miss, jsonl as profile_jsonl
 
 st.set_page_config(page_title="考古題 Handy Plus v2.0", layout="wide")
 st.title("**考題整理**")
@@ -64,329 +69,327 @@ span[style*="background"]{ padding:0 2px; border-radius:2px; }
 </style>
 """, unsafe_allow_html=True)
 
+# ---------- 效能剖析（選用）----------
+# 在「🛠 維護工具」開啟（或以環境變數 EXAM_PROFILE=1 預設開啟）。每次重跑記錄一份 Run，
+# 跑完（或被下一次重跑打斷）後移到 _prof_runs，維護工具裡顯示上一次重跑的瀑布圖與 SQL 記錄。
+PROFILE_KEEP = 20
+st.session_state.setdefault("profile_on", os.environ.get("EXAM_PROFILE") == "1")
+# 算式排版：已由背景工作轉成 LaTeX 的算式以 $…$ 顯示（環境變數 EXAM_MATH=1 時預設開啟）
+st.session_state.setdefault("math_on", MATH_DEFAULT)
+_prev_run = st.session_state.pop("_prof_run", None)
+if _prev_run is not None:
+    st.session_state.setdefault("_prof_runs", []).append(_prev_run.finish())
+    del st.session_state["_prof_runs"][:-PROFILE_KEEP]
+if st.session_state["profile_on"]:
+    st.session_state["_prof_run"] = start_run(f"rerun {len(st.session_state.get('_prof_runs', [])) + 1}")
+else:
+    stop_profiling()
+
 # ---------- DB ----------
-@st.cache_resource
-def get_conn():
-    os.makedirs(MEDIA_DIR, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA synchronous=NORMAL;")
-    conn.execute("PRAGMA temp_store=MEMORY;")
-    conn.execute("PRAGMA cache_size=100000;")
-    return conn
-
-def init_or_upgrade_db():
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS questions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        subject TEXT, source TEXT, year TEXT, type TEXT,
-        topic TEXT, subtopic TEXT,
-        stem TEXT, options TEXT, answer TEXT,
-        explanation TEXT, tags TEXT,
-        created_at TEXT, updated_at TEXT
-    );""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS notes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        qid INTEGER UNIQUE,
-        note TEXT,
-        created_at TEXT, updated_at TEXT
-    );""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS note_assets (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        qid INTEGER, file_path TEXT, caption TEXT, created_at TEXT
-    );""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS annotations (
-        qid INTEGER PRIMARY KEY,
-        color TEXT DEFAULT '',
-        highlight_keywords TEXT DEFAULT '',
-        hl_bg TEXT DEFAULT '#ffff66',
-        hl_fg TEXT DEFAULT '#000000',
-        wrong_count INTEGER DEFAULT 0,
-        last_updated TEXT
-    );""")
-    # 索引
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_q_subject ON questions(subject)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_q_year    ON questions(year)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_q_type    ON questions(type)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_q_topic   ON questions(topic)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_img_qid   ON note_assets(qid)")
-    # 升級 annotations 欄位（done, star）
-    _safe_add_column(conn, "annotations", "done", "INTEGER DEFAULT 0")
-    _safe_add_column(conn, "annotations", "star", "INTEGER DEFAULT 0")
-
-    conn.commit()
-
-init_or_upgrade_db()
+# 資料存取都在 exam_db.py（行程內共用連線，第一次取用時套用 schema migration）。
+# 這裡只包上 Streamlit 快取：version 參數取自 data_version()，資料有異動時快取自動失效。
+# note_cache_miss()：函式本體只在快取未命中時執行，效能剖析藉此區分命中 / 未命中。
+# 每個快取都有項目數上限與存活時間：資料異動後舊 version 的項目不會再被命中，靠 TTL / 上限淘汰；
+# 結果較大的函式以 _account() 記錄估計大小，維護工具裡可看到各快取目前約佔多少記憶體。
+CACHE_TTL = 3600          # 秒
+BIG_ENTRIES = 16          # 題目清單、整份題庫的抽題快照等大型結果
+PAGE_ENTRIES = 64         # 分頁、長文字等中型結果
+SMALL_ENTRIES = 256       # 計數、選單等小型結果
+
+def _nbytes(obj) -> int:
+    """估計快取結果的大小（DataFrame 含字串內容；numpy 陣列只算資料區）"""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+    if isinstance(obj, dict):
+        return sum(_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(v) for v in obj)
+    return sys.getsizeof(obj)
 
+@st.cache_resource
+def _cache_sizes() -> Dict[str, tuple]:
+    """{函式名稱: (項目數上限, LRU[參數 → (寫入時間, 位元組)])}，與 st.cache_data 同樣的上限淘汰"""
+    return {}
+
+def _account(name:str, max_entries:int, args:tuple, result):
+    sizes = _cache_sizes()
+    if name not in sizes:
+        sizes[name] = (max_entries, LRU(max_entries))
+    sizes[name][1].put(hash(repr(args)), (time.time(), _nbytes(result)))
+    return result
+
+def cache_memory_report() -> pd.DataFrame:
+    """各快取目前（未過期）的項目數與估計大小"""
+    now = time.time(); rows = []
+    for name, (limit, lru) in _cache_sizes().items():
+        live = [n for t, n in lru.values() if now - t < CACHE_TTL]
+        rows.append({"快取": name, "上限": limit, "項目": len(live), "MB": round(sum(live) / 2**20, 2)})
+    return pd.DataFrame(rows, columns=["快取", "上限", "項目", "MB"])
+
+@st.cache_data(show_spinner=False, max_entries=SMALL_ENTRIES, ttl=CACHE_TTL)
+def get_notes_bulk(qids:tuple, version:tuple) -> Dict[int, str]:
+    return notes_bulk(qids)
+
+@st.cache_data(show_spinner=False, max_entries=SMALL_ENTRIES, ttl=CACHE_TTL)
+def list_images_bulk(qids:tuple, version:tuple) -> Dict[int, List[Dict]]:
+    return images_bulk(qids)
+
+@st.cache_data(show_spinner=False, max_entries=PAGE_ENTRIES, ttl=CACHE_TTL)
+def get_question_texts(qids:tuple, version:tuple) -> Dict[int, Dict[str, str]]:
+    """只在要顯示時取回的長文字欄位（題幹、選項、答案、詳解、標籤）；version 用 data_version("questions")"""
+    note_cache_miss()
+    return _account("get_question_texts", PAGE_ENTRIES, (qids, version), question_texts(qids))
+
+@st.cache_data(show_spinner=False, max_entries=4, ttl=CACHE_TTL)
+def get_meta(version:tuple):
+    note_cache_miss()
+    return load_meta()
+
+@st.cache_data(show_spinner=False, max_entries=SMALL_ENTRIES, ttl=CACHE_TTL)
+def get_facet_counts(filters: dict, search: str, wrong_only: bool, min_wrong: int, version:tuple) -> Dict[str, Dict[str, int]]:
+    note_cache_miss()
+    return facet_counts(filters, search, wrong_only, min_wrong)
+
+@st.cache_data(show_spinner=True, max_entries=BIG_ENTRIES, ttl=CACHE_TTL)
+def query_questions_cached(filters: dict, search: str, limit: int, wrong_only: bool, min_wrong: int, version:tuple, state:str=""):
+    """題目清單只有中繼欄位（exam_db.LIST_COLS）；長文字另由 get_question_texts 取"""
+    note_cache_miss()
+    return _account("query_questions_cached", BIG_ENTRIES, (filters, search, limit, wrong_only, min_wrong, version, state),
+                    query_questions(filters, search, limit, wrong_only, min_wrong, state))
+
+@st.cache_data(show_spinner=False, max_entries=SMALL_ENTRIES, ttl=CACHE_TTL)
+def count_questions_cached(filters: dict, search: str, wrong_only: bool, min_wrong: int, version:tuple, state:str="") -> int:
+    note_cache_miss()
+    return count_questions(filters, search, wrong_only, min_wrong, state)
+
+@st.cache_data(show_spinner=False, max_entries=PAGE_ENTRIES, ttl=CACHE_TTL)
+def query_questions_page(filters: dict, search: str, wrong_only: bool, min_wrong: int, version:tuple, page_size:int, after:tuple=None, state:str=""):
+    note_cache_miss()
+    return _account("query_questions_page", PAGE_ENTRIES, (filters, search, wrong_only, min_wrong, version, page_size, after, state),
+                    query_page(filters, search, wrong_only, min_wrong, page_size, after, state))
+
+@st.cache_data(show_spinner=False, max_entries=SMALL_ENTRIES, ttl=CACHE_TTL)
+def _page_anchor(filters: dict, search: str, wrong_only: bool, min_wrong: int, version:tuple, offset:int, state:str=""):
+    return page_anchor(filters, search, wrong_only, min_wrong, offset, state)
+
+@st.cache_data(show_spinner=False, max_entries=PAGE_ENTRIES, ttl=CACHE_TTL)
+def study_summary_cached(group_by:str, filters: dict, search: str, wrong_only: bool, min_wrong: int, version:tuple):
+    note_cache_miss()
+    return study_summary(group_by, filters, search, wrong_only, min_wrong)
+
+@st.cache_data(show_spinner=False, max_entries=4, ttl=CACHE_TTL)
+def mock_sampler_cached(filters: dict, search: str, wrong_only: bool, min_wrong: int, strata:str,
+                        w_wrong:float, w_star:float, w_stale:float, version:tuple):
+    note_cache_miss()
+    return _account("mock_sampler_cached", 4, (filters, search, wrong_only, min_wrong, strata, w_wrong, w_star, w_stale, version),
+                    build_sampler(mock_pool(filters, search, wrong_only, min_wrong, strata), w_wrong, w_star, w_stale))
+
+@st.cache_data(show_spinner=False, max_entries=BIG_ENTRIES, ttl=CACHE_TTL)
+def questions_by_ids_cached(qids:tuple, version:tuple) -> pd.DataFrame:
+    return _account("questions_by_ids_cached", BIG_ENTRIES, (qids, version), questions_by_ids(list(qids)))
+
+@st.cache_data(show_spinner=False, max_entries=8, ttl=CACHE_TTL)
+def near_duplicate_clusters(threshold:float, version:tuple):
+    return find_near_duplicates(threshold)
 # ---------- helpers ----------
-def ensure_annotation_row(qid:int):
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("SELECT qid FROM annotations WHERE qid=?", (qid,))
-    if cur.fetchone() is None:
-        cur.execute("""INSERT INTO annotations
-            (qid, color, highlight_keywords, hl_bg, hl_fg, wrong_count, last_updated)
-            VALUES (?, '', '', '#ffff66', '#000000', 0, ?)""",
-            (qid, datetime.now().isoformat(timespec='seconds')))
-        conn.commit()
-
 def get_annotations(qid:int) -> Dict:
-    ensure_annotation_row(qid)
-    conn = get_conn()
-    df = pd.read_sql_query("SELECT * FROM annotations WHERE qid=?", conn, params=[qid])
-    return df.iloc[0].to_dict()
-
-def update_annotations(qid:int, **kwargs):
-    ensure_annotation_row(qid)
-    if not kwargs: return
-    conn = get_conn(); cur = conn.cursor()
-    sets, vals = [], []
-    for k,v in kwargs.items():
-        sets.append(f"{k}=?"); vals.append(v)
-    sets.append("last_updated=?"); vals.append(datetime.now().isoformat(timespec='seconds'))
-    vals.append(qid)
-    cur.execute(f"UPDATE annotations SET {', '.join(sets)} WHERE qid=?", vals)
-    conn.commit()
+    """讀取題目註記。session 內保留目前看過的列，annotations 沒有異動時直接用記憶體中的值"""
+    # 其他 session（或自己）改過 annotations 後世代會變，整個記憶體視圖作廢重讀
+    gen = data_version("annotations")
+    if st.session_state.get("_ann_view_gen") != gen:
+        st.session_state["_ann_view"] = {}
+        st.session_state["_ann_view_gen"] = gen
+    view = st.session_state["_ann_view"]
+    if qid not in view:
+        conn = get_conn()
+        row = conn.execute(f"SELECT {', '.join(ANN_FIELDS)} FROM annotations WHERE qid=?", (qid,)).fetchone()
+        view[qid] = dict(zip(ANN_FIELDS, row)) if row else dict(ANN_DEFAULTS)
+    return dict(view[qid])
+
+def update_annotations(qid:int, **kwargs) -> bool:
+    """只寫入和目前值不同的欄位，以單一 INSERT ... ON CONFLICT DO UPDATE 完成；
+    沒有任何變更時完全不碰資料庫。回傳是否有寫入。"""
+    current = get_annotations(qid)
+    changed = {k: v for k, v in kwargs.items() if current.get(k) != v}
+    if not changed: return False
+    cols = list(changed)
+    sql = (f"INSERT INTO annotations (qid, {', '.join(cols)}, last_updated) VALUES (?, {', '.join(['?']*len(cols))}, ?) "
+           f"ON CONFLICT(qid) DO UPDATE SET {', '.join(f'{c}=excluded.{c}' for c in cols)}, last_updated=excluded.last_updated")
+    vals = [qid, *changed.values(), datetime.now().isoformat(timespec='seconds')]
+    # 小寫入交給 writer 佇列，多人同時點選時會合併成一次 commit
+    get_db().run_write(lambda conn: conn.execute(sql, vals))
+    st.session_state["_ann_view"][qid].update(changed)
+    return True
 
 
 def insert_questions(df: pd.DataFrame):
-    # 必要欄位補齊
-    req = ["subject","source","year","type","topic","subtopic","stem","options","answer","explanation","tags"]
-    for c in req:
-        if c not in df.columns:
-            df[c] = ""
-
-    # 清理題幹並濾掉空白
-    df = df.copy()
-    df["stem"] = df["stem"].fillna("").astype(str).str.strip()
-    df = df[df["stem"] != ""]
-
-    # 與資料庫比對，避免重複（以「題幹完全相同」視為同題）
-    conn = get_conn()
-    exist_df = pd.read_sql_query("SELECT stem FROM questions", conn)
-    exist_set = set(exist_df["stem"].astype(str).tolist())
-    new_df = df[~df["stem"].astype(str).isin(exist_set)].copy()
-
-    if new_df.empty:
+    inserted, skipped = add_questions(df)
+    if inserted == 0:
         st.warning("⚠️ 本次匯入的題目皆與資料庫重複，未新增任何題目。")
         return
-
-    now = datetime.now().isoformat(timespec="seconds")
-    new_df["created_at"] = now
-    new_df["updated_at"] = now
-    new_df[req+["created_at","updated_at"]].to_sql("questions", conn, if_exists="append", index=False)
-
-    st.session_state["_dirty"] = st.session_state.get("_dirty", 0) + 1
-    st.success(f"✅ 已新增 {len(new_df)} 題（已自動跳過重複題）")
-
-def update_question_row(qid:int, data:Dict):
-    fields = ["subject","source","year","type","topic","subtopic","stem","options","answer","explanation","tags"]
-    sets, vals = [], []
-    for f in fields:
-        sets.append(f"{f}=?"); vals.append(data.get(f,""))
-    sets.append("updated_at=?"); vals.append(datetime.now().isoformat(timespec='seconds'))
-    vals.append(qid)
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute(f"UPDATE questions SET {', '.join(sets)} WHERE id=?", vals)
-    conn.commit()
-    st.session_state["_dirty"] = st.session_state.get("_dirty", 0) + 1
-
-def get_note_text(qid:int) -> str:
-    conn = get_conn()
-    df = pd.read_sql_query("SELECT note FROM notes WHERE qid=?", conn, params=[qid])
-    if df.empty: return ""
-    return df.iloc[0]["note"] or ""
-
-def save_note(qid:int, text:str):
-    conn = get_conn(); cur = conn.cursor()
-    now = datetime.now().isoformat(timespec='seconds')
-    cur.execute("INSERT INTO notes (qid, note, created_at, updated_at) VALUES (?,?,?,?) ON CONFLICT(qid) DO UPDATE SET note=excluded.note, updated_at=excluded.updated_at", (qid, text, now, now))
-    conn.commit()
-
-def list_images(qid:int) -> pd.DataFrame:
-    conn = get_conn()
-    return pd.read_sql_query("SELECT id, file_path, caption, created_at FROM note_assets WHERE qid=? ORDER BY id DESC", conn, params=[qid])
-
-def add_image(qid:int, file_bytes:bytes, filename:str, caption:str=""):
-    os.makedirs(MEDIA_DIR, exist_ok=True)
-    base, ext = os.path.splitext(filename)
-    safe_ext = ext if ext else ".bin"
-    save_name = f"{qid}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{safe_ext}"
-    save_path = os.path.join(MEDIA_DIR, save_name)
-    with open(save_path, "wb") as f:
-        f.write(file_bytes)
-    conn = get_conn(); cur = conn.cursor()
-    cur.execute("INSERT INTO note_assets (qid, file_path, caption, created_at) VALUES (?,?,?,?)",
-                (qid, save_path, caption, datetime.now().isoformat(timespec='seconds')))
-    conn.commit()
-
-def delete_image(asset_id:int):
-    conn = get_conn(); cur = conn.cursor()
-    df = pd.read_sql_query("SELECT file_path FROM note_assets WHERE id=?", conn, params=[asset_id])
-    if not df.empty:
-        path = df.iloc[0]["file_path"]
-        try:
-            if path and os.path.exists(path):
-                os.remove(path)
-        except Exception:
-            pass
-    cur.execute("DELETE FROM note_assets WHERE id=?", (asset_id,))
-    conn.commit()
-
-
-
-@st.cache_data(show_spinner=False)
-def get_meta(_dirty:int):
-    conn = get_conn()
-    try:
-        dfm = pd.read_sql_query("SELECT subject, year, type, topic, subtopic FROM questions", conn)
-    except Exception:
-        return {"subjects": [], "years": [], "types": [], "topics": []}
-
-    def _uniq(col):
-        if col not in dfm.columns:
-            return []
-        s = dfm[col].dropna().astype(str).map(lambda x: x.strip()).replace({"": None}).dropna()
-        return sorted(s.unique().tolist())
-
-    return {
-        "subjects": _uniq("subject"),
-        "years": _uniq("year"),
-        "types": _uniq("type"),
-        "topics": _uniq("topic"),
-    "subtopics": _uniq("subtopic"),
-    }
-
-
-@st.cache_data(show_spinner=True)
-def query_questions_cached(filters: dict, search: str, limit: int, wrong_only: bool, min_wrong: int, _dirty:int):
-    conn = get_conn()
-    q = "SELECT q.*, COALESCE(a.wrong_count,0) AS wrong_count, COALESCE(a.done,0) AS done, COALESCE(a.star,0) AS star FROM questions q LEFT JOIN annotations a ON a.qid = q.id WHERE 1=1"
-    args: List = []
-    for key in ["subject","year","type","topic","subtopic"]:
-        vals = filters.get(key, [])
-        if vals:
-            holders = ",".join(["?"]*len(vals))
-            q += f" AND q.{key} IN ({holders})"
-            args.extend(vals)
-    if search:
-        q += " AND (q.stem LIKE ? OR q.explanation LIKE ? OR q.tags LIKE ? OR q.source LIKE ? OR q.options LIKE ? OR q.topic LIKE ? OR q.subject LIKE ? OR q.subtopic LIKE ?)"
-        s = f"%{search}%"; args.extend([s,s,s,s,s,s,s,s])
-    if wrong_only:
-        q += " AND COALESCE(a.wrong_count,0) > 0"
-    if isinstance(min_wrong, int) and min_wrong > 0:
-        q += " AND COALESCE(a.wrong_count,0) >= ?"
-        args.append(int(min_wrong))
-    q += " ORDER BY COALESCE(a.wrong_count,0) DESC, q.updated_at DESC, q.id DESC LIMIT ?"
-    args.append(limit)
-    return pd.read_sql_query(q, conn, params=args)
-
-def _delete_ids(qids:List[int]) -> int:
-    if not qids: return 0
-    conn = get_conn(); cur = conn.cursor()
-    holders = ",".join(["?"]*len(qids))
-    img_df = pd.read_sql_query(f"SELECT file_path FROM note_assets WHERE qid IN ({holders})", conn, params=qids)
-    for _, r in img_df.iterrows():
-        try:
-            if r["file_path"] and os.path.exists(r["file_path"]):
-                os.remove(r["file_path"])
-        except Exception:
-            pass
-    cur.execute(f"DELETE FROM note_assets WHERE qid IN ({holders})", qids)
-    cur.execute(f"DELETE FROM notes       WHERE qid IN ({holders})", qids)
-    cur.execute(f"DELETE FROM annotations WHERE qid IN ({holders})", qids)
-    cur.execute(f"DELETE FROM questions   WHERE id  IN ({holders})", qids)
-    conn.commit()
-    st.session_state["_dirty"] = st.session_state.get("_dirty", 0) + 1
-    return len(qids)
-
-def clear_all(which:str):
-    conn = get_conn(); cur = conn.cursor()
-    if which == "all":
-        try: shutil.rmtree(MEDIA_DIR)
-        except Exception: pass
-        os.makedirs(MEDIA_DIR, exist_ok=True)
-        for tbl in ["note_assets","notes","annotations","questions"]:
-            cur.execute(f"DELETE FROM {tbl};")
-    elif which == "notes_only":
-        try: shutil.rmtree(MEDIA_DIR)
-        except Exception: pass
-        os.makedirs(MEDIA_DIR, exist_ok=True)
-        cur.execute("DELETE FROM note_assets;")
-        cur.execute("DELETE FROM notes;")
-    elif which == "ann_only":
-        cur.execute("DELETE FROM annotations;")
-    conn.commit()
-    st.session_state["_dirty"] = st.session_state.get("_dirty", 0) + 1
-
-
-def find_duplicate_ids_to_delete() -> list:
-    """回傳應刪除的重複題 id（以相同 stem 為重複，保留每組最小 id）"""
-    conn = get_conn()
-    # 找出每個 stem 的最小 id
-    min_id_df = pd.read_sql_query("SELECT stem, MIN(id) AS keep_id FROM questions GROUP BY stem", conn)
-    all_df = pd.read_sql_query("SELECT id, stem FROM questions", conn)
-    keep_map = {row["stem"]: int(row["keep_id"]) for _, row in min_id_df.iterrows()}
-    ids_to_delete = []
-    for _, r in all_df.iterrows():
-        sid = int(r["id"]); steme = str(r["stem"])
-        if steme in keep_map and sid != keep_map[steme]:
-            ids_to_delete.append(sid)
-    return ids_to_delete
-def apply_highlight(html_txt:str, keywords:str, bg:str, fg:str) -> str:
-    if not html_txt: return ""
-    if not keywords.strip(): return html_txt
-    kws = [k.strip() for k in keywords.split(',') if k.strip()]
-    out = html_txt
-    for k in sorted(kws, key=len, reverse=True):
-        out = out.replace(k, f"<span style='background:{bg};color:{fg};padding:0 2px;border-radius:2px'>{k}</span>")
-    return out
+    st.success(f"✅ 已新增 {inserted} 題（已自動跳過重複題 {skipped} 題）")
+
+def fetch_page(state_key:str, params:tuple, page:int, page_size:int, study:str="") -> pd.DataFrame:
+    """分頁元件用：在 session 記住各頁最後一列的排序鍵，逐頁翻動時直接接續游標；
+    跳到沒走過的頁才用 _page_anchor 定位。params 為 (filters, search, wrong_only, min_wrong, version)，
+    study 為讀書狀態篩選（done / wrong / star）"""
+    state = st.session_state.get(state_key)
+    if not state or state["sig"] != (params, page_size, study):
+        state = {"sig": (params, page_size, study), "cursors": {}}
+        st.session_state[state_key] = state
+    cursors = state["cursors"]
+    after = None
+    if page > 1:
+        after = cursors.get(page-1)
+        if after is None:
+            after = _page_anchor(*params, (page-1)*page_size - 1, study)
+            if after is None:
+                return query_questions_page(*params, 0, None, study)[0]
+    df_page, last = query_questions_page(*params, page_size, after, study)
+    if last is not None:
+        cursors[page] = last
+    return df_page
+
+
+def render_profile_panel():
+    """維護工具內的效能剖析：上一次重跑的瀑布圖、SQL 記錄（含查詢計畫旗標）與 JSONL 下載"""
+    runs = st.session_state.get("_prof_runs", [])
+    if not runs:
+        st.caption("已開啟，下一次重跑後會顯示結果。")
+        return
+    run = runs[-1]
+    sqls = run.sql_events()
+    sections = [e for e in run.events if e["kind"] == "section"]
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("上次重跑", f"{run.total_ms:,.0f} ms")
+    m2.metric("SQL", f"{len(sqls)} 條")
+    m3.metric("SQL 合計", f"{sum(e['dur_ms'] for e in sqls):,.1f} ms")
+    m4.metric("快取未命中", sum(e.get("cache") == "miss" for e in sections))
+    if run.dropped:
+        st.caption(f"事件過多，另有 {run.dropped} 筆未記錄。")
+
+    wf = pd.DataFrame([{"#": i, "項目": ("　" * e["depth"]) + (e["name"] if e["kind"] == "section" else "SQL " + e["name"][:50]),
+                        "類型": e["kind"] if e["kind"] == "sql" else f"section {e.get('cache', '')}".strip(),
+                        "開始": e["start_ms"], "結束": e["start_ms"] + (e["dur_ms"] or 0), "ms": e["dur_ms"]}
+                       for i, e in enumerate(run.events)])
+    if not wf.empty:
+        # 每列一個事件、依發生順序由上而下；極短的 SQL 不畫以免圖太長
+        wf = wf[(wf["類型"] != "sql") | (wf["ms"] >= 0.2)].head(200)
+        wf["項目"] = wf["#"].map("{:03d} ".format) + wf["項目"]
+        st.vega_lite_chart(wf, {
+            "mark": {"type": "bar", "tooltip": True},
+            "height": max(120, 18 * len(wf)),
+            "encoding": {
+                "y": {"field": "項目", "type": "ordinal", "sort": None, "title": None},
+                "x": {"field": "開始", "type": "quantitative", "title": "ms"},
+                "x2": {"field": "結束"},
+                "color": {"field": "類型", "type": "nominal"},
+            },
+        }, use_container_width=True)
+    if sqls:
+        st.caption("SQL 記錄（依耗時排序；全表掃描 / 暫存 B-tree 取自 EXPLAIN QUERY PLAN）")
+        log = pd.DataFrame([{"ms": e["dur_ms"], "列數": e["rows"], "旗標": "、".join(e["flags"]),
+                             "所在區段": e["parent"], "SQL": e["sql"], "查詢計畫": " | ".join(e["plan"])} for e in sqls])
+        st.dataframe(log.sort_values("ms", ascending=False), use_container_width=True, hide_index=True)
+    st.download_button(f"下載計時記錄 JSONL（最近 {len(runs)} 次重跑）", profile_jsonl(runs),
+                       file_name=f"profile_{datetime.now():%Y%m%d_%H%M%S}.jsonl", mime="application/x-ndjson")
+
+# ---------- 背景工作 ----------
+# 匯入、去重、清除、匯出、維護交給 exam_jobs 的背景執行緒；側欄的工作面板在有工作進行時每 2 秒輪詢一次，
+# 本 session 排入的工作結束後整頁重跑一次，讓快取（依 data_version）與匯出下載更新。
+JOB_ICONS = {"queued": "⏳", "running": "🔄", "done": "✅", "failed": "❌", "cancelled": "⏹", "interrupted": "⚠️"}
+JOB_LABELS = {"inserted": "新增", "skipped": "跳過", "deleted": "刪除", "n": "題數",
+              "moved": "搬移", "thumbs": "補縮圖", "missing": "缺檔", "steps": "步驟",
+              "converted": "轉換", "failed": "無法解析", "changes": "異動",
+              "questions": "題目", "notes": "筆記", "annotations": "註記", "assets": "圖片", "older": "保留本機"}
+
+def run_job(kind:str, params:Dict=None, title:str="", key:str=None):
+    """排入背景工作後重跑，讓工作面板開始輪詢；key 有給時把 job id 存進 session_state[key]"""
+    job_id = submit_job(kind, params, title)
+    st.session_state.setdefault("_watch_jobs", set()).add(job_id)
+    if key: st.session_state[key] = job_id
+    st.rerun()
+
+def _job_summary(job:Dict) -> str:
+    vals = job["result"] if job["status"] == "done" and isinstance(job["result"], dict) else job["counters"]
+    parts = [f"{JOB_LABELS[k]} {v:,}" for k, v in vals.items() if k in JOB_LABELS and isinstance(v, int)]
+    return "、".join(parts) or (job["message"] or "")
+
+@st.fragment(run_every=2 if has_active_jobs() else None)
+def jobs_panel():
+    jobs = list_jobs(6)
+    if not jobs: return
+    st.subheader("**背景工作**")
+    watch = st.session_state.setdefault("_watch_jobs", set())
+    for job in jobs:
+        jid, status = job["id"], job["status"]
+        label = f"{JOB_ICONS.get(status, '')} #{jid} {job['title']}"
+        if status in JOB_ACTIVE:
+            frac = job["done_units"] / job["total_units"] if job["total_units"] else 0.0
+            st.progress(min(1.0, frac), text=f"{label}｜{job['message'] or ('排隊中' if status == 'queued' else '執行中')}")
+            if st.button("取消", key=f"job_cancel_{jid}"):
+                cancel_job(jid)
+            continue
+        st.caption(f"{label}｜{_job_summary(job)}")
+        if job["error"]:
+            st.caption(f"　{job['error'].splitlines()[0]}")
+        if status in JOB_RESUMABLE and st.button("從中斷處繼續", key=f"job_resume_{jid}"):
+            if resume_job(jid):
+                watch.add(jid)
+                st.rerun()
+    finished = [j["id"] for j in jobs if j["id"] in watch and j["status"] not in JOB_ACTIVE]
+    if finished:
+        watch.difference_update(finished)
+        st.rerun()
 
 # ---------- SIDEBAR ----------
-with st.sidebar:
+with st.sidebar, section("sidebar"):
     st.subheader("**資料匯入**")
     up = st.file_uploader("上傳題庫 CSV（UTF-8 / UTF-8-SIG）", type=["csv"])
-    if up is not None:
-        try:
-            try:
-                df_in = pd.read_csv(up, encoding="utf-8-sig")
-            except Exception:
-                up.seek(0); df_in = pd.read_csv(up, encoding="utf-8")
-            insert_questions(df_in); st.success(f"已匯入 {len(df_in)} 題"); st.session_state['_dirty'] = st.session_state.get('_dirty', 0) + 1
-        except Exception as e:
-            st.error(f"匯入失敗：{e}")
+    # 同一個上傳檔只匯入一次（file_uploader 會在每次重跑時保留檔案）；先存到 jobs/，由背景工作分批匯入
+    if up is not None and st.session_state.get("_imported_file") != up.file_id:
+        st.session_state["_imported_file"] = up.file_id
+        run_job("import_csv", {"path": save_upload(up, up.name), "encoding": "utf-8-sig"}, f"匯入 {up.name}")
+    jobs_panel()
 
     st.divider()
     st.subheader("**查詢設定**")
     max_rows = st.slider("查詢上限（越小越快）", 50, 5000, 800, 50)
 
-    meta = get_meta(st.session_state.get('_dirty', 0))
+    with section("get_meta", cached=True):
+        meta = get_meta(data_version("questions"))
     subjects = meta["subjects"]
     years    = meta["years"]
     types    = meta["types"]
     topics   = meta["topics"]
     subtopics = meta["subtopics"]
-    f_subject = st.multiselect("科目", subjects)
-    f_year    = st.multiselect("年度", years)
-    f_type    = st.multiselect("題型", types)
-    f_topic   = st.multiselect("主題", topics)
-    f_subtopic= st.multiselect("次主題 / 子題", subtopics)
+    # 選項旁顯示「在其他已選條件下」的題數；其他元件的值此時已在 session_state 中
+    with section("get_facet_counts", cached=True):
+        fc = get_facet_counts({d: st.session_state.get(f"f_{d}", []) for d in FACET_DIMS},
+                              st.session_state.get("search_kw", ""), st.session_state.get("wrong_only", False),
+                              int(st.session_state.get("min_wrong", 0)), data_version("questions","annotations"))
+    def _fmt(dim):
+        return lambda v: f"{v} ({fc[dim].get(v, 0):,})"
+    f_subject = st.multiselect("科目", subjects, key="f_subject", format_func=_fmt("subject"))
+    f_year    = st.multiselect("年度", years, key="f_year", format_func=_fmt("year"))
+    f_type    = st.multiselect("題型", types, key="f_type", format_func=_fmt("type"))
+    f_topic   = st.multiselect("主題", topics, key="f_topic", format_func=_fmt("topic"))
+    f_subtopic= st.multiselect("次主題 / 子題", subtopics, key="f_subtopic", format_func=_fmt("subtopic"))
     
-search_kw = st.text_input("全文搜尋（題幹/詳解/標籤/來源/選項/主題/科目）")
+search_kw = st.text_input("全文搜尋（題幹/詳解/標籤/來源/選項/主題/科目）", key="search_kw", help="多個關鍵字以空白分隔（需同時符合）；以雙引號包住可搜尋完整片語")
 
     
 st.markdown("—")
 cwo1, cwo2 = st.columns([1,1])
 with cwo1:
-    wrong_only = st.toggle("只顯示做錯過（>0）", value=False)
+    wrong_only = st.toggle("只顯示做錯過（>0）", value=False, key="wrong_only")
 with cwo2:
-    min_wrong = st.number_input("最低錯誤次數（>=）", min_value=0, max_value=999, value=0, step=1)
+    min_wrong = st.number_input("最低錯誤次數（>=）", min_value=0, max_value=999, value=0, step=1, key="min_wrong")
 # 重新載入選單（強制刷新快取）
     if st.button("🔄 重新載入選單"):
-        st.session_state["_dirty"] = st.session_state.get("_dirty", 0) + 1
+        get_meta.clear()
         st.rerun()
 
     st.divider()
@@ -400,31 +403,51 @@ with cwo2:
             if not ok or token!="DELETE":
                 st.error("未勾選確認或驗證碼錯誤，已取消。")
             else:
-                if mode.endswith("筆記＋圖片＋註記"): clear_all("all"); st.success("已清除：題目、筆記、圖片、註記。")
-                elif mode.startswith("只清除所有題目的筆記"): clear_all("notes_only"); st.success("已清除：筆記與圖片。")
-                else: clear_all("ann_only"); st.success("已清除：顏色/螢光筆/錯誤次數。")
+                if mode.endswith("筆記＋圖片＋註記"): run_job("clear", {"which": "all"}, "清除題目、筆記、圖片、註記")
+                elif mode.startswith("只清除所有題目的筆記"): run_job("clear", {"which": "notes_only"}, "清除筆記與圖片")
+                else: run_job("clear", {"which": "ann_only"}, "清除顏色/螢光筆/錯誤次數")
 
         st.markdown("---")
         if st.button("🧹 刪除資料庫中已存在的重複題（以題幹相同，保留每組最小ID）"):
-            ids = find_duplicate_ids_to_delete()
-            if not ids:
-                st.info("未發現重複題。")
-            else:
-                n = _delete_ids(ids)
-                st.success(f"已刪除 {n} 筆重複題。")
+            run_job("dedup", title="刪除重複題")
+
+    with st.expander("🛠 維護工具", expanded=False):
+        if st.button("🖼 整理圖片庫（合併相同圖片、補產生縮圖）"):
+            run_job("media", title="整理圖片庫")
+        if st.button("🧰 重建索引與查詢統計（全文檢索、REINDEX、ANALYZE）"):
+            run_job("maintenance", title="重建索引")
+        st.toggle("∑ 算式排版（以 LaTeX 顯示已轉換的算式）", key="math_on")
+        if st.button("∑ 轉換題庫中的算式（只處理尚未轉換的）"):
+            run_job("math", title="轉換算式")
+        st.caption("資料庫連線狀態")
+        st.json(get_db().stats(), expanded=False)
+        st.caption("題目片段快取：" + "｜".join(f"{k} {v:,}" for k, v in {"記憶體命中": FRAGMENTS.stats["memory"],
+                   "資料庫命中": FRAGMENTS.stats["stored"], "重新產生": FRAGMENTS.stats["rendered"]}.items()))
+        st.caption("快取記憶體（估計；只列結果較大的快取）")
+        st.dataframe(cache_memory_report(), hide_index=True, use_container_width=True)
+        st.toggle("⏱ 效能剖析（記錄每次重跑的區段計時與 SQL）", key="profile_on")
+        if st.session_state["profile_on"]:
+            render_profile_panel()
 # ---------- MAIN ----------
 filters = {"subject": f_subject, "year": f_year, "type": f_type, "topic": f_topic, "subtopic": f_subtopic}
-df = query_questions_cached(filters, search_kw, max_rows, wrong_only, int(min_wrong), st.session_state.get('_dirty', 0))
+q_version = data_version("questions","annotations")
+with section("query_questions_cached", cached=True):
+    df = query_questions_cached(filters, search_kw, max_rows, wrong_only, int(min_wrong), q_version)
+# 清單 / 卡片分頁直接在 SQL 端分頁與計數，不受查詢上限限制
+page_params = (filters, search_kw, wrong_only, int(min_wrong), q_version)
+with section("count_questions_cached", cached=True):
+    total_all = count_questions_cached(*page_params)
 
-tabs = st.tabs(["**逐題模式**", "**清單（分頁）**", "**卡片（分頁）**", "**進度總覽**", "**手動新增 / 修改**", "**匯出**"])
+tabs = st.tabs(["**逐題模式**", "**清單（分頁）**", "**卡片（分頁）**", "**進度總覽**", "**模擬考**", "**手動新增 / 修改**", "**匯出**"])
 
 # ===== 逐題模式 =====
-with tabs[0]:
+with tabs[0], section("tab:逐題模式"):
     if df.empty:
         st.info("尚無資料或篩選條件無結果。請先匯入或清除篩選。")
     else:
         if "idx" not in st.session_state: st.session_state.idx = 0
         max_idx = len(df)-1
+        st.session_state.idx = min(st.session_state.idx, max_idx)
         c1,c2,c3,c4,c5 = st.columns([1,1,1,1,3])
         if c1.button("⏮ 第一題"): st.session_state.idx = 0
         if c2.button("◀ 上一題"): st.session_state.idx = max(0, st.session_state.idx-1)
@@ -435,91 +458,116 @@ with tabs[0]:
         r = df.iloc[st.session_state.idx]
         qid = int(r["id"])
         ann = get_annotations(qid)
-
-wrong = int(ann.get("wrong_count") or 0)
-done_state = int(ann.get("done") or 0)
-star_state = int(ann.get("star") or 0)
-# 顏色與錯誤次數（並排）
-ca, cb, cc, cd, ce = st.columns([1.6, 1.0, 1.0, 1.2, 1.2])
-with ca:
-    color = st.color_picker("題卡顏色（可自訂）", value=ann.get("color") or "#FFFFFF")
-with cb:
-    st.metric("錯誤次數", wrong)
-with cc:
-    if st.button("➕ 記一次錯誤", key=f"wc_inc_{qid}"):
-        update_annotations(qid, wrong_count=wrong+1)
-        st.experimental_rerun()
-with cd:
-    if st.button("🔁 歸零", key=f"wc_reset_{qid}"):
-        update_annotations(qid, wrong_count=0)
-        st.experimental_rerun()
-with ce:
-    if st.button(("✅ 已做過 ✓" if done_state else "✅ 已做過"), key=f"done_{qid}"):
-        update_annotations(qid, done=0 if done_state else 1)
-        st.experimental_rerun()
-    if st.button(("★ 取消收藏" if star_state else "☆ 加入收藏"), key=f"star_{qid}"):
-        update_annotations(qid, star=0 if star_state else 1)
-        st.experimental_rerun()
-
-kw = st.text_input("螢光筆關鍵字（逗號分隔，可多個）", value=ann.get("highlight_keywords") or "")
-cc1,cc2 = st.columns(2)
-hl_bg = cc1.color_picker("螢光筆底色", value=ann.get("hl_bg") or "#ffff66")
-hl_fg = cc2.color_picker("螢光筆文字顏色", value=ann.get("hl_fg") or "#000000")
-update_annotations(qid, color=color, highlight_keywords=kw, hl_bg=hl_bg, hl_fg=hl_fg)
-
-st.markdown(f"<div style='padding:14px;border-radius:12px;background:{color};'><b>#{qid}｜{r.get('subject','')}｜{r.get('year','')}｜{r.get('type','')}｜{r.get('topic','')}｜{(r.get('subtopic','') or '')}｜錯誤次數 {wrong}｜{('已做過' if done_state else '未做')}｜{('★' if star_state else '☆')}</b><div style='margin-top:8px;line-height:1.7;'>{apply_highlight(r.get('stem','') or '', kw, hl_bg, hl_fg)}</div></div>", unsafe_allow_html=True)
-# 選項換行修正
-opts_html = (r.get('options','') or '').replace('\r\n','\n').replace('\r','\n').replace('\n','<br>')
-if opts_html:
-    st.markdown(opts_html, unsafe_allow_html=True)
-
-with st.expander("答案 / 詳解", expanded=False):
-    st.write(f"**答案：** {r.get('answer','')}")
-    st.markdown(apply_highlight(r.get('explanation','') or '', kw, hl_bg, hl_fg), unsafe_allow_html=True)
-    st.caption(f"標籤：{r.get('tags','')}")
-
-# ✅ 筆記 / 圖片 區塊
-st.subheader("📝 筆記 / 圖片")
-existing_note = get_note_text(qid)
-with st.form(f"note_form_{qid}"):
-    note_text = st.text_area("筆記內容（支援一般文字或簡單 Markdown）", value=existing_note, height=180)
-    files = st.file_uploader("上傳圖片（可多選；支援 jpg/png/webp）", type=["jpg","jpeg","png","webp"], accept_multiple_files=True, key=f"u_{qid}")
-    caption = st.text_input("圖片說明（可留空）", value="")
-    save_btn = st.form_submit_button("儲存筆記 / 上傳圖片")
-    if save_btn:
-        save_note(qid, note_text)
-        if files:
-            for f in files:
-                add_image(qid, f.read(), f.name, caption)
-        st.success("已更新筆記 / 上傳圖片。")
-        st.session_state["_dirty"] = st.session_state.get("_dirty", 0) + 1
-
-imgs = list_images(qid)
-if not imgs.empty:
-    st.caption("已上傳圖片")
-    for _, row in imgs.iterrows():
-        col1, col2 = st.columns([4,1])
-        with col1:
-            st.image(row["file_path"], use_container_width=True)
-            if row.get("caption"):
-                st.caption(row["caption"])
-        with col2:
-            if st.button("刪除", key=f"delimg_{row['id']}"):
-                delete_image(int(row["id"]))
-                st.success("圖片已刪除")
-                st.experimental_rerun()
+        # 以 20 題為一個視窗批次預取筆記 / 圖片，上一題、下一題直接命中快取
+        win = st.session_state.idx // 20 * 20
+        win_ids = tuple(int(x) for x in df["id"].iloc[win:win+20])
+        notes_map = get_notes_bulk(win_ids, data_version("notes"))
+        # 清單只有中繼欄位，長文字同樣以視窗為單位取回
+        txt = get_question_texts(win_ids, data_version("questions")).get(qid, {})
+
+        wrong = int(ann.get("wrong_count") or 0)
+        done_state = int(ann.get("done") or 0)
+        star_state = int(ann.get("star") or 0)
+        # 按鈕動作與元件變更先收集起來，最後合併成一次寫入
+        pending = {}
+        # 顏色與錯誤次數（並排）
+        ca, cb, cc, cd, ce = st.columns([1.6, 1.0, 1.0, 1.2, 1.2])
+        with ca:
+            color = st.color_picker("題卡顏色（可自訂）", value=ann.get("color") or "#FFFFFF")
+        with cb:
+            st.metric("錯誤次數", wrong)
+        with cc:
+            if st.button("➕ 記一次錯誤", key=f"wc_inc_{qid}"):
+                pending["wrong_count"] = wrong+1
+        with cd:
+            if st.button("🔁 歸零", key=f"wc_reset_{qid}"):
+                pending["wrong_count"] = 0
+        with ce:
+            if st.button(("✅ 已做過 ✓" if done_state else "✅ 已做過"), key=f"done_{qid}"):
+                pending["done"] = 0 if done_state else 1
+            if st.button(("★ 取消收藏" if star_state else "☆ 加入收藏"), key=f"star_{qid}"):
+                pending["star"] = 0 if star_state else 1
+        clicked = bool(pending)
+
+        kw = st.text_input("螢光筆關鍵字（逗號分隔，可多個）", value=ann.get("highlight_keywords") or "")
+        cc1,cc2 = st.columns(2)
+        hl_bg = cc1.color_picker("螢光筆底色", value=ann.get("hl_bg") or "#ffff66")
+        hl_fg = cc2.color_picker("螢光筆文字顏色", value=ann.get("hl_fg") or "#000000")
+        # 和元件初始值比較（資料庫的空字串顯示為預設色），使用者沒動過就不寫入
+        shown = {"color": ann.get("color") or "#FFFFFF", "highlight_keywords": ann.get("highlight_keywords") or "",
+                 "hl_bg": ann.get("hl_bg") or "#ffff66", "hl_fg": ann.get("hl_fg") or "#000000"}
+        picked = {"color": color, "highlight_keywords": kw, "hl_bg": hl_bg, "hl_fg": hl_fg}
+        pending.update({k: v for k, v in picked.items() if v != shown[k]})
+        update_annotations(qid, **pending)
+        if clicked:
+            st.rerun()
+
+        # 標題列、題幹螢光筆、選項換行都取自片段快取（鍵含 updated_at 與註記版本）
+        math_on = st.session_state["math_on"]
+        frag = render_fragments([{**r.to_dict(), **txt}], {qid: {**ann, **pending}}, math_on)[qid]
+        if math_on:
+            # HTML 區塊內的文字不經 markdown 處理，題幹前後空一行才會排版 $…$
+            st.markdown(f"<div style='padding:14px;border-radius:12px;background:{color};line-height:1.7;'><b>{frag['header']}</b>\n\n{frag['stem']}\n\n</div>", unsafe_allow_html=True)
+        else:
+            st.markdown(f"<div style='padding:14px;border-radius:12px;background:{color};'><b>{frag['header']}</b><div style='margin-top:8px;line-height:1.7;'>{frag['stem']}</div></div>", unsafe_allow_html=True)
+        if frag["options"]:
+            st.markdown(frag["options"], unsafe_allow_html=True)
+
+        with st.expander("答案 / 詳解", expanded=False):
+            st.write(f"**答案：** {frag['answer']}")
+            st.markdown(frag["explanation"], unsafe_allow_html=True)
+            if math_on:
+                # 化簡結果可能等於答案，只放在這裡
+                simplified = [(tex, simple) for _, tex, simple in formula_details([txt.get(c) for c in MATH_COLS]).values()
+                              if tex and simple and simple != tex]
+                if simplified:
+                    st.caption("算式化簡")
+                    for tex, simple in simplified:
+                        st.markdown(f"${tex}$ → ${simple}$")
+            st.caption(f"標籤：{frag['tags']}")
+
+        # ✅ 筆記 / 圖片 區塊
+        st.subheader("📝 筆記 / 圖片")
+        existing_note = notes_map.get(qid, "")
+        with st.form(f"note_form_{qid}"):
+            note_text = st.text_area("筆記內容（支援一般文字或簡單 Markdown）", value=existing_note, height=180)
+            files = st.file_uploader("上傳圖片（可多選；支援 jpg/png/webp）", type=["jpg","jpeg","png","webp"], accept_multiple_files=True, key=f"u_{qid}")
+            caption = st.text_input("圖片說明（可留空）", value="")
+            save_btn = st.form_submit_button("儲存筆記 / 上傳圖片")
+            if save_btn:
+                save_note(qid, note_text)
+                if files:
+                    for f in files:
+                        add_image(qid, f.read(), f.name, caption)
+                st.success("已更新筆記 / 上傳圖片。")
+
+        imgs = list_images_bulk(win_ids, data_version("note_assets")).get(qid, [])
+        if imgs:
+            st.caption("已上傳圖片")
+            for row in imgs:
+                col1, col2 = st.columns([4,1])
+                with col1:
+                    # 預設顯示預覽圖，勾選後才載入原圖
+                    show_orig = st.toggle("原圖", key=f"orig_{row['id']}")
+                    st.image(row["file_path"] if show_orig else media_variant(row, "preview"), use_container_width=True)
+                    if row.get("caption"):
+                        st.caption(row["caption"])
+                with col2:
+                    if st.button("刪除", key=f"delimg_{row['id']}"):
+                        delete_image(int(row["id"]))
+                        st.success("圖片已刪除")
+                        st.rerun()
 
 # ===== 清單（分頁） =====
-with tabs[1]:
-    if df.empty:
+with tabs[1], section("tab:清單（分頁）"):
+    if total_all == 0:
         st.info("尚無資料或篩選條件無結果。")
     else:
         page_size = st.selectbox("每頁顯示筆數", [20,50,100,200], index=1)
-        total = len(df); pages = max(1, math.ceil(total/page_size))
+        total = total_all; pages = max(1, math.ceil(total/page_size))
         page = st.number_input("頁碼", 1, pages, 1)
-        start = (page-1)*page_size; end = start+page_size
         st.caption(f"共 {total} 筆；第 {page}/{pages} 頁")
-        df_page = df.iloc[start:end].copy()
+        df_page = fetch_page("_pg_list", page_params, int(page), page_size)
 
         # 勾選刪除
         df_view = df_page[["id","subject","source","year","type","topic","subtopic","wrong_count","done","star","stem","answer"]].copy()
@@ -545,12 +593,36 @@ with tabs[1]:
             tk_sel = st.text_input("輸入 DELETE（勾選）")
             if st.button("🗑 刪除已勾選題目", type="secondary", disabled=(len(selected_ids)==0)):
                 if ok_sel and tk_sel=="DELETE":
-                    n = _delete_ids(selected_ids)
+                    n = delete_ids(selected_ids)
                     st.success(f"已刪除勾選 {n} 題")
                     st.experimental_rerun()
                 else:
                     st.error("未勾選確認或驗證碼錯誤")
 
+        st.markdown("### **批次標記**")
+        # 動作名稱 -> (bulk_annotate 的 op, 固定值)；值為 None 的動作由下方元件提供
+        bulk_actions = {
+            "標記已做過": ("done", 1), "取消已做過": ("done", 0),
+            "加星": ("star", 1), "取消星號": ("star", 0), "切換星號": ("star_toggle", None),
+            "錯誤次數 +1": ("wrong_inc", 1), "錯誤次數歸零": ("wrong_reset", None),
+            "設定題卡顏色": ("color", None), "設定螢光筆關鍵字": ("keywords", None),
+        }
+        cb1, cb2, cb3 = st.columns([2, 2, 2])
+        bulk_target = cb1.radio("對象", [f"已勾選（{len(selected_ids)} 題）", f"目前篩選全部（{total_all} 題）"], key="bulk_target")
+        bulk_label = cb2.selectbox("動作", list(bulk_actions), key="bulk_action")
+        op, value = bulk_actions[bulk_label]
+        with cb3:
+            if op == "color":
+                value = st.color_picker("題卡顏色", value="#FFF3CD", key="bulk_color")
+            elif op == "keywords":
+                value = st.text_input("螢光筆關鍵字（逗號分隔；留空為清除）", key="bulk_kw")
+        on_selected = bulk_target.startswith("已勾選")
+        if st.button("✔ 套用批次標記", disabled=on_selected and not selected_ids):
+            scope = None if on_selected else {"filters": filters, "search": search_kw, "wrong_only": wrong_only, "min_wrong": int(min_wrong)}
+            n = bulk_annotate(op, value, qids=selected_ids if on_selected else None, scope=scope)
+            st.toast(f"已對 {n} 題套用「{bulk_label}」")
+            st.rerun()
+
         st.markdown("### **批次刪除**")
         cL, cR = st.columns(2)
         with cL:
@@ -558,80 +630,163 @@ with tabs[1]:
             tkp = st.text_input("輸入 DELETE（本頁）")
             if st.button("刪除本頁題目"):
                 if okp and tkp=="DELETE":
-                    n = _delete_ids(list(map(int, df_page["id"].tolist())))
+                    n = delete_ids(list(map(int, df_page["id"].tolist())))
                     st.success(f"已刪除本頁 {n} 題。請重新整理或切換頁碼。")
                 else:
                     st.error("未勾選確認或驗證碼錯誤")
         with cR:
             oka = st.checkbox("我了解此動作不可復原（全部）")
             tka = st.text_input("輸入 DELETE（全部）")
-            if st.button("刪除目前篩選的全部題目", type="primary"):
+            if st.button(f"刪除目前篩選的全部題目（{total_all} 題）", type="primary"):
                 if oka and tka=="DELETE":
-                    n = _delete_ids(list(map(int, df["id"].tolist())))
+                    n = delete_where(filters, search_kw, wrong_only, int(min_wrong))
                     st.success(f"已刪除當前篩選的全部 {n} 題。")
                 else:
                     st.error("未勾選確認或驗證碼錯誤")
 
 # ===== 卡片（分頁） =====
-with tabs[2]:
-    if df.empty:
+with tabs[2], section("tab:卡片（分頁）"):
+    if total_all == 0:
         st.info("尚無資料或篩選條件無結果。")
     else:
         page_size = st.selectbox("每頁顯示張數", [10,20,50], index=0, key="ps_card")
-        total = len(df); pages = max(1, math.ceil(total/page_size))
+        total = total_all; pages = max(1, math.ceil(total/page_size))
         page = st.number_input("頁碼（卡片）", 1, pages, 1, key="pg_card")
-        start = (page-1)*page_size; end = start+page_size
         st.caption(f"共 {total} 題；第 {page}/{pages} 頁")
-        for _, r in df.iloc[start:end].iterrows():
-            qid = int(r["id"])
+        card_df = fetch_page("_pg_card", page_params, int(page), page_size)
+        card_ids = tuple(int(x) for x in card_df["id"])
+        notes_map = get_notes_bulk(card_ids, data_version("notes"))
+        imgs_map = list_images_bulk(card_ids, data_version("note_assets"))
+        # 整頁的片段一次取得（註記一次查出），卡片只做拼裝
+        frags = render_fragments(card_df.to_dict("records"), math=st.session_state["math_on"])
+        for qid in card_ids:
+            frag = frags[qid]
             with st.container(border=True):
-                st.markdown(f"**#{qid}｜{r.get('subject','')}｜{r.get('year','')}｜{r.get('type','')}｜{r.get('topic','')}｜{r.get('subtopic','')}｜錯誤次數 {int(r.get('wrong_count',0) or 0)}｜{'已做過' if int(r.get('done',0) or 0) else '未做'}｜{'★' if int(r.get('star',0) or 0) else '☆'}**")
-                st.markdown(r.get('stem','') or '', unsafe_allow_html=True)
-                # 選項換行修正
-                opts_html = (r.get('options','') or '').replace('\r\n','\n').replace('\r','\n').replace('\n','<br>')
-                if opts_html:
-                    st.markdown(opts_html, unsafe_allow_html=True)
+                st.markdown(f"**{frag['header']}**")
+                st.markdown(frag["stem"], unsafe_allow_html=True)
+                if frag["options"]:
+                    st.markdown(frag["options"], unsafe_allow_html=True)
                 cols = st.columns([1.2, 3.8, 1.4, 1.2])
-                cols[0].write(f"**答案：** {r.get('answer','')}")
-                cols[1].markdown(r.get("explanation","") or "", unsafe_allow_html=True)
-                cols[2].write(f"**標籤：** {r.get('tags','')}")
-                note_txt = get_note_text(qid)
+                cols[0].write(f"**答案：** {frag['answer']}")
+                cols[1].markdown(frag["explanation"], unsafe_allow_html=True)
+                cols[2].write(f"**標籤：** {frag['tags']}")
+                note_txt = notes_map.get(qid, "")
                 if note_txt:
                     cols[3].markdown(f"**筆記：** {note_txt[:120]}{'…' if len(note_txt)>120 else ''}")
-                img_df = list_images(qid)
-                if not img_df.empty:
+                img_rows = imgs_map.get(qid, [])
+                if img_rows:
                     st.caption("已上傳圖片（縮圖）")
-                    tcols = st.columns(min(3, len(img_df)))
-                    for i, (_, rr) in enumerate(img_df.head(3).iterrows()):
+                    tcols = st.columns(min(3, len(img_rows)))
+                    for i, rr in enumerate(img_rows[:3]):
                         with tcols[i % len(tcols)]:
-                            st.image(rr["file_path"], use_container_width=True)
+                            st.image(media_variant(rr, "thumb"), use_container_width=True)
 
 
-with tabs[3]:
-    if df.empty:
+with tabs[3], section("tab:進度總覽"):
+    if total_all == 0:
         st.info("目前沒有符合條件的題目。")
     else:
-        c1, c2, c3 = st.columns(3)
-        with c1:
-            st.subheader("✅ 已做過")
-            d1 = df[df["done"]>0][["id","subject","year","type","topic","subtopic","wrong_count"]]
-            st.write(f"共 {len(d1)} 題")
-            st.dataframe(d1, use_container_width=True, hide_index=True)
-        with c2:
-            st.subheader("❌ 做錯過（>0）")
-            d2 = df[df["wrong_count"]>0][["id","subject","year","type","topic","subtopic","wrong_count"]]
-            st.write(f"共 {len(d2)} 題")
-            st.dataframe(d2, use_container_width=True, hide_index=True)
-        with c3:
-            st.subheader("★ 已加星")
-            d3 = df[df["star"]>0][["id","subject","year","type","topic","subtopic","wrong_count"]]
-            st.write(f"共 {len(d3)} 題")
-            st.dataframe(d3, use_container_width=True, hide_index=True)
+        # 整個篩選結果的彙總（不受查詢上限影響）；點選表格的一列可展開該組的題目明細
+        dim_labels = {"subject": "科目", "topic": "主題", "subtopic": "次主題", "year": "年度", "type": "題型"}
+        group_by = st.radio("分組", list(dim_labels), format_func=dim_labels.get, horizontal=True, key="dash_group")
+        summ = study_summary_cached(group_by, filters, search_kw, wrong_only, int(min_wrong), q_version)
+        n_all = int(summ["total"].sum())
+        pct = lambda n: f"{n / n_all:.0%}" if n_all else "—"
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("題數", f"{n_all:,}")
+        m2.metric("✅ 已做過", f"{int(summ['done'].sum()):,}", pct(summ["done"].sum()), delta_color="off")
+        m3.metric("❌ 做錯過", f"{int(summ['wrong'].sum()):,}", pct(summ["wrong"].sum()), delta_color="off")
+        m4.metric("★ 已加星", f"{int(summ['star'].sum()):,}", pct(summ["star"].sum()), delta_color="off")
+        view = summ.assign(value=summ["value"].replace("", "（未填）"), done_ratio=summ["done_ratio"] * 100, wrong_ratio=summ["wrong_ratio"] * 100)
+        picked = st.dataframe(
+            view[["value", "total", "done", "done_ratio", "wrong", "wrong_ratio", "wrong_sum", "star"]],
+            use_container_width=True, hide_index=True, on_select="rerun", selection_mode="single-row", key=f"dash_sel_{group_by}",
+            column_config={
+                "value": dim_labels[group_by], "total": "題數", "done": "已做過", "wrong": "做錯過", "wrong_sum": "累計錯誤", "star": "已加星",
+                "done_ratio": st.column_config.ProgressColumn("完成率", format="%.0f%%", min_value=0, max_value=100),
+                "wrong_ratio": st.column_config.ProgressColumn("錯誤率", format="%.0f%%", min_value=0, max_value=100),
+            })
+        rows = picked["selection"]["rows"]
+        if not rows:
+            st.caption("點選上表的一列查看該組題目。")
+        else:
+            cell = summ.iloc[rows[0]]
+            state_labels = {"": "全部", "done": "已做過", "wrong": "做錯過", "star": "已加星"}
+            drill = st.radio(f"「{view.iloc[rows[0]]['value']}」的題目", list(state_labels), format_func=state_labels.get, horizontal=True, key="dash_state")
+            d_params = ({**filters, group_by: [cell["value"]]}, search_kw, wrong_only, int(min_wrong), q_version)
+            d_total = count_questions_cached(*d_params, drill)
+            d_pages = max(1, math.ceil(d_total / 20))
+            d_page = st.number_input("頁碼（明細）", 1, d_pages, 1, key="pg_dash")
+            st.caption(f"共 {d_total} 題；第 {d_page}/{d_pages} 頁")
+            d_df = fetch_page("_pg_dash", d_params, int(d_page), 20, drill)
+            st.dataframe(d_df[["id","subject","year","type","topic","subtopic","wrong_count","done","star","stem"]],
+                         use_container_width=True, hide_index=True)
+
+# ===== 模擬考 =====
+with tabs[4], section("tab:模擬考"):
+    if total_all == 0:
+        st.info("目前沒有符合條件的題目。")
+    else:
+        # 抽題用的 id / 權重快照依 data_version 快取，產生試卷只在記憶體中抽樣，再一次取回抽到的題目
+        st.caption("從目前篩選＋搜尋結果依權重抽題：錯誤次數越多、有加星、越久沒複習的題目越容易被抽到。同樣的設定與種子會抽出同一份試卷。")
+        strata_labels = {"": "不分層", "subject": "科目", "topic": "主題"}
+        mc1, mc2, mc3 = st.columns(3)
+        n_mock = int(mc1.number_input("題數", 1, 500, 50, 10, key="mock_n"))
+        strata = mc2.selectbox("分層抽題", list(strata_labels), format_func=strata_labels.get, key="mock_strata")
+        quota_by = mc3.radio("各層配額", ["size", "weight"], format_func={"size": "依題數比例", "weight": "依權重比例"}.get, horizontal=True, key="mock_by")
+        with st.expander("權重設定（每題權重 = 1 + 各項加總）", expanded=False):
+            wc1, wc2, wc3 = st.columns(3)
+            w_wrong = wc1.slider("錯誤次數（每次）", 0.0, 5.0, 1.0, 0.5, key="mock_w_wrong")
+            w_star = wc2.slider("加星", 0.0, 5.0, 1.0, 0.5, key="mock_w_star")
+            w_stale = wc3.slider(f"久未複習（{STALE_DAYS} 天以上或未曾註記為滿分）", 0.0, 5.0, 1.0, 0.5, key="mock_w_stale")
+        sampler = mock_sampler_cached(filters, search_kw, wrong_only, int(min_wrong), strata, w_wrong, w_star, w_stale, q_version)
+        quotas = allocate(sampler, n_mock, quota_by)
+        if strata:
+            quota_df = pd.DataFrame({"value": [k or "（未填）" for k in quotas], "pool": [len(sampler[k]["id"]) for k in quotas], "quota": list(quotas.values())})
+            edited = st.data_editor(quota_df, hide_index=True, use_container_width=True, disabled=["value", "pool"],
+                                    key=f"mock_quota_{strata}_{quota_by}_{n_mock}",
+                                    column_config={"value": strata_labels[strata], "pool": "可抽題數", "quota": st.column_config.NumberColumn("配額", min_value=0, step=1)})
+            quotas = dict(zip(quotas, edited["quota"].fillna(0).astype(int).tolist()))
+        seed_txt = st.text_input("種子（留空則隨機；填入同一個整數可重現同一份試卷）", key="mock_seed")
+        if st.button("🎲 產生試卷"):
+            try:
+                seed = int(seed_txt) if seed_txt.strip() else random.randrange(10**8)
+            except ValueError:
+                st.error("種子需為整數。"); st.stop()
+            st.session_state["_mock"] = {"ids": draw(sampler, quotas, seed), "seed": seed}
+        paper = st.session_state.get("_mock")
+        if paper:
+            mock_ids = paper["ids"]
+            st.caption(f"試卷共 {len(mock_ids)} 題｜種子 {paper['seed']}")
+            paper_df = questions_by_ids_cached(tuple(mock_ids), q_version)
+            frags = render_fragments(paper_df.to_dict("records"), math=st.session_state["math_on"])
+            for i, (_, r) in enumerate(paper_df.iterrows(), 1):
+                qid = int(r["id"]); frag = frags[qid]
+                with st.container(border=True):
+                    st.markdown(f"**第 {i} 題｜#{qid}｜{r.get('subject','')}｜{r.get('year','')}｜{r.get('type','')}｜{r.get('topic','')}**")
+                    st.markdown(frag["stem"], unsafe_allow_html=True)
+                    if frag["options"]:
+                        st.markdown(frag["options"], unsafe_allow_html=True)
+                    st.checkbox("答錯", key=f"mock_wrong_{paper['seed']}_{qid}")
+                    with st.expander("答案 / 詳解", expanded=False):
+                        st.write(f"**答案：** {frag['answer']}")
+                        st.markdown(frag["explanation"], unsafe_allow_html=True)
+            # 同一份試卷只能交一次：按鈕在重跑後停用，連點送出的第二次也在這裡擋下
+            if st.button("📝 交卷（全部標為已做過，勾選「答錯」的題目錯誤次數 +1）",
+                         disabled=paper.get("submitted", False)) and not paper.get("submitted"):
+                missed = [q for q in mock_ids if st.session_state.get(f"mock_wrong_{paper['seed']}_{q}")]
+                # 兩次註記併成同一個交易：不會只記到一半
+                with get_db().write():
+                    bulk_annotate("done", 1, qids=mock_ids)
+                    if missed:
+                        bulk_annotate("wrong_inc", 1, qids=missed)
+                paper["submitted"] = True
+                st.success(f"已記錄：{len(mock_ids)} 題已做過，其中 {len(missed)} 題答錯。")
 
 # ===== 手動新增 / 修改 =====
-with tabs[3]:
+with tabs[5], section("tab:手動新增 / 修改"):
     st.caption("一次新增一題，或編輯現有題目後儲存變更。")
-    mode = st.radio("模式", ["新增一題", "修改現有題目"], horizontal=True)
+    mode = st.radio("模式", ["新增一題", "修改現有題目", "近似重複題"], horizontal=True)
     if mode == "新增一題":
         with st.form("add_one"):
             c1,c2,c3,c4 = st.columns(4)
@@ -654,13 +809,13 @@ with tabs[3]:
                 }])
                 insert_questions(df_new)
                 st.success("已新增")
-    else:
+    elif mode == "修改現有題目":
         if df.empty:
             st.info("目前無題目可修改。")
         else:
             id_list = df["id"].astype(int).tolist()
             sel_id = st.selectbox("選擇題目 ID", id_list)
-            cur_row = df[df["id"]==sel_id].iloc[0].to_dict()
+            cur_row = {**df[df["id"]==sel_id].iloc[0].to_dict(), **get_question_texts((int(sel_id),), data_version("questions")).get(int(sel_id), {})}
             with st.form("edit_one"):
                 c1,c2,c3,c4 = st.columns(4)
                 subject = c1.text_input("科目", cur_row.get("subject",""))
@@ -675,21 +830,85 @@ with tabs[3]:
                 tags    = st.text_input("標籤（逗號分隔）", cur_row.get("tags",""))
                 ok = st.form_submit_button("儲存修改")
                 if ok:
-                    update_question_row(int(sel_id), {
-                        "subject":subject,"source":cur_row.get("source","manual"),"year":year,"type":qtype,
-                        "topic":topic,"subtopic":subtopic,"stem":stem,"options":options,
-                        "answer":answer,"explanation":explanation,"tags":tags
-                    })
-                    st.success(f"題目 #{sel_id} 已更新")
+                    try:
+                        update_question_row(int(sel_id), {
+                            "subject":subject,"source":cur_row.get("source","manual"),"year":year,"type":qtype,
+                            "topic":topic,"subtopic":subtopic,"stem":stem,"options":options,
+                            "answer":answer,"explanation":explanation,"tags":tags
+                        })
+                        st.success(f"題目 #{sel_id} 已更新")
+                    except ValueError as e:
+                        st.error(f"未儲存：{e}")
+    else:
+        th = st.slider("相似度門檻", 0.5, 1.0, 0.8, 0.05,
+                       help="以題幹的 3 字元片段估計相似度；全半形、標點、空白、HTML 與開頭的題號 / 選項字母不影響比對")
+        with st.spinner("比對中…"):
+            refresh_minhash()
+            clusters = near_duplicate_clusters(float(th), data_version("questions"))
+        if not clusters:
+            st.info("未發現近似重複題。")
+        else:
+            shown = clusters[:30]
+            st.caption(f"共 {len(clusters)} 組、{sum(len(c) for c in clusters)} 題；顯示前 {len(shown)} 組，處理完會自動補上")
+            info = question_briefs([i for c in shown for i, _ in c])
+            for n, cluster in enumerate(shown, 1):
+                ids = [i for i, _ in cluster]
+                with st.expander(f"第 {n} 組：{len(ids)} 題（ID {', '.join(map(str, ids))}）", expanded=(n == 1)):
+                    rows = []
+                    for i, sim in cluster:
+                        subj, year, src, stem = info.get(i, ("", "", "", ""))
+                        rows.append({"ID": i, "相似度": f"{sim:.0%}", "科目": subj, "年度": year, "來源": src, "題幹": stem[:120]})
+                    st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+                    keep = st.radio("保留", ids, horizontal=True, key=f"dup_keep_{ids[0]}")
+                    how = st.radio("其他題", ["合併後刪除（筆記、圖片、註記併入保留題）", "直接刪除"], horizontal=True, key=f"dup_how_{ids[0]}")
+                    if st.button("套用", key=f"dup_apply_{ids[0]}"):
+                        drop = [i for i in ids if i != keep]
+                        n_del = merge_duplicates(keep, drop) if how.startswith("合併") else delete_ids(drop)
+                        st.toast(f"已保留 #{keep}，刪除 {n_del} 題")
+                        st.rerun()
 
 # ===== 匯出 =====
-with tabs[4]:
-    st.caption("將當前篩選＋搜尋結果導出為 CSV。")
-    if st.button("匯出 CSV"):
-        if df.empty:
-            st.warning("沒有可匯出的內容。")
-        else:
-            out = df.to_csv(index=False).encode("utf-8-sig")
-            st.download_button("下載 CSV", out, file_name=f"exam_export_{datetime.now().strftime('%Y%m%d_%H%M')}.csv", mime="text/csv")
+with tabs[6], section("tab:匯出"):
+    st.caption("串流匯出：資料逐批從資料庫讀出直接寫入檔案，不受查詢上限限制。")
+    ex_scope = st.radio("範圍", ["目前篩選＋搜尋結果", "整個題庫"], horizontal=True)
+    ex_fmt = st.radio("格式", ["CSV", "Excel（XLSX）", "完整備份 ZIP（題目＋筆記＋註記＋圖片）"], horizontal=True)
+    if st.button("產生匯出檔"):
+        scope = None if ex_scope == "整個題庫" else {"filters": filters, "search": search_kw, "wrong_only": wrong_only, "min_wrong": int(min_wrong)}
+        fmt = {"CSV": "csv", "Excel（XLSX）": "xlsx"}.get(ex_fmt, "bundle")
+        run_job("export", {"fmt": fmt, "scope": scope}, f"匯出 {ex_fmt.split('（')[0]}", key="_export_job")
+    job = get_job(st.session_state["_export_job"]) if "_export_job" in st.session_state else {}
+    exported = job.get("result") if job.get("status") == "done" else None
+    if job.get("status") in JOB_ACTIVE:
+        st.info("匯出中…（進度見側欄「背景工作」）")
+    elif exported and not exported["n"]:
+        st.warning("沒有可匯出的內容。")
+    elif exported and os.path.exists(exported["path"]):
+        with open(exported["path"], "rb") as fh:
+            st.download_button(f"下載（{exported['n']} 題）", fh, file_name=os.path.basename(exported["path"]), mime=exported["mime"])
+
+    st.divider()
+    st.subheader("🔄 裝置同步")
+    st.caption(f"只交換上次同步後變動的題目、筆記、註記與圖片；兩邊都改過的以較晚修改的為準。本機：{exam_sync.device_name()}（{exam_sync.device_id()}）")
+    known = exam_sync.peers()
+    targets = [None] + [p["peer"] for p in known]
+    names = {p["peer"]: f"{p['name']}（{p['peer']}）｜上次同步 {p['updated_at']}" for p in known}
+    target = st.selectbox("同步檔要給哪台裝置", targets, format_func=lambda p: names.get(p, "新裝置（完整資料）"))
+    if target:
+        st.caption(f"待送出 {exam_sync.pending_count(target):,} 筆異動")
+    if st.button("產生同步檔"):
+        run_job("sync_export", {"peer": target}, "產生同步檔", key="_sync_job")
+    job = get_job(st.session_state["_sync_job"]) if "_sync_job" in st.session_state else {}
+    synced = job.get("result") if job.get("status") == "done" else None
+    if job.get("status") in JOB_ACTIVE:
+        st.info("打包中…（進度見側欄「背景工作」）")
+    elif synced and os.path.exists(synced["path"]):
+        with open(synced["path"], "rb") as fh:
+            st.download_button(f"下載同步檔（{synced['changes']:,} 筆異動）", fh, file_name=os.path.basename(synced["path"]), mime=synced["mime"])
+    sync_up = st.file_uploader("匯入其他裝置的同步檔（.sync.zip）", type=["zip"])
+    if sync_up is not None and st.session_state.get("_synced_file") != sync_up.file_id:
+        st.session_state["_synced_file"] = sync_up.file_id
+        run_job("sync_import", {"path": save_upload(sync_up, sync_up.name)}, f"匯入同步檔 {sync_up.name}")
 
 st.caption("build v2.0 — notes & images restored, options newline fixed, list select-delete")
+if "_prof_run" in st.session_state:
+    st.session_state["_prof_run"].finish()
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+# 考古題 Handy Plus — 背景工作（匯入、去重、匯出、維護、清除、算式轉換、裝置同步），不依賴 Streamlit
+"""耗時的操作交給行程內的背景執行緒，Streamlit 腳本只負責排入工作與顯示進度；瀏覽器重新連線不影響執行。
+
+- jobs 表記錄狀態、進度、計數、檢查點與結果；側欄輪詢 list_jobs() 顯示進度
+- 只有一個工作執行緒，工作依序執行；每一批寫入是一個短的 get_db().write() 交易，
+  檢查點與該批資料在同一交易內 commit，互動中的小寫入在批與批之間照常進行
+- cancel() 只設旗標，工作在下一批開始前停下；中斷 / 失敗 / 取消的工作可用 resume() 從檢查點續跑
+"""
+import os, json, time, uuid, shutil, socket, threading, traceback, multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import exam_db, exam_math, exam_sync
+from exam_db import get_db, get_conn
+
+JOB_DIR = "jobs"            # 上傳待匯入的檔案
+IMPORT_CHUNK = 5000         # 匯入每批列數
+DELETE_CHUNK = 2000         # 去重每批刪除題數
+MATH_CHUNK = 200            # 算式轉換每批數量
+MATH_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+HEARTBEAT_S = 30            # 執行中的工作多久更新一次 updated_at
+STALE_S = 120               # 其他行程的工作超過這麼久沒有心跳，視為已中斷
+
+ACTIVE = ("queued", "running")
+RESUMABLE = ("interrupted", "failed", "cancelled")
+
+# 每個行程一個識別；jobs.owner 用來判斷工作屬於哪個行程
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class JobCancelled(Exception):
+    pass
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+class JobContext:
+    """交給工作函式的介面：checkpoint 為續跑用的狀態（dict），counters 為顯示用計數"""
+
+    def __init__(self, job_id:int, checkpoint:Dict, counters:Dict):
+        self.job_id = job_id
+        self.checkpoint = checkpoint
+        self.counters = counters
+        self.done_units = 0
+        self.total_units = 0
+        self.message = ""
+
+    def report(self, done:int=None, total:int=None, message:str=None, **counters):
+        if done is not None: self.done_units = int(done)
+        if total is not None: self.total_units = int(total)
+        if message is not None: self.message = message
+        self.counters.update(counters)
+
+    def check(self):
+        """使用者要求取消時丟出 JobCancelled（每批開始前呼叫）"""
+        row = get_conn().execute("SELECT cancel_requested FROM jobs WHERE id=?", (self.job_id,)).fetchone()
+        if row and row[0]:
+            raise JobCancelled()
+
+    def save(self, conn):
+        conn.execute("UPDATE jobs SET done_units=?, total_units=?, message=?, counters=?, checkpoint=?, updated_at=? WHERE id=?",
+                     (self.done_units, self.total_units, self.message, json.dumps(self.counters, ensure_ascii=False),
+                      json.dumps(self.checkpoint, ensure_ascii=False), _now(), self.job_id))
+
+    @contextmanager
+    def step(self):
+        """一批工作：先檢查取消，再開寫入交易；離開時把進度與檢查點寫進同一個交易"""
+        self.check()
+        with get_db().write() as conn:
+            yield conn
+            self.save(conn)
+
+    def flush(self):
+        with get_db().write() as conn:
+            self.save(conn)
+
+# ---------- 工作種類 ----------
+HANDLERS: Dict[str, Callable] = {}
+
+def handler(kind:str):
+    def deco(fn:Callable):
+        HANDLERS[kind] = fn
+        return fn
+    return deco
+
+@handler("import_csv")
+def _import_csv(ctx:JobContext, params:Dict):
+    """params: path, encoding；檢查點為已處理的資料列數，續跑時跳過"""
+    import pandas as pd
+    done_rows = ctx.checkpoint.get("rows", 0)
+    with open(params["path"], "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        reader = pd.read_csv(fh, encoding=params.get("encoding", "utf-8-sig"), dtype=str, keep_default_na=False,
+                             chunksize=IMPORT_CHUNK, skiprows=range(1, done_rows + 1))
+        for chunk in reader:
+            with ctx.step() as conn:
+                n_ins, n_skip = exam_db._insert_question_chunk(conn, chunk)
+                ctx.checkpoint["rows"] = done_rows = done_rows + len(chunk)
+                ctx.report(fh.tell(), size, f"已讀取 {done_rows:,} 列",
+                           inserted=ctx.counters.get("inserted", 0) + n_ins, skipped=ctx.counters.get("skipped", 0) + n_skip)
+    ctx.report(message="計算近似重複簽章…"); ctx.flush()
+    exam_db.refresh_minhash()
+    ctx.report(message="預先產生題目片段…"); ctx.flush()
+    exam_db.refresh_render_cache()
+    try: os.remove(params["path"])
+    except OSError: pass
+    return {"inserted": ctx.counters.get("inserted", 0), "skipped": ctx.counters.get("skipped", 0)}
+
+@handler("dedup")
+def _dedup(ctx:JobContext, params:Dict):
+    """刪除題幹完全相同的重複題（保留最小 id）；每批重新找，已刪掉的不會再出現，續跑不需要檢查點"""
+    ids = exam_db.find_duplicate_ids_to_delete()
+    total = ctx.counters.get("deleted", 0) + len(ids)
+    for i in range(0, len(ids), DELETE_CHUNK):
+        with ctx.step():
+            n = exam_db.delete_ids(ids[i:i+DELETE_CHUNK])
+            ctx.report(ctx.counters.get("deleted", 0) + n, total, deleted=ctx.counters.get("deleted", 0) + n)
+    return {"deleted": ctx.counters.get("deleted", 0)}
+
+EXPORTERS = {"csv": (exam_db.export_csv, "text/csv"),
+             "xlsx": (exam_db.export_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+             "bundle": (exam_db.export_bundle, "application/zip")}
+
+@handler("export")
+def _export(ctx:JobContext, params:Dict):
+    """params: fmt（csv / xlsx / bundle）、scope；串流匯出本身只有一步，中斷後重新產生"""
+    ctx.check()
+    exporter, mime = EXPORTERS[params["fmt"]]
+    ctx.report(message="匯出中…"); ctx.flush()
+    path, n = exporter(params.get("scope"))
+    return {"path": path, "n": n, "mime": mime}
+
+def _fts_rebuild(conn):
+    if get_db().has_fts:
+        conn.execute("INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')")
+        conn.execute("INSERT INTO questions_fts(questions_fts) VALUES ('optimize')")
+
+# 維護步驟：(名稱, 函式)；檢查點為下一個要做的步驟
+MAINTENANCE_STEPS = [
+    ("重建全文檢索", _fts_rebuild),
+    ("重建索引", lambda conn: conn.execute("REINDEX")),
+    ("更新查詢統計", lambda conn: conn.execute("ANALYZE")),
+]
+
+@handler("maintenance")
+def _maintenance(ctx:JobContext, params:Dict):
+    start = ctx.checkpoint.get("step", 0)
+    for i in range(start, len(MAINTENANCE_STEPS)):
+        name, fn = MAINTENANCE_STEPS[i]
+        ctx.report(i, len(MAINTENANCE_STEPS), name); ctx.flush()
+        with ctx.step() as conn:
+            fn(conn)
+            ctx.checkpoint["step"] = i + 1
+            ctx.report(i + 1)
+    ctx.report(message="更新近似重複簽章…"); ctx.flush()
+    exam_db.refresh_minhash()
+    return {"steps": len(MAINTENANCE_STEPS)}
+
+@handler("clear")
+def _clear(ctx:JobContext, params:Dict):
+    """params: which（all / notes_only / ann_only，同 clear_all）"""
+    ctx.check()
+    exam_db.clear_all(params["which"])
+    return {"which": params["which"]}
+
+@handler("media")
+def _media(ctx:JobContext, params:Dict):
+    ctx.check()
+    return exam_db.backfill_media()
+
+@handler("math")
+def _math(ctx:JobContext, params:Dict):
+    """把題庫中尚未轉換的算式交給 sympy 轉成 LaTeX。sympy 佔 CPU 又持有 GIL，改在子行程（spawn，
+    不複製 Streamlit 的執行緒與連線）執行；已轉換的不會再出現在 pending_formulas，續跑不需要檢查點"""
+    exprs = exam_db.pending_formulas()
+    done = ctx.counters.get("converted", 0)
+    total = done + len(exprs)
+    ctx.report(done, total, f"待轉換 {len(exprs):,} 個算式"); ctx.flush()
+    if not exprs:
+        return {"converted": done}
+    with ProcessPoolExecutor(MATH_WORKERS, mp_context=multiprocessing.get_context("spawn")) as pool:
+        for i in range(0, len(exprs), MATH_CHUNK):
+            part = exprs[i:i+MATH_CHUNK]
+            ctx.check()
+            results = list(pool.map(exam_math.to_latex, part, chunksize=8))
+            with ctx.step() as conn:
+                exam_db.store_formulas(conn, part, results)
+                done += len(part)
+                ctx.report(done, total, converted=done, failed=ctx.counters.get("failed", 0) + sum(r[0] is None for r in results))
+    return {"converted": done, "failed": ctx.counters.get("failed", 0)}
+
+@handler("sync_export")
+def _sync_export(ctx:JobContext, params:Dict):
+    """params: peer（None 為新裝置，送完整資料）；結果為 {path, changes, mime}"""
+    ctx.check()
+    ctx.report(message="打包異動…"); ctx.flush()
+    path, n = exam_sync.export_changes(params.get("peer"))
+    return {"path": path, "changes": n, "mime": "application/zip"}
+
+@handler("sync_import")
+def _sync_import(ctx:JobContext, params:Dict):
+    """params: path；整個同步檔一個交易，重跑不會重複套用"""
+    ctx.check()
+    ctx.report(message="套用同步檔…"); ctx.flush()
+    stats = exam_sync.import_changes(params["path"])
+    try: os.remove(params["path"])
+    except OSError: pass
+    return stats
+
+# ---------- 執行 ----------
+_pool = None
+_pool_lock = threading.Lock()
+
+def _executor() -> ThreadPoolExecutor:
+    """行程內唯一的工作執行緒；第一次取用時接手上次中斷或無人執行的工作"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job")
+                _recover(_pool)
+    return _pool
+
+def _recover(pool:ThreadPoolExecutor):
+    stale = datetime.fromtimestamp(time.time() - STALE_S).isoformat(timespec="seconds")
+    with get_db().write() as conn:
+        # 沒有心跳的 running 工作：原本的行程已結束（同一行程內不會有別人在跑）
+        conn.execute("UPDATE jobs SET status='interrupted', updated_at=? WHERE status='running' AND (owner=? OR updated_at < ?)",
+                     (_now(), OWNER, stale))
+        queued = [r[0] for r in conn.execute("SELECT id FROM jobs WHERE status='queued' AND (owner IS NULL OR owner=? OR updated_at < ?) ORDER BY id",
+                                             (OWNER, stale))]
+    for job_id in queued:
+        pool.submit(_run, job_id)
+
+def _heartbeat(job_id:int, stop:threading.Event):
+    while not stop.wait(HEARTBEAT_S):
+        get_db().run_write(lambda conn: conn.execute("UPDATE jobs SET updated_at=? WHERE id=?", (_now(), job_id)))
+
+def _run(job_id:int):
+    with get_db().write() as conn:
+        # 以條件式 UPDATE 認領，多個行程同時接手時只有一個會成功
+        claimed = conn.execute("UPDATE jobs SET status='running', owner=?, started_at=COALESCE(started_at, ?), updated_at=? "
+                               "WHERE id=? AND status='queued'", (OWNER, _now(), _now(), job_id)).rowcount
+        row = conn.execute("SELECT kind, params, checkpoint, counters FROM jobs WHERE id=?", (job_id,)).fetchone()
+    if not claimed or row is None:
+        return
+    kind, params, checkpoint, counters = row
+    ctx = JobContext(job_id, json.loads(checkpoint or "{}"), json.loads(counters or "{}"))
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, stop), name=f"job-{job_id}-heartbeat", daemon=True).start()
+    status, result, error = "done", None, None
+    try:
+        result = HANDLERS[kind](ctx, json.loads(params or "{}"))
+    except JobCancelled:
+        status = "cancelled"
+    except Exception as e:
+        status, error = "failed", f"{type(e).__name__}: {e}\n" + "".join(traceback.format_exc(limit=5))
+    finally:
+        stop.set()
+    with get_db().write() as conn:
+        ctx.save(conn)
+        conn.execute("UPDATE jobs SET status=?, result=?, error=?, finished_at=?, updated_at=? WHERE id=?",
+                     (status, json.dumps(result, ensure_ascii=False, default=str) if result is not None else None,
+                      error, _now(), _now(), job_id))
+
+def submit(kind:str, params:Dict=None, title:str="") -> int:
+    """排入一個工作，回傳 job id"""
+    if kind not in HANDLERS:
+        raise ValueError(f"未知的工作種類：{kind}")
+    pool = _executor()
+    with get_db().write() as conn:
+        job_id = conn.execute("INSERT INTO jobs (kind, title, params, status, owner, counters, checkpoint, created_at, updated_at) "
+                              "VALUES (?,?,?, 'queued', ?, '{}', '{}', ?, ?)",
+                              (kind, title or kind, json.dumps(params or {}, ensure_ascii=False), OWNER, _now(), _now())).lastrowid
+    pool.submit(_run, job_id)
+    return job_id
+
+def cancel(job_id:int):
+    """排隊中的工作直接取消；執行中的在下一批開始前停下"""
+    with get_db().write() as conn:
+        conn.execute("UPDATE jobs SET status='cancelled', finished_at=?, updated_at=? WHERE id=? AND status='queued'", (_now(), _now(), job_id))
+        conn.execute("UPDATE jobs SET cancel_requested=1 WHERE id=? AND status='running'", (job_id,))
+
+def resume(job_id:int) -> bool:
+    """從檢查點續跑中斷 / 失敗 / 取消的工作"""
+    pool = _executor()
+    with get_db().write() as conn:
+        ok = conn.execute(f"UPDATE jobs SET status='queued', owner=?, cancel_requested=0, error=NULL, finished_at=NULL, updated_at=? "
+                          f"WHERE id=? AND status IN ({','.join(['?']*len(RESUMABLE))})", (OWNER, _now(), job_id, *RESUMABLE)).rowcount
+    if ok:
+        pool.submit(_run, job_id)
+    return bool(ok)
+
+def list_jobs(limit:int=8) -> List[Dict]:
+    """最近的工作（進行中的排前面）；counters / result 已解析為 dict"""
+    _executor()
+    cols = ["id","kind","title","status","done_units","total_units","message","counters","result","error","created_at","finished_at"]
+    rows = get_conn().execute(f"SELECT {', '.join(cols)} FROM jobs ORDER BY status IN ('queued','running') DESC, id DESC LIMIT ?", (limit,))
+    out = []
+    for row in rows:
+        job = dict(zip(cols, row))
+        job["counters"] = json.loads(job["counters"] or "{}")
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        out.append(job)
+    return out
+
+def get_job(job_id:int) -> Dict:
+    row = get_conn().execute("SELECT status, result, message, error FROM jobs WHERE id=?", (job_id,)).fetchone()
+    if row is None:
+        return {}
+    return {"status": row[0], "result": json.loads(row[1]) if row[1] else None, "message": row[2], "error": row[3]}
+
+def has_active_jobs() -> bool:
+    return get_conn().execute("SELECT 1 FROM jobs WHERE status IN ('queued','running') LIMIT 1").fetchone() is not None
+
+def save_upload(fileobj, name:str) -> str:
+    """把上傳的檔案複製到 jobs/，匯入工作（含續跑）都從這份讀"""
+    os.makedirs(JOB_DIR, exist_ok=True)
+    path = os.path.join(JOB_DIR, f"upload_{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:6]}{os.path.splitext(name)[1] or '.csv'}")
+    with open(path, "wb") as out:
+        shutil.copyfileobj(fileobj, out)
+    return path
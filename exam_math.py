@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# 考古題 Handy Plus — 算式排版（選用），不依賴 Streamlit
+"""找出題目文字中以純文字寫成的算式（例如 x^2+3x-4=0），以 sympy 解析後轉成 LaTeX。
+
+sympy 載入要一兩秒，只在第一次轉換時才 import；轉換結果存在 latex_cache 表（以算式雜湊為鍵），
+整個題庫的轉換由背景工作以 process pool 執行，重跑時只查表、套用，不呼叫 sympy。
+"""
+import re, hashlib
+from typing import Dict, List, Optional, Tuple
+
+MAX_LEN = 120           # 超過此長度的片段不當作算式
+# 算式可能用到的字元；中文、全形標點都會把片段切開
+_SPAN_RE = re.compile(r"[0-9A-Za-z_.()\[\]^*/+\-=<>≤≥√ ]+")
+_HTML_TOKEN_RE = re.compile(r"(<!--.*?-->|<[!/]?[A-Za-z][^>]*>|&(?:#\d+|#x[0-9A-Fa-f]+|\w+);|\$[^$\n]+\$)", re.S)
+_OPTION_LABEL_RE = re.compile(r"^\(?[A-Ea-e]\)\s*")
+_WORD_RE = re.compile(r"[A-Za-z]{3,}")   # 兩個字母視為變數相乘（mc^2）
+_FUNCS = {"sin", "cos", "tan", "log", "ln", "exp", "sqrt"}
+_OPERATOR_RE = re.compile(r"[\^*/=<>≤≥√]|\w\s*[+\-]\s*\w|\d[A-Za-z]")
+_HUGE_POWER_RE = re.compile(r"\^\s*\(?\s*\d{3,}")
+_REL_RE = re.compile(r"<=|>=|≤|≥|=|<|>")
+_TAG_RE = re.compile(r"</|<\s*(?:br|b|i|u|p|hr|sub|sup|div|span|img)\b", re.I)
+
+def _clean(span:str) -> str:
+    span = _OPTION_LABEL_RE.sub("", span.strip()).strip(" .")
+    return span
+
+def is_formula(span:str) -> bool:
+    """需要有運算子（或 3x 這類隱含乘法），且有變數、次方或根號；含一般英文單字的不算"""
+    if not 3 <= len(span) <= MAX_LEN or not _OPERATOR_RE.search(span):
+        return False
+    if any(w.lower() not in _FUNCS for w in _WORD_RE.findall(span)):
+        return False
+    if span.count("(") != span.count(")") or _TAG_RE.search(span):
+        return False   # 括號不成對，或是沒寫完整的 HTML 標籤（<br、</ b>）
+    return bool(re.search(r"[A-Za-z^√]", span))
+
+def _text_parts(html_txt:str):
+    """HTML 標籤、entity 與已經是 $…$ 的部分原樣保留；回傳 (是否為文字, 片段)"""
+    for i, part in enumerate(_HTML_TOKEN_RE.split(html_txt or "")):
+        yield i % 2 == 0, part
+
+def find_formulas(html_txt:str) -> List[str]:
+    out = []
+    for is_text, part in _text_parts(html_txt):
+        if not is_text: continue
+        for m in _SPAN_RE.finditer(part):
+            span = _clean(m.group(0))
+            if is_formula(span) and span not in out:
+                out.append(span)
+    return out
+
+def expr_hash(expr:str) -> str:
+    return hashlib.sha1(" ".join(expr.split()).encode("utf-8")).hexdigest()[:20]
+
+def substitute(html_txt:str, latex:Dict[str, str]) -> str:
+    """把已轉換的算式換成 $LaTeX$；latex 為 {expr_hash: LaTeX}，沒有的保持原文"""
+    if not latex: return html_txt
+    def repl(m):
+        raw = m.group(0)
+        span = _clean(raw)
+        tex = latex.get(expr_hash(span)) if is_formula(span) else None
+        if not tex: return raw
+        start = raw.index(span)
+        return f"{raw[:start]}${tex}${raw[start + len(span):]}"
+    return "".join(_SPAN_RE.sub(repl, part) if is_text else part for is_text, part in _text_parts(html_txt))
+
+# ---------- sympy（只在轉換時載入） ----------
+_sympy = None
+
+def _load_sympy():
+    global _sympy
+    if _sympy is None:
+        import sympy
+        from sympy.parsing import sympy_parser as sp
+        transforms = sp.standard_transformations + (sp.implicit_multiplication_application, sp.convert_xor)
+        # 單一字母一律當變數（否則 E、I、S、N、O、Q 會被當成 sympy 的常數 / 函式），f、g、h 當函式
+        letters = {c: sympy.Symbol(c) for c in "abcdeijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"}
+        letters.update({c: sympy.Function(c) for c in "fgh"})
+        _sympy = (sympy, sp.parse_expr, transforms, letters)
+    return _sympy
+
+def _parse(sympy, parse_expr, transforms, letters, text:str, evaluate:bool):
+    text = text.replace("√", "sqrt").replace("[", "(").replace("]", ")")
+    return parse_expr(text, local_dict=letters, transformations=transforms, evaluate=evaluate)
+
+def to_latex(expr:str) -> Tuple[Optional[str], Optional[str]]:
+    """回傳 (照原式排版的 LaTeX, 化簡後的 LaTeX)；無法解析時為 (None, None)。
+    顯示一律用前者（不先算出答案），化簡結果只放在詳解。process pool 的 worker 也直接呼叫這個函式"""
+    try:
+        sympy, parse_expr, transforms, letters = _load_sympy()
+        rel = {"<=": sympy.Le, "≤": sympy.Le, ">=": sympy.Ge, "≥": sympy.Ge, "=": sympy.Eq, "<": sympy.Lt, ">": sympy.Gt}
+        sides = _REL_RE.split(expr)
+        ops = _REL_RE.findall(expr)
+        if len(sides) > 2:
+            return None, None
+        parts = [_parse(sympy, parse_expr, transforms, letters, s, False) for s in sides]
+        shown = rel[ops[0]](*parts, evaluate=False) if ops else parts[0]
+        latex = sympy.latex(shown, order="none")
+        if _HUGE_POWER_RE.search(expr):
+            return latex, None
+        values = [sympy.simplify(_parse(sympy, parse_expr, transforms, letters, s, True)) for s in sides]
+        simple = sympy.latex(rel[ops[0]](*values) if ops else values[0])
+        # 只是調換順序（同一組字元）的不算化簡
+        if sorted(simple.replace(" ", "")) == sorted(latex.replace(" ", "")):
+            return latex, None
+        return latex, simple
+    except Exception:
+        return None, None
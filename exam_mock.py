@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# 考古題 Handy Plus — 模擬考抽題，不依賴 Streamlit
+"""依分層配額與權重抽出一份試卷，不在 SQL 端 ORDER BY RANDOM() 排整張表。
+
+題庫快照（exam_db.mock_pool）先算好每題權重，每一層建一張 alias 表（Vose），之後每抽一題都是 O(1)；
+抽到已選過的題目直接丟掉再抽，等同逐題依權重不放回抽樣。同一份快照、配額與 seed 抽出的試卷相同。
+
+    sampler = build_sampler(exam_db.mock_pool(filters, "", False, 0, "subject"))
+    ids = draw(sampler, allocate(sampler, 100), seed=42)
+"""
+from typing import Dict, List
+
+import numpy as np
+
+STALE_DAYS = 30      # 距上次註記超過這麼多天（或從未註記）視為完全「久未複習」
+MAX_ROUNDS = 16      # 權重極度集中時重抽的輪數上限，之後改用 rng.choice 補齊
+
+def weights(pool:Dict[str, np.ndarray], w_wrong:float=1.0, w_star:float=1.0, w_stale:float=1.0) -> np.ndarray:
+    """權重 = 1 + 錯誤次數 × w_wrong + 加星 × w_star + 久未複習程度（0~1）× w_stale"""
+    stale = np.nan_to_num(pool["age_days"] / STALE_DAYS, nan=1.0).clip(0.0, 1.0)
+    w = 1.0 + pool["wrong_count"].clip(0) * w_wrong + (pool["star"] > 0) * w_star + stale * w_stale
+    return np.maximum(w, 1e-9)
+
+def alias_table(w:np.ndarray):
+    """Vose alias method：回傳 (prob, alias)；抽一次 = 均勻選一格 i，再以 prob[i] 決定取 i 或 alias[i]"""
+    n = len(w)
+    scaled = (w * (n / w.sum())).tolist()
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s, l = small.pop(), large[-1]
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] += scaled[s] - 1.0
+        if scaled[l] < 1.0:
+            small.append(large.pop())
+    # 剩下的格子（含浮點誤差造成的）機率為 1
+    return np.array(prob), np.array(alias, dtype=np.int64)
+
+def build_sampler(pool:Dict[str, np.ndarray], w_wrong:float=1.0, w_star:float=1.0, w_stale:float=1.0) -> Dict[str, Dict]:
+    """每一層一張 alias 表：{分層鍵: {id, weight, prob, alias}}"""
+    w = weights(pool, w_wrong, w_star, w_stale)
+    sampler = {}
+    for key in sorted(set(pool["stratum"].tolist())):
+        mask = pool["stratum"] == key
+        prob, alias = alias_table(w[mask])
+        sampler[key] = {"id": pool["id"][mask], "weight": w[mask], "prob": prob, "alias": alias}
+    return sampler
+
+def allocate(sampler:Dict[str, Dict], n:int, by:str="size") -> Dict[str, int]:
+    """把 n 題依比例分給各層（最大餘數法），不超過各層題數；by 為 size（依題數）或 weight（依權重總和，
+    錯題多的科目分到較多題）"""
+    keys = list(sampler)
+    if not keys:
+        return {}
+    share = np.array([len(t["id"]) if by == "size" else t["weight"].sum() for t in sampler.values()], dtype=np.float64)
+    cap = np.array([len(t["id"]) for t in sampler.values()], dtype=np.int64)
+    quota = np.zeros(len(keys), dtype=np.int64)
+    target = min(int(n), int(cap.sum()))
+    while quota.sum() < target:
+        room = quota < cap
+        s = np.where(room, share, 0.0)
+        if s.sum() <= 0: s = room.astype(np.float64)
+        exact = s / s.sum() * (target - quota.sum())
+        add = np.minimum(np.floor(exact).astype(np.int64), cap - quota)
+        quota += add
+        left = target - quota.sum()
+        # 剩下的依小數部分由大到小各補一題
+        for i in np.argsort(-(exact - np.floor(exact)), kind="stable"):
+            if left <= 0: break
+            if quota[i] < cap[i]:
+                quota[i] += 1; left -= 1
+    return {k: int(q) for k, q in zip(keys, quota)}
+
+def _draw_stratum(rng:np.random.Generator, table:Dict, k:int) -> List[int]:
+    ids, prob, alias = table["id"], table["prob"], table["alias"]
+    n = len(ids)
+    if k >= n:
+        return ids[rng.permutation(n)].tolist()
+    taken = np.zeros(n, dtype=bool)
+    picked: List[np.ndarray] = []
+    need = k
+    for _ in range(MAX_ROUNDS):
+        i = rng.integers(n, size=2 * need + 8)
+        idx = np.where(rng.random(len(i)) < prob[i], i, alias[i])
+        # 同一批內重複的只留第一次出現，再去掉先前已抽到的
+        _, first = np.unique(idx, return_index=True)
+        idx = idx[np.sort(first)]
+        idx = idx[~taken[idx]][:need]
+        taken[idx] = True
+        picked.append(idx)
+        need -= len(idx)
+        if need == 0: break
+    else:
+        rest = np.flatnonzero(~taken)
+        w = table["weight"][rest]
+        picked.append(rng.choice(rest, size=need, replace=False, p=w / w.sum()))
+    return ids[np.concatenate(picked)].tolist()
+
+def draw(sampler:Dict[str, Dict], quotas:Dict[str, int], seed:int=None) -> List[int]:
+    """依配額從各層抽題，回傳 id（依分層鍵排序、層內為抽出順序）；seed 相同則結果相同"""
+    rng = np.random.default_rng(seed)
+    out: List[int] = []
+    for key, table in sampler.items():
+        k = int(quotas.get(key, 0))
+        if k > 0:
+            out.extend(_draw_stratum(rng, table, k))
+    return out
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# 考古題 Handy Plus — 效能剖析（選用），不依賴 Streamlit
+"""每次重跑記錄一份 Run：區段計時（側欄、各分頁、快取命中與否）與每一條 SQL 的耗時、列數、
+EXPLAIN QUERY PLAN。沒有進行中的 Run 時，連線與區段只多一次 thread-local 檢查。
+
+    run = start_run("rerun")
+    with section("sidebar"): ...
+    with section("query_questions_cached", cached=True): ...   # 快取函式內呼叫 note_cache_miss()
+    run.finish()
+"""
+import re, json, time, sqlite3, threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+MAX_EVENTS = 2000      # 單次重跑最多記錄的事件數，超過只計數
+_PLAN_CACHE_MAX = 500  # 同一段 SQL 的查詢計畫只查一次
+
+_local = threading.local()
+_plans: Dict[str, List[str]] = {}
+_plans_lock = threading.Lock()
+_WS_RE = re.compile(r"\s+")
+_READ_RE = re.compile(r"(SELECT|WITH)\b", re.I)
+
+class Run:
+    """一次重跑的計時紀錄；時間皆為相對於開始的毫秒數"""
+
+    def __init__(self, label:str=""):
+        self.label = label
+        self.started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.t0 = time.perf_counter()
+        self.total_ms: Optional[float] = None
+        self.events: List[Dict] = []
+        self.dropped = 0
+        self._open: List[Dict] = []
+
+    def now_ms(self) -> float:
+        return (time.perf_counter() - self.t0) * 1000
+
+    def add(self, ev:Dict) -> Dict:
+        ev["depth"] = len(self._open)
+        ev["parent"] = self._open[-1]["name"] if self._open else ""
+        if len(self.events) < MAX_EVENTS:
+            self.events.append(ev)
+        else:
+            self.dropped += 1
+        return ev
+
+    def finish(self):
+        if self.total_ms is None:
+            self.total_ms = round(self.now_ms(), 3)
+        if _current() is self:
+            _local.run = None
+        return self
+
+    def sql_events(self) -> List[Dict]:
+        return [e for e in self.events if e["kind"] == "sql"]
+
+    def to_jsonl(self) -> str:
+        head = {"run": self.started_at, "label": self.label}
+        return "".join(json.dumps({**head, **e}, ensure_ascii=False) + "\n" for e in self.events)
+
+def _current() -> Optional[Run]:
+    return getattr(_local, "run", None)
+
+def current() -> Optional[Run]:
+    return _current()
+
+def start_run(label:str="") -> Run:
+    """在目前執行緒開始記錄；之前未結束的 Run 直接作廢"""
+    run = Run(label)
+    _local.run = run
+    return run
+
+def stop():
+    _local.run = None
+
+@contextmanager
+def section(name:str, cached:bool=False):
+    """計時一段程式；cached=True 表示包住 st.cache_data 函式，預設視為命中，
+    函式本體（只在未命中時執行）呼叫 note_cache_miss() 改成未命中"""
+    run = _current()
+    if run is None:
+        yield None
+        return
+    ev = run.add({"kind": "section", "name": name, "start_ms": round(run.now_ms(), 3), "dur_ms": None})
+    if cached: ev["cache"] = "hit"
+    run._open.append(ev)
+    try:
+        yield ev
+    finally:
+        run._open.remove(ev)
+        ev["dur_ms"] = round(run.now_ms() - ev["start_ms"], 3)
+
+def note_cache_miss():
+    run = _current()
+    if run is not None:
+        for ev in reversed(run._open):
+            if "cache" in ev:
+                ev["cache"] = "miss"
+                return
+
+def jsonl(runs:List[Run]) -> str:
+    return "".join(r.to_jsonl() for r in runs)
+
+# ---------- SQL ----------
+def _explain(conn:sqlite3.Connection, sql:str, params) -> List[str]:
+    with _plans_lock:
+        plan = _plans.get(sql)
+    if plan is not None:
+        return plan
+    try:
+        # 直接用 sqlite3.Cursor，避免 EXPLAIN 本身又被記錄
+        plan = [r[3] for r in sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, params)]
+    except sqlite3.Error as e:
+        plan = [f"(無法取得查詢計畫：{e})"]
+    with _plans_lock:
+        if len(_plans) >= _PLAN_CACHE_MAX: _plans.clear()
+        _plans[sql] = plan
+    return plan
+
+def plan_flags(plan:List[str]) -> List[str]:
+    """標出全表掃描與暫存 B-tree（排序 / 去重沒用到索引）。依索引順序掃描（SCAN … USING INDEX）
+    通常是配合 ORDER BY … LIMIT 提早結束，不列為全表掃描"""
+    flags = []
+    for d in plan:
+        if d.startswith("SCAN ") and " USING " not in d and "VIRTUAL TABLE" not in d:
+            flags.append("全表掃描 " + d[5:].split(" ")[0])
+        elif "TEMP B-TREE" in d:
+            flags.append("暫存B-tree")
+    return flags
+
+class ProfiledCursor(sqlite3.Cursor):
+    """只在有 Run 時建立；fetch 的時間與列數累加到同一筆 SQL 事件"""
+    _ev: Optional[Dict] = None
+
+    def _record(self, method, sql:str, params, many:bool=False):
+        run = _current()
+        if run is None:
+            return method(sql, params)
+        text = _WS_RE.sub(" ", sql).strip()
+        ev = {"kind": "sql", "name": text[:80], "sql": text, "rows": 0, "flags": [], "plan": []}
+        if not many and _READ_RE.match(text):
+            ev["plan"] = _explain(self.connection, sql, params)
+            ev["flags"] = plan_flags(ev["plan"])
+        ev["start_ms"] = round(run.now_ms(), 3)
+        t0 = time.perf_counter()
+        try:
+            return method(sql, params)
+        finally:
+            ev["dur_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+            if self.rowcount > 0: ev["rows"] = self.rowcount
+            self._ev = run.add(ev)
+
+    def execute(self, sql, params=()):
+        return self._record(super().execute, sql, params)
+
+    def executemany(self, sql, seq):
+        return self._record(super().executemany, sql, seq, many=True)
+
+    def _fetched(self, rows, t0:float):
+        ev = self._ev
+        if ev is not None:
+            ev["dur_ms"] = round(ev["dur_ms"] + (time.perf_counter() - t0) * 1000, 3)
+            ev["rows"] += len(rows) if isinstance(rows, list) else (rows is not None)
+        return rows
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        return self._fetched(super().fetchone(), t0)
+
+    def fetchmany(self, size:int=None):
+        t0 = time.perf_counter()
+        return self._fetched(super().fetchmany(self.arraysize if size is None else size), t0)
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        return self._fetched(super().fetchall(), t0)
+
+    def __next__(self):
+        t0 = time.perf_counter()
+        row = super().__next__()
+        self._fetched(row, t0)
+        return row
+
+class ProfiledConnection(sqlite3.Connection):
+    """sqlite3.connect(factory=...) 用；沒有 Run 時行為與一般連線相同"""
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = ProfiledCursor if _current() is not None else sqlite3.Cursor
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        if _current() is None:
+            return super().execute(sql, params)
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        if _current() is None:
+            return super().executemany(sql, seq)
+        return self.cursor().executemany(sql, seq)
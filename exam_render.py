@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# 考古題 Handy Plus — 題目 HTML 呈現（螢光筆、題目片段快取），不依賴 Streamlit
+import re, zlib, functools, threading
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+# HTML 標籤（含屬性）、註解與 entity 只原樣輸出，不參與關鍵字比對
+_HTML_TOKEN_RE = re.compile(r"(<!--.*?-->|<[!/]?[A-Za-z][^>]*>|&(?:#\d+|#x[0-9A-Fa-f]+|\w+);)", re.S)
+
+@functools.lru_cache(maxsize=256)
+def _keyword_pattern(keywords:str):
+    """關鍵字編成單一 alternation（長的優先），一次掃描即可找出所有關鍵字"""
+    kws = sorted({k.strip() for k in re.split(r"[,，]", keywords or "") if k.strip()}, key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, kws))) if kws else None
+
+def apply_highlight(html_txt:str, keywords:str, bg:str, fg:str) -> str:
+    if not html_txt: return ""
+    pat = _keyword_pattern(keywords)
+    if pat is None: return html_txt
+    span = f"<span style='background:{bg};color:{fg};padding:0 2px;border-radius:2px'>"
+    # split 後奇數位置是標籤 / entity，偶數位置才是文字
+    parts = _HTML_TOKEN_RE.split(html_txt)
+    for i in range(0, len(parts), 2):
+        if parts[i]:
+            parts[i] = pat.sub(lambda m: f"{span}{m.group(0)}</span>", parts[i])
+    return "".join(parts)
+
+class LRU:
+    """執行緒安全的小型 LRU（app 放在 st.cache_resource 裡，跨重跑、跨 session 共用）"""
+    def __init__(self, maxsize:int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data: return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def values(self) -> list:
+        with self._lock:
+            return list(self._data.values())
+
+# ---------- 題目片段 ----------
+# 每題呈現成幾個 HTML 片段（標題列、題幹、選項、詳解…），各檢視直接拼裝。
+# 快取鍵為 (qid, questions.updated_at, 註記版本)：題目或註記沒變就不重做換行、標題組字與螢光筆。
+DEFAULT_HL = ("#ffff66", "#000000")
+
+def _s(v) -> str:
+    return "" if v is None or v != v else str(v)   # v != v：pandas 的 NaN
+
+def options_html(txt:str) -> str:
+    """選項換行（\r\n / \r / \n）轉成 <br>"""
+    return (txt or "").replace("\r\n", "\n").replace("\r", "\n").replace("\n", "<br>")
+
+def _ann_state(ann:Dict) -> tuple:
+    """影響片段內容的註記值（題卡底色由檢視自己套，不在片段內）"""
+    return (ann.get("highlight_keywords") or "", ann.get("hl_bg") or DEFAULT_HL[0], ann.get("hl_fg") or DEFAULT_HL[1],
+            int(ann.get("wrong_count") or 0), int(ann.get("done") or 0), int(ann.get("star") or 0))
+
+def ann_version(ann:Dict) -> str:
+    """註記版本：上述註記值的摘要。last_updated 只到秒，同一秒內連按兩次也要能分辨"""
+    return format(zlib.crc32(repr(_ann_state(ann)).encode("utf-8")), "08x")
+
+def render_question(q:Dict, ann:Dict, post:Callable=None) -> Dict[str, str]:
+    """q 需有 id、分類欄位與 stem / options / answer / explanation / tags；ann 為該題註記（可為空）。
+    post(html) 在螢光筆之後套用到題幹、選項與詳解（例如算式排版）"""
+    kw, bg, fg, wrong, done, star = _ann_state(ann)
+    post = post or (lambda x: x)
+    header = "｜".join([f"#{int(q['id'])}", *(_s(q.get(c)) for c in ("subject", "year", "type", "topic", "subtopic")),
+                       f"錯誤次數 {wrong}", "已做過" if done else "未做", "★" if star else "☆"])
+    return {"header": header,
+            "stem": post(apply_highlight(_s(q.get("stem")), kw, bg, fg)),
+            "options": post(options_html(_s(q.get("options")))),
+            "answer": _s(q.get("answer")),
+            "explanation": post(apply_highlight(_s(q.get("explanation")), kw, bg, fg)),
+            "tags": _s(q.get("tags"))}
+
+class FragmentCache:
+    """記憶體 LRU；未命中時先問 load(keys) -> {key: 片段}（例如資料庫），仍沒有才重新產生，
+    新產生的交給 store([(key, 片段), ...]) 保存"""
+    def __init__(self, maxsize:int, load:Callable=None, store:Callable=None):
+        self._lru = LRU(maxsize)
+        self.load, self.store = load, store
+        self.stats = {"memory": 0, "stored": 0, "rendered": 0}
+
+    def get_many(self, rows:List[Dict], anns:Dict[int, Dict], variant:str="", post:Callable=None) -> Dict[int, Dict[str, str]]:
+        """variant 接在註記版本後面，區分同一題的不同呈現（例如有無算式排版）；post 見 render_question"""
+        out: Dict[int, Dict[str, str]] = {}
+        miss = []
+        for q in rows:
+            qid = int(q["id"]); ann = anns.get(qid) or {}
+            key = (qid, _s(q.get("updated_at")), ann_version(ann) + variant)
+            frags = self._lru.get(key)
+            if frags is None:
+                miss.append((key, q, ann))
+            else:
+                out[qid] = frags
+        self.stats["memory"] += len(out)
+        if not miss:
+            return out
+        stored = self.load([key for key, _, _ in miss]) if self.load else {}
+        fresh = []
+        for key, q, ann in miss:
+            frags = stored.get(key)
+            if frags is None:
+                frags = render_question(q, ann, post)
+                fresh.append((key, frags))
+            self._lru.put(key, frags)
+            out[key[0]] = frags
+        self.stats["stored"] += len(miss) - len(fresh)
+        self.stats["rendered"] += len(fresh)
+        if fresh and self.store:
+            self.store(fresh)
+        return out
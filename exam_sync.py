@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+# 考古題 Handy Plus — 裝置間增量同步，不依賴 Streamlit
+"""兩台裝置（例如筆電與共用伺服器）之間只交換上次同步後變動的資料，不必整份 CSV 匯出再匯入。
+
+- exam_db 的 trigger 把 questions / notes / annotations / note_assets 的異動記在 changes 表（seq 單調遞增）
+- export_changes(peer) 打包對方尚未確認收到的異動：變動的列、刪除墓碑，以及新圖片（依 sha256，同一內容只放一份）
+- import_changes(path) 以 updated_at / last_updated 比較，較新的一方勝出（相同時保留本機）；本機已有的圖片不再寫入
+- 同步檔附上「本機已收到對方到哪個 seq」，對方匯入後下次就從那裡開始送；匯入造成的異動記上來源裝置，不會再送回去
+
+    path, n = export_changes(peer)      # 筆電：產生給伺服器的同步檔
+    stats = import_changes(path)        # 伺服器：套用
+"""
+import os, io, csv, json, socket, sqlite3, hashlib, zipfile
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import exam_db
+from exam_db import get_db, get_conn, QUESTION_FIELDS, ANN_FIELDS
+
+FORMAT = 1
+ASSET_COLS = ["uid","quid","sha256","ext","caption","created_at"]
+STATS = ["questions","notes","annotations","assets","deleted","older","missing"]
+
+def device_id() -> str:
+    return get_conn().execute("SELECT value FROM sync_state WHERE key='device'").fetchone()[0]
+
+def device_name() -> str:
+    row = get_conn().execute("SELECT value FROM sync_state WHERE key='name'").fetchone()
+    return row[0] if row else socket.gethostname()
+
+def _epoch() -> int:
+    return int(get_conn().execute("SELECT value FROM sync_state WHERE key='epoch'").fetchone()[0])
+
+def peers() -> List[Dict]:
+    """同步過的裝置：[{peer, name, acked（對方已確認收到的本機 seq）, received（已套用到對方的 seq）, updated_at}]"""
+    cur = get_conn().execute("SELECT peer, name, acked, received, updated_at FROM sync_peers ORDER BY updated_at DESC")
+    return [dict(zip(["peer","name","acked","received","updated_at"], r)) for r in cur]
+
+def _since(conn, peer:Optional[str]) -> tuple:
+    """(起點 seq, 本機已收到對方的 seq)；peer 為 None 表示新裝置，送完整資料"""
+    row = conn.execute("SELECT acked, received FROM sync_peers WHERE peer=?", (peer,)).fetchone() if peer else None
+    return (row[0], row[1]) if row else (0, 0)
+
+def pending_count(peer:Optional[str]) -> int:
+    """要送給 peer 的異動筆數"""
+    conn = get_conn(); since, _ = _since(conn, peer)
+    return conn.execute("SELECT COUNT(*) FROM changes WHERE seq > ? AND (? IS NULL OR origin IS NOT ?)",
+                        (since, peer, peer)).fetchone()[0]
+
+# ---------- 匯出 ----------
+def _write_csv(zf:zipfile.ZipFile, name:str, header:List[str], rows) -> int:
+    n = 0
+    with zf.open(name, "w") as raw, io.TextIOWrapper(raw, encoding="utf-8", newline="") as fh:
+        w = csv.writer(fh)
+        w.writerow(header)
+        for row in rows:
+            w.writerow(row); n += 1
+    return n
+
+def _file_sha(path:str) -> Optional[str]:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def export_changes(peer:Optional[str]=None):
+    """把 peer 尚未確認收到的異動打包成 ZIP；回傳 (路徑, 異動筆數)"""
+    conn = get_conn()
+    since, received = _since(conn, peer)
+    upto = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+    # 範圍固定在 (since, upto]：匯出期間的新異動 seq 較大，下次再送
+    window = "c.seq > ? AND c.seq <= ? AND (? IS NULL OR c.origin IS NOT ?)"
+    args = (since, upto, peer, peer)
+    path = exam_db._new_export_path(".sync.zip")
+    counts = {}
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        q_cols = ["uid"] + QUESTION_FIELDS + ["created_at","updated_at"]
+        counts["questions"] = _write_csv(zf, "questions.csv", q_cols, conn.execute(
+            f"SELECT {', '.join(f'q.{c}' for c in q_cols)} FROM changes c JOIN questions q ON q.uid = c.uid "
+            f"WHERE c.tbl = 'questions' AND c.op = 'u' AND {window} ORDER BY c.seq", args))
+        counts["notes"] = _write_csv(zf, "notes.csv", ["quid","note","created_at","updated_at"], conn.execute(
+            f"SELECT q.uid, n.note, n.created_at, n.updated_at FROM changes c JOIN questions q ON q.uid = c.uid "
+            f"JOIN notes n ON n.qid = q.id WHERE c.tbl = 'notes' AND c.op = 'u' AND {window} ORDER BY c.seq", args))
+        counts["annotations"] = _write_csv(zf, "annotations.csv", ["quid"] + ANN_FIELDS + ["last_updated"], conn.execute(
+            f"SELECT q.uid, {', '.join(f'a.{c}' for c in ANN_FIELDS)}, a.last_updated FROM changes c JOIN questions q ON q.uid = c.uid "
+            f"JOIN annotations a ON a.qid = q.id WHERE c.tbl = 'annotations' AND c.op = 'u' AND {window} ORDER BY c.seq", args))
+        assets = conn.execute(
+            f"SELECT a.uid, q.uid, a.sha256, b.ext, a.caption, a.created_at, a.file_path FROM changes c "
+            f"JOIN note_assets a ON a.uid = c.uid JOIN questions q ON q.id = a.qid LEFT JOIN media_blobs b ON b.sha256 = a.sha256 "
+            f"WHERE c.tbl = 'note_assets' AND c.op = 'u' AND {window} ORDER BY c.seq", args).fetchall()
+        rows, sent = [], set()
+        for uid, quid, sha, ext, cap, created, fp in assets:
+            # 舊版（未內容定址）的圖片在這裡算雜湊，對方一樣以內容存放
+            src = exam_db._blob_paths(sha, ext)["original"] if sha and ext is not None else fp
+            sha = sha or (_file_sha(fp) if fp else None)
+            if not sha or not src or not os.path.exists(src):
+                continue
+            ext = ext if ext is not None else (os.path.splitext(fp)[1].lower() or ".bin")
+            if sha not in sent:
+                zf.write(src, arcname=f"media/{sha}{ext}"); sent.add(sha)
+            rows.append((uid, quid, sha, ext, cap, created))
+        counts["assets"] = _write_csv(zf, "note_assets.csv", ASSET_COLS, rows)
+        counts["deleted"] = _write_csv(zf, "deletes.csv", ["tbl","uid","at"], conn.execute(
+            f"SELECT c.tbl, c.uid, c.at FROM changes c WHERE c.op = 'd' AND {window} ORDER BY c.seq", args))
+        zf.writestr("manifest.json", json.dumps({
+            "format": FORMAT, "device": device_id(), "name": device_name(), "epoch": _epoch(), "since": since, "upto": upto,
+            "acked": received, "created_at": datetime.now().isoformat(timespec="seconds"), "counts": counts,
+        }, ensure_ascii=False))
+    return path, sum(counts.values())
+
+# ---------- 匯入 ----------
+def _rows(zf:zipfile.ZipFile, name:str):
+    try:
+        raw = zf.open(name)
+    except KeyError:
+        return
+    with raw, io.TextIOWrapper(raw, encoding="utf-8", newline="") as fh:
+        yield from csv.DictReader(fh)
+
+def _rename_question(conn, old:str, new:str):
+    """兩台裝置各自匯入了同一題（題幹相同、uid 不同）：統一用較小的 uid，本機的筆記 / 註記異動跟著改名"""
+    conn.execute("UPDATE questions SET uid=? WHERE uid=?", (new, old))
+    conn.execute("DELETE FROM changes WHERE tbl='questions' AND uid=?", (old,))
+    conn.execute("UPDATE changes SET uid=? WHERE tbl IN ('notes','annotations') AND uid=?", (new, old))
+
+def _tombstoned(conn, tbls:tuple, uid:str, ts:str) -> bool:
+    """本機在 ts 當下或之後刪除過（changes 有 op='d' 的墓碑）：較舊的遠端異動不能把它加回來"""
+    holders = ",".join(["?"]*len(tbls))
+    row = conn.execute(f"SELECT MAX(at) FROM changes WHERE tbl IN ({holders}) AND uid=? AND op='d'", (*tbls, uid)).fetchone()
+    return row[0] is not None and row[0] >= (ts or "")
+
+def _apply_question(conn, row:Dict, qids:Dict[str, int], keep:List[str], stats:Dict[str, int]):
+    uid = row["uid"]; h = exam_db.stem_hash(row["stem"])
+    if _tombstoned(conn, ("questions",), uid, row["updated_at"]):
+        stats["older"] += 1
+        return
+    local = (conn.execute("SELECT id, uid, updated_at FROM questions WHERE uid=?", (uid,)).fetchone()
+             or conn.execute("SELECT id, uid, updated_at FROM questions WHERE stem_hash=?", (h,)).fetchone())
+    vals = [row.get(f, "") for f in QUESTION_FIELDS]
+    if local is None:
+        cur = conn.execute(f"INSERT INTO questions ({', '.join(QUESTION_FIELDS)}, stem_hash, created_at, updated_at, uid) "
+                           f"VALUES ({', '.join(['?']*(len(QUESTION_FIELDS)+4))})", (*vals, h, row["created_at"], row["updated_at"], uid))
+        qids[uid] = cur.lastrowid; stats["questions"] += 1
+        return
+    qid, local_uid, local_upd = local
+    qids[uid] = qid
+    if local_uid != uid:
+        if uid < local_uid: _rename_question(conn, local_uid, uid)
+        else: keep.append(local_uid)   # 匯入結束後再記一筆異動，讓對方改用本機的 uid
+    if (row["updated_at"] or "") <= (local_upd or ""):
+        stats["older"] += 1
+        return
+    try:
+        conn.execute(f"UPDATE questions SET {', '.join(f'{f}=?' for f in QUESTION_FIELDS)}, stem_hash=?, updated_at=? WHERE id=?",
+                     (*vals, h, row["updated_at"], qid))
+        stats["questions"] += 1
+    except sqlite3.IntegrityError:
+        stats["older"] += 1   # 改過的題幹和本機另一題相同，保留本機
+
+def _qid(conn, qids:Dict[str, int], quid:str) -> Optional[int]:
+    if quid not in qids:
+        row = conn.execute("SELECT id FROM questions WHERE uid=?", (quid,)).fetchone()
+        qids[quid] = row[0] if row else None
+    return qids[quid]
+
+def _newer(conn, sql:str, qid:int, ts:str) -> bool:
+    row = conn.execute(sql, (qid,)).fetchone()
+    return row is None or (ts or "") > (row[0] or "")
+
+def _prepare_media(zf:zipfile.ZipFile) -> Dict[str, Dict]:
+    """在寫入交易之前把同步檔中本機還沒有的圖片寫入儲存區、產生縮圖（雜湊不符的略過）：{sha256: blob}"""
+    conn = get_conn(); out = {}
+    for row in _rows(zf, "note_assets.csv"):
+        sha = row["sha256"]
+        if sha in out or conn.execute("SELECT 1 FROM media_blobs WHERE sha256=?", (sha,)).fetchone():
+            continue
+        try:
+            data = zf.read(f"media/{sha}{row['ext']}")
+        except KeyError:
+            continue
+        if hashlib.sha256(data).hexdigest() == sha:
+            out[sha] = exam_db._prepare_blob(data, row["ext"])
+    return out
+
+def _apply_asset(conn, row:Dict, media:Dict[str, Dict], qids:Dict[str, int], stats:Dict[str, int]):
+    if conn.execute("SELECT 1 FROM note_assets WHERE uid=?", (row["uid"],)).fetchone():
+        return
+    qid = _qid(conn, qids, row["quid"]); sha = row["sha256"]
+    if qid is None:
+        stats["missing"] += 1; return
+    known = conn.execute("SELECT ext FROM media_blobs WHERE sha256=?", (sha,)).fetchone()
+    if known is not None:
+        ext = known[0]
+    elif sha in media:
+        ext = exam_db._register_blob(conn, media[sha])
+    else:
+        stats["missing"] += 1; return
+    conn.execute("INSERT INTO note_assets (qid, file_path, caption, created_at, sha256, uid) VALUES (?,?,?,?,?,?)",
+                 (qid, exam_db._blob_paths(sha, ext)["original"], row["caption"], row["created_at"], sha, row["uid"]))
+    stats["assets"] += 1
+
+def _apply_delete(conn, row:Dict, qids:Dict[str, int], stats:Dict[str, int], released:List):
+    """墓碑比本機那一列新（或同時）才刪；本機在對方刪除之後又改過的保留"""
+    tbl, uid, at = row["tbl"], row["uid"], row["at"] or ""
+    if tbl == "questions":
+        r = conn.execute("SELECT id, updated_at FROM questions WHERE uid=?", (uid,)).fetchone()
+        if r and (r[1] or "") <= at:
+            conn.execute("INSERT OR IGNORE INTO temp._del_ids (id) VALUES (?)", (r[0],))   # 稍後與筆記、圖片一起刪
+    elif tbl in ("notes", "annotations"):
+        qid = _qid(conn, qids, uid); ts = "updated_at" if tbl == "notes" else "last_updated"
+        r = conn.execute(f"SELECT {ts} FROM {tbl} WHERE qid=?", (qid,)).fetchone() if qid else None
+        if r and (r[0] or "") <= at:
+            conn.execute(f"DELETE FROM {tbl} WHERE qid=?", (qid,)); stats["deleted"] += 1
+    elif tbl == "note_assets":
+        r = conn.execute("SELECT id, sha256, file_path FROM note_assets WHERE uid=?", (uid,)).fetchone()
+        if r:
+            conn.execute("DELETE FROM note_assets WHERE id=?", (r[0],)); released.append(r[1:]); stats["deleted"] += 1
+
+def import_changes(path:str) -> Dict[str, int]:
+    """套用其他裝置的同步檔（單一交易）；回傳各類筆數：新增或更新的 questions / notes / annotations / assets、
+    deleted、older（本機較新而保留）、missing（找不到題目或圖片檔）。同一個檔案重複匯入不會有變動"""
+    stats = dict.fromkeys(STATS, 0)
+    with zipfile.ZipFile(path) as zf:
+        try:
+            man = json.loads(zf.read("manifest.json"))
+        except KeyError:
+            raise ValueError("不是同步檔（缺少 manifest.json）")
+        if man.get("format") != FORMAT:
+            raise ValueError(f"不支援的同步檔格式：{man.get('format')}")
+        peer = man["device"]
+        if peer == device_id():
+            raise ValueError("這是本機匯出的同步檔")
+        qids: Dict[str, int] = {}; keep: List[str] = []; released: List = []
+        media = _prepare_media(zf)
+        with get_db().write() as conn:
+            before = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+            known = conn.execute("SELECT received, epoch FROM sync_peers WHERE peer=?", (peer,)).fetchone() or (0, 0)
+            if int(man.get("epoch") or 0) > known[1]:
+                # 對方清除過資料：先前從它收到的異動也要一併送回去
+                conn.execute("UPDATE changes SET origin=NULL WHERE origin=?", (peer,))
+            for row in _rows(zf, "questions.csv"):
+                _apply_question(conn, row, qids, keep, stats)
+            for row in _rows(zf, "notes.csv"):
+                if _tombstoned(conn, ("questions", "notes"), row["quid"], row["updated_at"]):
+                    stats["older"] += 1; continue
+                qid = _qid(conn, qids, row["quid"])
+                if qid is None: stats["missing"] += 1; continue
+                if not _newer(conn, "SELECT updated_at FROM notes WHERE qid=?", qid, row["updated_at"]):
+                    stats["older"] += 1; continue
+                conn.execute("INSERT INTO notes (qid, note, created_at, updated_at) VALUES (?,?,?,?) "
+                             "ON CONFLICT(qid) DO UPDATE SET note=excluded.note, updated_at=excluded.updated_at",
+                             (qid, row["note"], row["created_at"], row["updated_at"]))
+                stats["notes"] += 1
+            for row in _rows(zf, "annotations.csv"):
+                if _tombstoned(conn, ("questions", "annotations"), row["quid"], row["last_updated"]):
+                    stats["older"] += 1; continue
+                qid = _qid(conn, qids, row["quid"])
+                if qid is None: stats["missing"] += 1; continue
+                if not _newer(conn, "SELECT last_updated FROM annotations WHERE qid=?", qid, row["last_updated"]):
+                    stats["older"] += 1; continue
+                vals = [int(row[c] or 0) if c in exam_db.STUDY_STATE else row[c] for c in ANN_FIELDS]
+                conn.execute(f"INSERT INTO annotations (qid, {', '.join(ANN_FIELDS)}, last_updated) VALUES ({', '.join(['?']*(len(ANN_FIELDS)+2))}) "
+                             f"ON CONFLICT(qid) DO UPDATE SET {', '.join(f'{c}=excluded.{c}' for c in ANN_FIELDS)}, last_updated=excluded.last_updated",
+                             (qid, *vals, row["last_updated"]))
+                stats["annotations"] += 1
+            for row in _rows(zf, "note_assets.csv"):
+                _apply_asset(conn, row, media, qids, stats)
+            exam_db._stage_ids(conn, "_del_ids")
+            for row in _rows(zf, "deletes.csv"):
+                _apply_delete(conn, row, qids, stats, released)
+            stats["deleted"] += exam_db._delete_staged(conn)
+            exam_db._release_blobs(conn, [sha for sha, _ in released])
+            exam_db._remove_legacy_files(conn, [fp for sha, fp in released if not sha])
+            # 這次匯入造成的異動都來自 peer，送給它時略過
+            conn.execute("UPDATE changes SET origin=? WHERE seq > ?", (peer, before))
+            now = datetime.now().isoformat(timespec="seconds")
+            conn.executemany("INSERT OR REPLACE INTO changes (tbl, uid, op, at) VALUES ('questions', ?, 'u', ?)", [(u, now) for u in keep])
+            # 中間漏了一個同步檔（since 超過已收到的位置）時不前進，請對方從舊位置重送
+            received = known[0]
+            if man["since"] <= received:
+                received = max(received, man["upto"])
+            # 對方清除過資料（epoch 變大）時確認位置會變小，照收，下次從那裡重送
+            conn.execute("""INSERT INTO sync_peers (peer, name, acked, received, epoch, updated_at) VALUES (?,?,?,?,?,?)
+                ON CONFLICT(peer) DO UPDATE SET name=excluded.name,
+                acked=CASE WHEN excluded.epoch > epoch THEN excluded.acked ELSE MAX(acked, excluded.acked) END,
+                epoch=MAX(epoch, excluded.epoch), received=excluded.received, updated_at=excluded.updated_at""",
+                (peer, man.get("name") or peer, int(man.get("acked") or 0), received, int(man.get("epoch") or 0), now))
+    exam_db.schedule_media_gc()
+    if stats["questions"] or stats["deleted"]:
+        exam_db.refresh_minhash()
+        exam_db.refresh_render_cache([q for q in qids.values() if q])
+    return stats